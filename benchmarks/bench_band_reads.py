@@ -0,0 +1,105 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Bytes read and wall time of the impedance reads on the bundled data files : whole frequency sweep
+              selected by a fancy index on 'existing' (former DataFileReader) against the hyperslab of the
+              0-200 kHz band and the columns of the features only (DataFileReader.read_band).
+              The bytes are the ones read by the process (rchar of /proc/self/io, Linux only), the files are in the
+              page cache : the times do not include the disk.
+
+Usage : python -m benchmarks.bench_band_reads [--repeat R]
+"""
+
+import argparse
+import glob
+import os
+import time
+import h5py
+import numpy as np
+from datafilereader import DataFileReader
+from features import DEFAULT_SPEC, feature_bins
+
+
+def bytes_read():
+    """
+        Returns:
+        number of bytes read by the process so far, None if not available : int
+    """
+    try:
+        with open("/proc/self/io") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("rchar"))
+    except (OSError, StopIteration):
+        return None
+
+
+def cost(fun, repeat):
+    """
+        Best wall time and bytes read of a function
+
+        Arguments:
+        fun -- function without arguments : callable
+        repeat -- number of runs : int
+
+        Returns:
+        duration [s] : float
+        bytes read by a run : int
+    """
+    times = []
+    for _ in range(repeat):
+        before = bytes_read()
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+        after = bytes_read()
+    return min(times), None if before is None else after - before
+
+
+# former DataFileReader : file opened by the constructor, then by the accessor with the default sieve buffer
+def full_sweep_fancy(path):
+    DataFileReader(path)
+    with h5py.File(path, 'r') as f:
+        mes_existing = np.flatnonzero(f['existing'][:])
+        frequency = f['impedance'][0, 0, :]
+        Z_array = f['impedance'][mes_existing, 1:, :]
+    Z = Z_array[:, 0, :] + 1j*Z_array[:, 1, :]
+    band = np.logical_and(frequency > DataFileReader.FREQ_MIN, frequency < DataFileReader.FREQ_MAX)
+    return frequency[band], Z[:, band]
+
+
+def last_row_full(path):
+    DataFileReader(path)
+    with h5py.File(path, 'r') as f:
+        n_ = np.flatnonzero(f['existing'][:])[-1]
+        return f['rawdata'][n_], f['impedance'][n_], f['metadata'][n_]
+
+
+def full_sweep_slice(path):
+    reader = DataFileReader(path)
+    reader.LIMIT_FREQ = False
+    return reader.get_all_mesurements()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bytes read and time of the impedance reads')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs, the best one is reported')
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join("./data", "**", "*.h5"), recursive=True))
+    bins = feature_bins(DEFAULT_SPEC)
+    n = sum(DataFileReader(path).get_number_of_mesurements() for path in files)
+    print("{} files, {} measurements, {} feature columns\n".format(len(files), n, len(bins)))
+
+    cases = {
+        "full sweep, fancy index (before)": lambda: [full_sweep_fancy(path) for path in files],
+        "full sweep (LIMIT_FREQ = False)": lambda: [full_sweep_slice(path) for path in files],
+        "band 0-200 kHz (get_all_mesurements)": lambda: [DataFileReader(path).get_all_mesurements() for path in files],
+        "feature columns + references (read_band)": lambda: [DataFileReader(path).read_band(bins) for path in files],
+        "last measurement, whole row (before)": lambda: [last_row_full(path) for path in files],
+        "last measurement (get_last_mesurement)": lambda: [DataFileReader(path).get_last_mesurement() for path in files],
+    }
+    print("{:<40} {:>12} {:>10}".format("read", "bytes read", "time [ms]"))
+    for name, fun in cases.items():
+        fun() # warm the file system cache
+        t, nbytes = cost(fun, args.repeat)
+        print("{:<40} {:>12} {:>10.1f}".format(name, "-" if nbytes is None else nbytes, t*1e3))
@@ -0,0 +1,145 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Accuracy of the bundle classifier during a session where the coil drifts, with the first calibration
+              only, with the latest reference press (as the live tools before the rolling calibration) and with the
+              rolling calibration (calibration.py). The coin measurements are the real deviations of the Groupe5
+              coins from their calibration, added to a coil whose resistance drifts linearly by DRIFT over the
+              session (the inductance by a tenth of it). Scenarios : empty coil presses every 10 measurements
+              (reference at the start only), a reference press every 50 measurements, empty coil presses every
+              150 measurements (too sparse to follow a fast drift) or no capture after the first reference.
+              The measurements during which the rolling calibration requests a recalibration are counted by
+              reason ('age' : no capture for MAX_AGE measurements, 'drift' : expected drift above MAX_DRIFT).
+
+Usage : python -m benchmarks.bench_drift [--n N] [--drift D ...] [--bundle FOLDER] [--seed SEED]
+"""
+
+import argparse
+import glob
+import time
+import warnings
+import numpy as np
+from calibration import CalibrationTracker, MEASUREMENT
+from datafilereader import DataFileReader
+from features import FeatureExtractor, LABELS, feature_bins, spec_on_bins
+from model_bundle import DEFAULT_BUNDLE
+from svm_inference import load_predictors
+from synthetic_data import CoinModel
+from tester_functions import classify_batch
+
+DEFAULT_COINS = sorted(glob.glob("./data/Groupe5/dataSetAGF-bobine3/*.h5"))
+DEFAULT_DRIFTS = (0.0, 0.02, 0.05, 0.2)
+SCENARIOS = {"empty presses": {'empty_every': 10, 'reference_every': 0},
+             "reference presses": {'empty_every': 0, 'reference_every': 50},
+             "sparse presses": {'empty_every': 150, 'reference_every': 0},
+             "no capture": {'empty_every': 0, 'reference_every': 0}}
+EMPTY_NOISE = 5e-4 # relative noise of an empty coil capture (0_line files)
+
+
+def make_session(models, columns, n, drift, rng, empty_every=0, reference_every=0):
+    """
+    Measurements of a session with a drifting coil, the first one is a reference press
+
+    Returns:
+    impedance (n, F) : 2D numpy array of complex
+    reference flag : 1D numpy array of bool
+    label of each measurement, -1 for the empty coil captures : 1D numpy array of int
+    """
+    calibration = models[0].reference_mean[..., columns]
+    calibration = calibration[0] + 1j*calibration[1]
+    t = np.arange(n)/n
+    coil = calibration.real*(1 + drift*t[:, None]) + 1j*calibration.imag*(1 + drift/10*t[:, None])
+
+    is_reference = np.zeros(n, dtype=bool)
+    empty = np.zeros(n, dtype=bool)
+    is_reference[0] = True
+    if reference_every:
+        is_reference[::reference_every] = True
+    if empty_every:
+        empty[empty_every::empty_every] = True
+    labels = np.where(is_reference | empty, -1, rng.integers(len(models), size=n))
+
+    Z = coil*(1 + EMPTY_NOISE*rng.standard_normal(coil.shape))
+    for m, model in enumerate(models):
+        rows = np.flatnonzero(labels == m)
+        delta = model.delta[rng.integers(len(model.delta), size=len(rows))][..., columns]
+        Z[rows] = coil[rows] + delta[:, 0] + 1j*delta[:, 1]
+    labels = np.where(labels >= 0, [LABELS.index(models[m].name) for m in np.maximum(labels, 0)], -1)
+    return Z, is_reference, labels
+
+
+def calibrate_fixed(frequency, spec, Z, is_reference, latest):
+    """
+    Features with the first reference press only, or with the latest one before each measurement
+
+    Returns:
+    features of the measurements that are not references (NaN on the references) : 2D numpy array
+    """
+    extractor = FeatureExtractor(frequency, **spec)
+    X = np.full((len(Z), extractor.n_features), np.nan)
+    for i in range(len(Z)):
+        if is_reference[i] and (latest or i == 0):
+            extractor.set_reference(Z[i])
+        elif not is_reference[i]:
+            extractor.transform(Z[i], out=X[i])
+    return X
+
+
+def calibrate_rolling(frequency, spec, Z, is_reference):
+    """
+    Features with the rolling calibration, one measurement at a time as the live tools
+
+    Returns:
+    features of the measurements (NaN on the captures)
+    number of measurements with a recalibration request, by reason : dict
+    time per measurement [s]
+    """
+    tracker = CalibrationTracker(frequency, spec)
+    X = np.full((len(Z), tracker.extractor.n_features), np.nan)
+    requests = {'uncalibrated': 0, 'step': 0, 'age': 0, 'drift': 0}
+    t0 = time.perf_counter()
+    for i in range(len(Z)):
+        if tracker.observe(Z[i], is_reference[i]) == MEASUREMENT:
+            tracker.extractor.transform(Z[i], out=X[i])
+        reason = tracker.recalibration_reason()
+        if reason is not None:
+            requests[reason] += 1
+    return X, requests, (time.perf_counter() - t0)/len(Z)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Accuracy with a drifting coil')
+    parser.add_argument('--n', type=int, default=2000, help='measurements per session')
+    parser.add_argument('--drift', nargs='+', type=float, default=list(DEFAULT_DRIFTS),
+                        help='relative drift of the resistance over the session')
+    parser.add_argument('--bundle', type=str, default=DEFAULT_BUNDLE, help='model bundle')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    SVM, SVMO, bundle = load_predictors(args.bundle)
+    models = [CoinModel(path) for path in DEFAULT_COINS]
+    bins = feature_bins(bundle.feature_spec)
+    spec = spec_on_bins(bundle.feature_spec, bins)
+    # the bins of the features are counted in the band read by DataFileReader, the models have all the columns
+    band = (models[0].frequency > DataFileReader.FREQ_MIN) & (models[0].frequency < DataFileReader.FREQ_MAX)
+    columns = np.flatnonzero(band)[bins]
+    frequency = models[0].frequency[columns]
+
+    print("accuracy on the coins of {} measurements (Groupe5 coins, {})".format(args.n, args.bundle))
+    print("{:<18} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10}".format(
+        "scenario", "drift", "first", "latest", "rolling", "age", "drift", "us/meas."))
+    for scenario, options in SCENARIOS.items():
+        for drift in args.drift:
+            rng = np.random.default_rng(args.seed)
+            Z, is_reference, labels = make_session(models, columns, args.n, drift, rng, **options)
+            coins = labels >= 0
+            X_rolling, requests, t = calibrate_rolling(frequency, spec, Z, is_reference)
+            accuracy = []
+            for X in (calibrate_fixed(frequency, spec, Z, is_reference, False),
+                      calibrate_fixed(frequency, spec, Z, is_reference, True), X_rolling):
+                verdicts = classify_batch(bundle.scale(X[coins]), SVM, SVMO, bundle.labels)
+                accuracy.append(np.mean(verdicts == np.asarray(bundle.labels, dtype=object)[labels[coins]]))
+            print("{:<18} {:>6.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8} {:>8} {:>10.1f}".format(
+                scenario, drift, *accuracy, requests['age'], requests['drift'], t*1e6))
@@ -0,0 +1,145 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Count the HDF5 file opens (and time) spent per new measurement by the live loop
+              (has_file_changed + get_last_mesurement), per-call reader vs persistent-handle reader.
+              The HDF5 file locking stays on : the writer reopens the file in 'a' mode for each measurement
+              while the persistent reader is open, as the ISS tool does.
+
+Usage : python -m benchmarks.bench_file_opens [--source FILE] [--n N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import h5py
+from datafilereader import DataFileReader
+
+DEFAULT_SOURCE = "./data/Groupe11/1_CHF.h5"
+
+
+def prepare_file(source, dest, swmr):
+    """
+        Copy the source file with all measurements flagged as not existing yet
+
+        Arguments:
+        source -- ISS data file to copy : str
+        dest -- path of the copy : str
+        swmr -- write the copy in the SWMR compatible format : bool
+
+        Returns:
+        number of measurements that can be appended : int
+    """
+    if swmr:
+        with h5py.File(source, 'r') as fs, h5py.File(dest, 'w', libver='latest') as fd:
+            for key, value in fs.attrs.items():
+                fd.attrs[key] = value
+            for key in fs.keys():
+                fd.create_dataset(key, data=fs[key][:])
+            fd['existing'][:] = 0
+            return len(fd['existing'])
+
+    shutil.copyfile(source, dest)
+    with h5py.File(dest, 'a') as fd:
+        fd['existing'][:] = 0
+        return len(fd['existing'])
+
+
+def writer_process(path, swmr, conn):
+    """
+        Acquisition tool emulation, runs in its own process (HDF5 does not allow the same process
+        to hold a read and a write handle on one file). Flags measurement k as existing for each k received.
+
+        Arguments:
+        path -- file to write : str
+        swmr -- keep the file open in SWMR write mode, otherwise reopen it for each measurement : bool
+        conn -- pipe end receiving the measurement indexes (None to stop) : multiprocessing.Connection
+    """
+    writer = None
+    if swmr:
+        writer = h5py.File(path, 'a', libver='latest')
+        writer.swmr_mode = True
+    conn.send(True)
+
+    k = conn.recv()
+    while k is not None:
+        if writer is None:
+            with h5py.File(path, 'a') as fw:
+                fw['existing'][k] = 1
+        else:
+            writer['existing'][k] = 1
+            writer.flush()
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + k)) # make sure the mtime moves
+        conn.send(True)
+        k = conn.recv()
+
+    if writer is not None:
+        writer.close()
+
+
+def run(source, n, mode):
+    """
+        Append n measurements one by one and read each of them as the live loop does
+
+        Arguments:
+        source -- ISS data file used as measurement source : str
+        n -- number of measurements to append : int
+        mode -- 'per-call', 'keep-open' or 'swmr' : str
+
+        Returns:
+        file opens per measurement : float
+        mean time to detect and read one measurement [s] : float
+    """
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "live.h5")
+    try:
+        n = min(n, prepare_file(source, path, mode == 'swmr'))
+
+        conn, child_conn = multiprocessing.Pipe()
+        writer = multiprocessing.Process(target=writer_process, args=(path, mode == 'swmr', child_conn))
+        writer.start()
+        conn.recv()
+
+        # first measurement, so that the reader does not start on an empty file
+        conn.send(0)
+        conn.recv()
+
+        reader = DataFileReader(path, keep_open=mode != 'per-call', swmr=mode == 'swmr')
+        opens_before = reader.file_opens
+        elapsed = 0.0
+
+        for k in range(1, n):
+            # acquisition tool side
+            conn.send(k)
+            conn.recv()
+
+            # live loop side
+            t0 = time.perf_counter()
+            if reader.has_file_changed():
+                reader.get_last_mesurement()
+            elapsed += time.perf_counter() - t0
+
+        opens = reader.file_opens - opens_before
+        reader.close()
+        conn.send(None)
+        writer.join()
+        return opens/(n-1), elapsed/(n-1)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='HDF5 opens per measurement in the live loop')
+    parser.add_argument('--source', type=str, default=DEFAULT_SOURCE, help='ISS data file used as measurement source')
+    parser.add_argument('--n', type=int, default=50, help='number of measurements to append')
+    args = parser.parse_args()
+
+    print("{:<12} {:>18} {:>18}".format("mode", "opens/measurement", "time/measurement"))
+    print("-" * 50)
+    for mode in ['per-call', 'keep-open', 'swmr']:
+        opens, t = run(args.source, args.n, mode)
+        print("{:<12} {:>18.2f} {:>15.3f} ms".format(mode, opens, t*1e3))
@@ -0,0 +1,116 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : File size and read / write throughput of the data file layouts written by DataFileReader :
+              contiguous preallocated datasets (as the ISS acquisition tool) against chunked datasets with
+              different chunk sizes and compression filters (gzip, lzf, lz4 with hdf5plugin, byte shuffle).
+              The measurements are synthetic (synthetic_data.py, Groupe5 coins).
+
+Usage : python -m benchmarks.bench_filters [--n N] [--block B] [--appends A] [--repeat R]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import warnings
+from datafilereader import DataFileReader
+from synthetic_data import DEFAULT_COINS, CoinModel, MeasurementGenerator, create_file
+
+# name -> arguments of DataFileReader.create, None for the layout of the acquisition tool
+LAYOUTS = {
+    "contiguous (ISS tool)": None,
+    "chunked 1 row": dict(chunk_rows=1),
+    "chunked 16 rows": dict(chunk_rows=16),
+    "chunked 64 rows": dict(chunk_rows=64),
+    "gzip 1": dict(compression='gzip', compression_opts=1),
+    "gzip 4": dict(compression='gzip', compression_opts=4),
+    "gzip 4 + shuffle": dict(compression='gzip', compression_opts=4, shuffle=True),
+    "lzf": dict(compression='lzf'),
+    "lzf + shuffle": dict(compression='lzf', shuffle=True),
+    "lz4": dict(compression='lz4'),
+    "lz4 + shuffle": dict(compression='lz4', shuffle=True),
+}
+
+
+def best_time(fun, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def write_file(path, layout, blocks):
+    """
+        Write the measurement blocks in a new file
+
+        Arguments:
+        path -- file to create : str
+        layout -- arguments of DataFileReader.create, None for contiguous preallocated datasets : dict
+        blocks -- (impedance, rawdata, metadata) blocks of MeasurementGenerator : list of tuple
+    """
+    frequency = blocks[0][0][0, 0]
+    if layout is None:
+        n = sum(len(metadata) for _, _, metadata in blocks)
+        create_file(path, n, len(frequency), blocks[0][2].dtype).close()
+        writer = DataFileReader(path, 'a')
+    else:
+        writer = DataFileReader(path, 'w')
+        writer.create(frequency, **layout)
+    for impedance, rawdata, metadata in blocks:
+        writer.append_mesurements(frequency, impedance[:, 1] + 1j*impedance[:, 2], rawdata[:, 0], rawdata[:, 1],
+                                  metadata=metadata)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='File size and throughput of the data file layouts')
+    parser.add_argument('--n', type=int, default=10000, help='number of measurements per file')
+    parser.add_argument('--block', type=int, default=1000, help='measurements per append_mesurements call')
+    parser.add_argument('--appends', type=int, default=200, help='single measurement appends timed per layout')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is reported')
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    generator = MeasurementGenerator([CoinModel(path) for path in DEFAULT_COINS], reference_every=50, seed=0)
+    blocks = [generator.next_block(min(args.block, args.n - start)) for start in range(0, args.n, args.block)]
+    singles = [generator.next_block(1) for _ in range(args.appends)]
+
+    tmp = tempfile.mkdtemp()
+    print("{} measurements, appended by {}\n".format(args.n, args.block))
+    print("{:<24} {:>9} {:>9} {:>11} {:>13} {:>12} {:>13}".format(
+        "layout", "size [MB]", "B / mes", "write [ms]", "append 1 [ms]", "read [ms]", "read 1 [ms]"))
+    try:
+        for name, layout in LAYOUTS.items():
+            path = os.path.join(tmp, "filters.h5")
+            try:
+                t_write = best_time(lambda: write_file(path, layout, blocks), args.repeat)
+            except ValueError as error: # lz4 without hdf5plugin
+                print("{:<24} skipped : {}".format(name, error))
+                continue
+            size = os.path.getsize(path)
+            reader = DataFileReader(path)
+            t_read = best_time(lambda: reader.get_all_mesurements(), args.repeat)
+            t_read_one = best_time(lambda: [reader.get_mesurement(k) for k in range(0, args.n, args.n//100)],
+                                   args.repeat)/100
+
+            # live acquisition : one measurement per call, the file reopened each time (preallocated file full)
+            t_append = None
+            if layout is not None:
+                writer = DataFileReader(path, 'a')
+                frequency = singles[0][0][0, 0]
+                t0 = time.perf_counter()
+                for impedance, rawdata, metadata in singles:
+                    writer.append_mesurements(frequency, impedance[:, 1] + 1j*impedance[:, 2], rawdata[:, 0],
+                                              rawdata[:, 1], metadata=metadata)
+                t_append = (time.perf_counter() - t0)/len(singles)
+
+            print("{:<24} {:>9.2f} {:>9.0f} {:>11.1f} {:>13} {:>12.1f} {:>13.3f}".format(
+                name, size/1e6, size/args.n, t_write*1e3, "-" if t_append is None else "{:.2f}".format(t_append*1e3),
+                t_read*1e3, t_read_one*1e3))
+            os.remove(path)
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,70 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Latency of the sklearn models against the NumPy predictors (svm_inference.py),
+              for a single measurement (live tools) and for batches (file tester)
+
+Usage : python -m benchmarks.bench_inference [--bundle FOLDER] [--calls N]
+"""
+
+import argparse
+import time
+import warnings
+import numpy as np
+from dataset_io import load_dataset
+from model_bundle import DEFAULT_BUNDLE, load_bundle
+from svm_inference import load_predictors
+from tester_functions import classify_batch
+
+
+def latency(fun, calls):
+    """
+        Median and 99th percentile duration of a function
+
+        Arguments:
+        fun -- function without arguments : callable
+        calls -- number of calls : int
+
+        Returns:
+        median [s], p99 [s] : float
+    """
+    times = np.empty(calls)
+    for k in range(calls):
+        t0 = time.perf_counter()
+        fun()
+        times[k] = time.perf_counter() - t0
+    return np.median(times), np.percentile(times, 99)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Latency of the sklearn models and of the NumPy predictors')
+    parser.add_argument('--bundle', type=str, default=DEFAULT_BUNDLE, help='model bundle folder')
+    parser.add_argument('--calls', type=int, default=2000, help='number of single row calls')
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    bundle = load_bundle(args.bundle)
+    classifier, gate, _ = load_predictors(args.bundle)
+    engines = {
+        "sklearn": (bundle.classifier, bundle.gate),
+        "numpy": (classifier, gate),
+    }
+    X, _ = load_dataset("dataset/validationset", mmap=False)
+
+    print("single measurement (median / p99) [us]")
+    print("{:<10} {:>18} {:>18} {:>18}".format("", "gate", "classifier", "classify_batch"))
+    x = X[:1]
+    for name, (SVM, SVMO) in engines.items():
+        row = [latency(lambda: SVMO.predict(x), args.calls),
+               latency(lambda: SVM.predict(x), args.calls),
+               latency(lambda: classify_batch(x, SVM, SVMO), args.calls)]
+        print("{:<10} ".format(name) + " ".join("{:>8.1f} / {:>7.1f}".format(m*1e6, p*1e6) for m, p in row))
+
+    print("\nbatches, classify_batch [measurements/s]")
+    print("{:>12} {:>14} {:>14} {:>10}".format("measurements", "sklearn", "numpy", "speed-up"))
+    for n in [10, 100, 1000, 10000, 100000]:
+        Xn = np.resize(X, (n, X.shape[1]))
+        calls = max(3, min(200, 20000//n))
+        t = {name: latency(lambda: classify_batch(Xn, SVM, SVMO), calls)[0] for name, (SVM, SVMO) in engines.items()}
+        print("{:>12} {:>14.0f} {:>14.0f} {:>9.1f}x".format(n, n/t["sklearn"], n/t["numpy"], t["sklearn"]/t["numpy"]))
@@ -0,0 +1,109 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Startup time of the live tools : pickled models loaded on every call (former tester_functions)
+              against the model bundle and its registry. The cold starts are measured in fresh processes.
+
+Usage : python -m benchmarks.bench_model_loading [--bundle FOLDER] [--repeat R]
+"""
+
+import argparse
+import pickle
+import subprocess
+import sys
+import time
+import warnings
+from model_bundle import DEFAULT_BUNDLE, REGISTRY, load_bundle
+
+CLASSIFIER = "models/model1.pkl"
+GATE = "models/modelOneVsAll.pkl"
+
+# code timed in a fresh interpreter, it prints its duration in seconds
+COLD_STARTS = {
+    "pickle.load (before)": """
+import pickle
+with open({classifier!r}, "rb") as f:
+    SVM = pickle.load(f)
+with open({gate!r}, "rb") as f:
+    SVMO = pickle.load(f)
+""",
+    "bundle, arrays only": """
+from model_bundle import load_bundle
+bundle = load_bundle({bundle!r})
+params = [bundle.parameters(name) for name in ("classifier", "gate")]
+""",
+    "bundle, numpy predictors": """
+from svm_inference import load_predictors
+SVM, SVMO, bundle = load_predictors({bundle!r})
+""",
+    "bundle, sklearn models": """
+from model_bundle import load_bundle
+bundle = load_bundle({bundle!r})
+SVM, SVMO = bundle.classifier, bundle.gate
+""",
+}
+
+TIMER = """
+import time, warnings
+warnings.simplefilter("ignore")
+t0 = time.perf_counter()
+{code}
+print(time.perf_counter() - t0)
+"""
+
+
+def cold_start(code, repeat):
+    """
+        Best duration of a code run in fresh python processes
+
+        Arguments:
+        code -- code to run : str
+        repeat -- number of processes : int
+
+        Returns:
+        duration [s] : float
+    """
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", TIMER.format(code=code)], capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.split()[-1]))
+    return min(times)
+
+
+def load_pickles():
+    with open(CLASSIFIER, "rb") as f:
+        SVM = pickle.load(f)
+    with open(GATE, "rb") as f:
+        SVMO = pickle.load(f)
+    return SVM, SVMO
+
+
+def mean_time(fun, number):
+    t0 = time.perf_counter()
+    for _ in range(number):
+        fun()
+    return (time.perf_counter() - t0)/number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Startup time of the models')
+    parser.add_argument('--bundle', type=str, default=DEFAULT_BUNDLE, help='model bundle folder')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh processes, the best one is reported')
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    print("cold start (fresh process, imports included)")
+    for name, code in COLD_STARTS.items():
+        t = cold_start(code.format(classifier=CLASSIFIER, gate=GATE, bundle=args.bundle), args.repeat)
+        print("  {:<26} {:8.1f} ms".format(name, t*1e3))
+
+    # warm : models needed again by a later call in the same process (process_files, liveTest)
+    load_pickles()
+    REGISTRY.clear()
+    bundle = load_bundle(args.bundle)
+    bundle.classifier, bundle.gate
+    print("\nper call in a warm process")
+    print("  {:<26} {:8.3f} ms".format("pickle.load (before)", mean_time(load_pickles, 100)*1e3))
+    print("  {:<26} {:8.3f} ms".format("registry", mean_time(
+        lambda: (load_bundle(args.bundle).classifier, load_bundle(args.bundle).gate), 1000)*1e3))
@@ -0,0 +1,100 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Throughput of the file tester (tester_functions.process_files) on the data/Live_files sets,
+              and of the batched classification against the former one-row-at-a-time loop
+
+Usage : python -m benchmarks.bench_process_files [--folder FOLDER] [--repeat R]
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import os
+import pickle
+import time
+import numpy as np
+import tester_functions
+from datafilereader import DataFileReader
+from features import FeatureExtractor
+
+DEFAULT_FOLDER = "./data/Live_files/"
+
+
+def load_features(folder_path):
+    """
+        Extract the calibrated features of all the test sets of a folder
+
+        Arguments:
+        folder_path -- folder containing test_set_*.h5 files : str
+
+        Returns:
+        features of all the measurements : 2D numpy array
+    """
+    features = []
+    for file_path in sorted(glob.glob(os.path.join(folder_path, "test_set_*.h5"))):
+        dataset = DataFileReader(file_path)
+        f, Z = dataset.get_all_mesurements()
+        C_idx = dataset.get_reference_impedance_index()
+        if C_idx is None:
+            continue
+        extractor = FeatureExtractor(f)
+        extractor.set_reference(Z[C_idx,:])
+        features.append(extractor.transform(np.delete(Z, C_idx, axis=0)))
+    return np.concatenate(features, axis=0)
+
+
+def classify_per_row(X, SVM, SVMO):
+    """
+        Former process_files loop : one gate call and one classifier call per measurement
+    """
+    verdicts = []
+    for j in range(X.shape[0]):
+        x = X[j].reshape(1, -1)
+        if not np.isfinite(x).all():
+            verdicts.append("Skipped due to NaN")
+        elif SVMO.predict(x) == -1:
+            verdicts.append("Unknown")
+        else:
+            verdicts.append(SVM.predict(x)[0])
+    return verdicts
+
+
+def best_time(fun, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Throughput of the batch file tester')
+    parser.add_argument('--folder', type=str, default=DEFAULT_FOLDER, help='folder containing test_set_*.h5 files')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs, the best one is reported')
+    args = parser.parse_args()
+
+    with open("models/model1.pkl", "rb") as f:
+        SVM = pickle.load(f)
+    with open("models/modelOneVsAll.pkl", "rb") as f:
+        SVMO = pickle.load(f)
+
+    # end to end (files read + features + models)
+    X = load_features(args.folder)
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = best_time(lambda: tester_functions.process_files(args.folder), args.repeat)
+    print(f"process_files on {args.folder} : {X.shape[0]} measurements in {t*1e3:.1f} ms"
+          f" ({X.shape[0]/t:.0f} measurements/s)")
+
+    # classification stage only, the measurements are tiled to emulate larger folders
+    print()
+    print("{:>12} {:>18} {:>18} {:>10}".format("measurements", "per-row [mes/s]", "batched [mes/s]", "speed-up"))
+    print("-" * 62)
+    for n in [X.shape[0], 1000, 10000]:
+        Xn = np.resize(X, (n, X.shape[1]))
+        t_row = best_time(lambda: classify_per_row(Xn, SVM, SVMO), 1 if n > 1000 else args.repeat)
+        t_batch = best_time(lambda: tester_functions.classify_batch(Xn, SVM, SVMO), args.repeat)
+        print("{:>12} {:>18.0f} {:>18.0f} {:>9.1f}x".format(n, n/t_row, n/t_batch, t_row/t_batch))
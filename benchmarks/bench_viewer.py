@@ -0,0 +1,78 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Cost of a live viewer update while the data file grows : DataFileViewer (new lines for every
+              measurement, whole figure drawn) against LiveDataFileViewer (ring of lines updated in place and
+              blitted, density of the older measurements in a background drawn again now and then).
+              Measurements are appended one at a time to a new file, the figure is rendered off screen (Agg) and
+              the event loop waits are not counted.
+
+Usage : python -m benchmarks.bench_viewer [--source FILE] [--n N] [--ring R]
+"""
+
+import matplotlib
+matplotlib.use("Agg")
+
+import argparse
+import os
+import tempfile
+import time
+import matplotlib.pyplot as plt
+import numpy as np
+from datafilereader import DataFileReader
+from dev.datafileviewer_template import DataFileViewer, LiveDataFileViewer
+
+DEFAULT_SOURCE = "./data/Groupe11/1_CHF.h5"
+CHECKPOINTS = (20, 100, 250, 500, 1000, 2000)
+WINDOW = 20 # updates averaged at each checkpoint, one background draw of LiveDataFileViewer with the default ring
+
+
+def run(viewer_class, source, n, **kwargs):
+    """
+        Append n measurements one at a time and update the viewer after each of them
+
+        Returns:
+        duration of each update (read, artists and rendering) [s] : 1D numpy array
+    """
+    reader = DataFileReader(source)
+    reader.LIMIT_FREQ = False
+    frequency, Z = reader.get_all_mesurements()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "live.h5")
+        writer = DataFileReader(path, mode='a')
+        writer.append_mesurements(frequency, Z[0], is_reference=True)
+        writer.append_mesurements(frequency, Z[1])
+
+        viewer = viewer_class(path, **kwargs)
+        times = np.empty(n)
+        for i in range(n):
+            writer.append_mesurements(frequency, Z[1 + i % (len(Z) - 1)])
+            t0 = time.perf_counter()
+            viewer.update_plot(i)
+            if viewer_class is DataFileViewer:
+                viewer.fig.canvas.draw() # done by plt.pause in the viewer
+            times[i] = time.perf_counter() - t0
+        plt.close(viewer.fig)
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cost of a live viewer update')
+    parser.add_argument('--source', type=str, default=DEFAULT_SOURCE, help='coin file giving the measurements')
+    parser.add_argument('--n', type=int, default=500, help='number of measurements appended')
+    parser.add_argument('--ring', type=int, default=20, help='ring size of LiveDataFileViewer')
+    args = parser.parse_args()
+
+    # the event loop waits of the viewers (plt.pause) are not part of the update cost
+    plt.pause = lambda interval: None
+
+    results = {"DataFileViewer": run(DataFileViewer, args.source, args.n),
+               "LiveDataFileViewer": run(LiveDataFileViewer, args.source, args.n, ring_size=args.ring)}
+    checkpoints = [k for k in CHECKPOINTS if k <= args.n]
+    print("update time [ms] (mean of the {} updates before N measurements)".format(WINDOW))
+    print("{:<20}".format("N") + "".join("{:>9}".format(k) for k in checkpoints))
+    for name, times in results.items():
+        print("{:<20}".format(name) + "".join("{:>9.1f}".format(np.mean(times[max(k-WINDOW, 0):k])*1e3)
+                                              for k in checkpoints))
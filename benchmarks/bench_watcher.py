@@ -0,0 +1,92 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Lost measurements and CPU load of the live loop change detection : former mtime busy-wait
+              against the MeasurementWatcher (inotify and polling backends). The emulated acquisition
+              tool writes pairs of measurements back to back, separated by idle periods.
+
+Usage : python -m benchmarks.bench_watcher [--source FILE] [--pairs N] [--idle SECONDS]
+"""
+
+import os
+os.environ.setdefault("HDF5_USE_FILE_LOCKING", "FALSE")
+
+import argparse
+import multiprocessing
+import shutil
+import tempfile
+import time
+import h5py
+from datafilereader import DataFileReader
+from watcher import MeasurementWatcher
+
+DEFAULT_SOURCE = "./data/Groupe11/1_CHF.h5"
+
+
+def writer_process(path, pairs, idle):
+    """
+        Acquisition tool emulation : flags the measurements as existing two by two (the first one exists already)
+    """
+    time.sleep(idle)
+    k = 1
+    for _ in range(pairs):
+        for _ in range(2):
+            with h5py.File(path, 'a') as fw:
+                fw['existing'][k] = 1
+            k += 1
+        time.sleep(idle)
+
+
+def run(source, pairs, idle, mode):
+    """
+        Run the emulated acquisition and count the measurements seen by the live loop
+
+        Returns:
+        number of measurements seen : int
+        CPU load of the live loop during the run [%] : float
+    """
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "live.h5")
+    try:
+        shutil.copyfile(source, path)
+        with h5py.File(path, 'a') as fd:
+            fd['existing'][:] = 0
+            fd['existing'][0] = 1
+
+        reader = DataFileReader(path)
+        writer = multiprocessing.Process(target=writer_process, args=(path, pairs, idle))
+        seen = 0
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        writer.start()
+
+        if mode == 'busy-wait':
+            while writer.is_alive():
+                if reader.has_file_changed():
+                    reader.get_last_mesurement()
+                    seen += 1
+        else:
+            with MeasurementWatcher(reader, backend=mode) as watcher:
+                for n in watcher.watch(idle_timeout=2*idle + 0.5):
+                    reader.get_mesurement(n)
+                    seen += 1
+
+        writer.join()
+        load = 100*(time.process_time() - cpu0)/(time.perf_counter() - wall0)
+        return seen, load
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lost measurements and CPU load of the live change detection')
+    parser.add_argument('--source', type=str, default=DEFAULT_SOURCE, help='ISS data file used as measurement source')
+    parser.add_argument('--pairs', type=int, default=10, help='number of back to back measurement pairs')
+    parser.add_argument('--idle', type=float, default=0.5, help='idle time between the pairs [s]')
+    args = parser.parse_args()
+
+    print("{:<10} {:>10} {:>10} {:>10}".format("mode", "written", "seen", "CPU [%]"))
+    print("-" * 44)
+    for mode in ['busy-wait', 'inotify', 'polling']:
+        seen, load = run(args.source, args.pairs, args.idle, mode)
+        print("{:<10} {:>10} {:>10} {:>10.1f}".format(mode, 2*args.pairs, seen, load))
@@ -0,0 +1,306 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Benchmark suite over the bundled data : data file reads, feature extraction (and impedance
+              recomputed from the raw data), dataset creation, training of the models, inference, and reads /
+              inference on synthetic files of 10k to 100k measurements (synthetic_data.py, Groupe5 coins, one
+              calibration every 50 measurements).
+              The results are written as JSON (with the commit and the versions) so two runs can be compared.
+
+Usage : python -m benchmarks.run [--suites SUITE ...] [--sizes N ...] [--repeat R] [--out FILE.json]
+                                 [--compare BASE.json]
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import warnings
+import h5py
+import numpy as np
+
+DATA_FOLDER = "./data"
+LIVE_FOLDER = "./data/Live_files/"
+SUITES = ["reader", "features", "datasets", "training", "inference", "synthetic"]
+DEFAULT_SIZES = [10000, 100000]
+
+
+def measure(fun, repeat):
+    """
+        Run a function several times
+
+        Arguments:
+        fun -- function without arguments : callable
+        repeat -- number of runs : int
+
+        Returns:
+        duration of each run [s] : list of float
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def result(suite, case, times, n=None, unit="measurements", **info):
+    """
+        Result of a benchmark case
+
+        Arguments:
+        suite -- name of the suite : str
+        case -- name of the case : str
+        times -- duration of each run [s] : list of float
+        n -- number of items processed by a run : int
+        unit -- name of the items : str
+        info -- other values stored with the result : json values
+
+        Returns:
+        result : dict
+    """
+    best = min(times)
+    res = {'suite': suite, 'case': case, 'best_s': best, 'median_s': float(np.median(times)), 'runs': len(times)}
+    if n is not None:
+        res.update({'n': n, 'unit': unit, 'throughput': n/best if best > 0 else None})
+    res.update(info)
+    print("  {:<44} {:>10.2f} ms {}".format(case, best*1e3,
+                                           "" if n is None else "({:.0f} {}/s)".format(n/best, unit)))
+    return res
+
+
+def environment():
+    """
+        Returns:
+        commit, versions and machine of the run : dict
+    """
+    import sklearn
+
+    def git(*args):
+        try:
+            return subprocess.run(["git"] + list(args), capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': git("rev-parse", "HEAD"),
+        'dirty': bool(git("status", "--porcelain", "--untracked-files=no")),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'h5py': h5py.__version__,
+        'hdf5': h5py.version.hdf5_version,
+        'sklearn': sklearn.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def data_files():
+    return sorted(glob.glob(os.path.join(DATA_FOLDER, "**", "*.h5"), recursive=True))
+
+
+# --- suites
+def bench_reader(repeat):
+    from datafilereader import DataFileReader
+
+    files = data_files()
+    n = sum(DataFileReader(path).get_number_of_mesurements() for path in files)
+    size = sum(os.path.getsize(path) for path in files)
+    results = [
+        result("reader", "open + count, all data files", measure(
+            lambda: [DataFileReader(path).get_number_of_mesurements() for path in files], repeat),
+            len(files), "files"),
+        result("reader", "get_all_mesurements, all data files", measure(
+            lambda: [DataFileReader(path).get_all_mesurements() for path in files], repeat),
+            n, bytes=size),
+        result("reader", "get_reference_impedance_index, all files", measure(
+            lambda: [DataFileReader(path).get_reference_impedance_index() for path in files], repeat), len(files), "files"),
+        result("reader", "get_all_metadata, all data files", measure(
+            lambda: [DataFileReader(path).get_all_metadata() for path in files], repeat), n),
+    ]
+    return results
+
+
+def bench_features(repeat):
+    from datafilereader import DataFileReader
+    from features import FeatureExtractor
+    from impedance_engine import ImpedanceEngine, rawdata_by_settings
+
+    blocks = [DataFileReader(path).get_all_mesurements() for path in data_files()]
+    frequency = blocks[0][0]
+    Z = np.concatenate([Z for f, Z in blocks if len(f) == len(frequency)], axis=0)
+    extractor = FeatureExtractor(frequency)
+    extractor.set_reference(Z[0])
+    # one engine per acquisition settings (trace length, sampling frequency, shunt) of the files
+    raw = rawdata_by_settings(data_files())
+    n_raw = sum(len(vd) for vd, vs in raw.values())
+    out = np.empty((len(Z), extractor.n_features))
+    x = np.empty(extractor.n_features)
+    return [
+        result("features", "transform, all data files (batch)", measure(lambda: extractor.transform(Z, out=out), repeat),
+               len(Z)),
+        result("features", "transform, one measurement", measure(
+            lambda: [extractor.transform(Z[k], out=x) for k in range(len(Z))], repeat), len(Z)),
+        result("features", "impedance from rawdata, FFT", measure(
+            lambda: [ImpedanceEngine(*settings).impedance(vd, vs) for settings, (vd, vs) in raw.items()], repeat),
+            n_raw),
+        result("features", "impedance from rawdata, DFT 72 bins", measure(
+            lambda: [ImpedanceEngine(*settings, frequency).impedance(vd, vs) for settings, (vd, vs) in raw.items()],
+            repeat), n_raw),
+    ]
+
+
+def bench_datasets(repeat):
+    import createSets
+
+    out = tempfile.mkdtemp()
+    cache = tempfile.mkdtemp()
+    build = lambda workers, cache_dir: createSets.build_sets(workers=workers, out_folder=out, cache_dir=cache_dir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            t_single = measure(lambda: build(1, None), repeat)
+            t_pool = measure(lambda: build(None, None), repeat)
+            build(1, cache) # fill the cache
+            t_cache = measure(lambda: build(1, cache), repeat)
+        results = [
+            result("datasets", "build_sets, 1 process", t_single),
+            result("datasets", "build_sets, process pool", t_pool),
+            result("datasets", "build_sets, feature cache", t_cache),
+        ]
+    finally:
+        shutil.rmtree(out)
+        shutil.rmtree(cache)
+    return results
+
+
+def bench_training(repeat):
+    from sklearn import svm
+    from sklearn.ensemble import IsolationForest
+    from dataset_io import load_dataset
+
+    X, Y = load_dataset("dataset/trainingset", mmap=False)
+    return [
+        result("training", "SVC(kernel='linear', C=1)", measure(lambda: svm.SVC(kernel='linear', C=1).fit(X, Y), repeat),
+               len(X), "samples"),
+        result("training", "OneClassSVM(kernel='rbf', nu=0.001)", measure(
+            lambda: svm.OneClassSVM(kernel='rbf', gamma='scale', nu=0.001).fit(X), repeat), len(X), "samples"),
+        result("training", "IsolationForest(contamination=0.1)", measure(
+            lambda: IsolationForest(contamination=0.1, random_state=42).fit(X), repeat), len(X), "samples"),
+    ]
+
+
+def bench_inference(repeat):
+    import tester_functions
+    from model_bundle import load_bundle
+    from svm_inference import load_predictors
+    from benchmarks.bench_process_files import load_features
+
+    X = load_features(LIVE_FOLDER)
+    bundle = load_bundle()
+    SVM, SVMO, _ = load_predictors()
+    with contextlib.redirect_stdout(io.StringIO()):
+        t_files = measure(lambda: tester_functions.process_files(LIVE_FOLDER), repeat)
+    return [
+        result("inference", "process_files, Live_files", t_files, len(X)),
+        result("inference", "classify_batch, Live_files, numpy", measure(
+            lambda: tester_functions.classify_batch(X, SVM, SVMO), repeat), len(X)),
+        result("inference", "classify_batch, Live_files, sklearn", measure(
+            lambda: tester_functions.classify_batch(X, bundle.classifier, bundle.gate), repeat), len(X)),
+    ]
+
+
+def bench_synthetic(repeat, sizes):
+    import tester_functions
+    from datafilereader import DataFileReader
+    from features import FeatureExtractor
+    from svm_inference import load_predictors
+    from synthetic_data import DEFAULT_COINS, CoinModel, generate_file
+
+    SVM, SVMO, _ = load_predictors()
+    models = [CoinModel(path) for path in DEFAULT_COINS]
+    results = []
+    tmp = tempfile.mkdtemp()
+    try:
+        for n in sizes:
+            path = os.path.join(tmp, "synthetic_{}.h5".format(n))
+            generate_file(path, n, models, reference_every=50, seed=0)
+            size = os.path.getsize(path)
+
+            def end_to_end():
+                reader = DataFileReader(path)
+                f, Z, is_reference, _ = reader.read_since(0)
+                extractor = FeatureExtractor(f)
+                extractor.set_reference(Z[is_reference])
+                tester_functions.classify_batch(extractor.transform(Z[~is_reference]), SVM, SVMO)
+
+            runs = max(1, min(repeat, 100000//n))
+            results += [
+                result("synthetic", "get_all_mesurements, {} measurements".format(n), measure(
+                    lambda: DataFileReader(path).get_all_mesurements(), runs), n, bytes=size),
+                result("synthetic", "read_since(0), {} measurements".format(n), measure(
+                    lambda: DataFileReader(path).read_since(0), runs), n, bytes=size),
+                result("synthetic", "get_reference_impedance_index, {} measurements".format(n), measure(
+                    lambda: DataFileReader(path).get_reference_impedance_index(), runs), n),
+                result("synthetic", "read + features + classify, {} measurements".format(n), measure(
+                    end_to_end, runs), n),
+            ]
+            os.remove(path)
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+def compare(results, base_path):
+    """
+        Print the speed-up of each case against a former run
+
+        Arguments:
+        results -- results of this run : list of dict
+        base_path -- JSON file of the former run : str
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    base_times = {(res['suite'], res['case']): res['best_s'] for res in base['results']}
+    print("\ncompared to {} ({}) :".format(base_path, (base['environment']['commit'] or "?")[:10]))
+    for res in results:
+        key = (res['suite'], res['case'])
+        if key in base_times:
+            print("  {:<56} {:>7.2f}x".format(res['suite'] + " / " + res['case'], base_times[key]/res['best_s']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark suite')
+    parser.add_argument('--suites', nargs='+', type=str, default=SUITES, choices=SUITES, help='suites to run')
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='sizes of the synthetic files')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of each case')
+    parser.add_argument('--out', type=str, default=None, help='JSON result file (default: benchmark_<commit>.json)')
+    parser.add_argument('--compare', type=str, default=None, help='JSON result file of a former run')
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    env = environment()
+    results = []
+    for suite in args.suites:
+        print(suite)
+        if suite == "synthetic":
+            results += bench_synthetic(args.repeat, args.sizes)
+        else:
+            results += globals()["bench_" + suite](args.repeat)
+
+    out = args.out or "benchmark_{}.json".format((env['commit'] or "unknown")[:10])
+    with open(out, 'w') as f:
+        json.dump({'environment': env, 'arguments': vars(args), 'results': results}, f, indent=1)
+        f.write("\n")
+    print("\nresults written in", out)
+
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,412 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Rolling calibration of a sensor. The coil drifts with the temperature during a long session, so the
+              calibration is not a single reference measurement but the median of the last empty coil captures :
+              the reference presses, and the measurements without a coin (as the 0_line files) recognised by their
+              small deviation from the current calibration. Each measurement is calibrated with the calibration
+              before it, in O(F) and without reading the history again.
+
+              An empty coil capture must also be close to an absolute empty coil signature : a stored empty coil
+              capture (0_line file) or, without it, the calibration of a press flagged as reference. A first
+              calibration far from the stored signature (coin on the coil) is rejected, and without any signature
+              the empty coil captures are not tracked, so that a calibration made on a coin does not turn the
+              next presses of this coin into captures.
+
+              Reference presses far from the calibration are not averaged in : a press with a coin on the coil is
+              rejected, a smaller step (coil moved or warmed up between two presses) is applied once a second
+              press confirms it. The drift of the calibration (shift since the first capture, rate, expected drift
+              since the last capture) is tracked, and a recalibration is requested when the last capture is too old
+              or too far from the expected calibration.
+
+Usage : python calibration.py FILE.h5 [FILE.h5 ...] [--window N] [--no-empty] [--empty-coil FILE] [--all]
+"""
+
+import argparse
+import numpy as np
+from features import FeatureExtractor, DEFAULT_SPEC, feature_bins, spec_on_bins
+
+# kind of each observed measurement
+MEASUREMENT = "measurement" # coin (or anything else) to classify
+REFERENCE = "reference"     # reference press added to the calibration
+EMPTY = "empty"             # empty coil capture added to the calibration
+STEP = "step"               # reference press away from the calibration, applied when the next one confirms it
+REJECTED = "rejected"       # reference press with a coin on the coil
+CALIBRATION_KINDS = (REFERENCE, EMPTY, STEP, REJECTED)
+
+DEFAULT_WINDOW = 5        # captures in the rolling calibration
+EMPTY_THRESHOLD = 0.03    # relative deviation of an empty coil capture (noise < 0.001, coins > 0.13 on the data)
+MAX_STEP = 0.1            # relative deviation above which a reference press has a coin on the coil
+MAX_DRIFT = 0.005         # expected relative drift since the last capture above which a recalibration is requested
+MAX_AGE = 200             # measurements since the last capture above which a recalibration is requested
+DEFAULT_EMPTY_COIL = "./data/Groupe8/0_line.h5" # empty coil captures (all the coils are within 0.03 of it)
+
+
+def load_empty_coil(frequency, file_path=DEFAULT_EMPTY_COIL):
+    """
+    Empty coil signature : median of the captures of an empty coil file, on the given frequencies
+
+    Arguments:
+    frequency -- frequency vector of the measurements : 1D numpy array
+    file_path -- data file of empty coil captures : str
+
+    Returns:
+    empty coil impedance (F,), None if the file is missing or has other frequencies : 1D numpy array of complex
+    """
+    import os
+    from datafilereader import DataFileReader
+
+    if not os.path.isfile(file_path):
+        return None
+    file_frequency, Z, _, _ = DataFileReader(file_path).read_band(fmin=-np.inf, fmax=np.inf)
+    columns = np.minimum(np.searchsorted(file_frequency, frequency), len(file_frequency) - 1)
+    if len(Z) == 0 or not np.allclose(file_frequency[columns], frequency):
+        return None
+    Z = Z[:, columns]
+    return np.median(Z.real, axis=0) + 1j*np.median(Z.imag, axis=0)
+
+
+def relative_deviation(Z, Z_ref):
+    """
+    Deviation of measurements from a calibration : median over the frequencies of |Z - Z_ref| / |Z_ref|
+
+    Arguments:
+    Z -- impedance (F,) or (N, F) : numpy array of complex
+    Z_ref -- calibration impedance (F,) : 1D numpy array of complex
+
+    Returns:
+    deviation : float or 1D numpy array
+    """
+    return np.median(np.abs(Z - Z_ref)/np.abs(Z_ref), axis=-1)
+
+
+def drift_deviation(Z, Z_ref):
+    """
+    Drift of a calibration : the largest of the median relative deviations of the resistance and of the reactance
+
+    Arguments:
+    Z -- calibration impedance (F,) : 1D numpy array of complex
+    Z_ref -- former calibration impedance (F,) : 1D numpy array of complex
+
+    Returns:
+    deviation : float
+    """
+    return max(np.median(np.abs(part(Z) - part(Z_ref))/np.abs(part(Z_ref))) for part in (np.real, np.imag))
+
+
+class CalibrationTracker:
+    """
+    Class to keep the calibration of a sensor up to date from its empty coil captures.
+
+    The last captures are kept in a ring of window spectra, the calibration is their median (real and imaginary
+    parts), set in the FeatureExtractor of the tracker. Measurement counts are the time base of the drift.
+
+    """
+
+    def __init__(self, frequency, spec=DEFAULT_SPEC, window=DEFAULT_WINDOW, track_empty=True, empty_coil=None,
+                 empty_threshold=EMPTY_THRESHOLD, max_step=MAX_STEP, max_drift=MAX_DRIFT, max_age=MAX_AGE):
+        """
+        Constructor
+
+        Arguments:
+        frequency -- frequency vector of the measurements : 1D numpy array
+        spec -- feature specification : dict
+        window -- number of captures in the calibration : int
+        track_empty -- add the empty coil captures to the calibration, else the reference presses only : bool
+        empty_coil -- empty coil signature (load_empty_coil), None to trust the presses flagged as reference only
+                      : 1D numpy array of complex
+        empty_threshold -- relative deviation below which a measurement is an empty coil capture : float
+        max_step -- relative deviation above which a reference press is rejected : float
+        max_drift -- expected relative drift since the last capture that requests a recalibration : float
+        max_age -- number of measurements since the last capture that requests a recalibration : int
+        """
+        self.extractor = FeatureExtractor(frequency, **spec)
+        self.window = window
+        self.track_empty = track_empty
+        self.empty_threshold = empty_threshold
+        self.max_step = max_step
+        self.max_drift = max_drift
+        self.max_age = max_age
+        self.empty_coil = empty_coil
+
+        self.calibration = None # median of the captures : 1D numpy array of complex
+        self.anchor = None      # first calibration (after a step) : 1D numpy array of complex
+        self.rate = np.zeros(len(frequency)) # relative drift of the resistance or reactance per measurement
+        self.count = 0          # number of observed measurements
+        self.last_capture = None # count of observed measurements right after the last capture
+        self.counts = {kind: 0 for kind in CALIBRATION_KINDS}
+
+        self.__ring = np.empty((window, len(frequency)), dtype=complex)
+        self.__ring_index = np.empty(window) # measurement index of each capture
+        self.__n = 0 # captures in the ring
+        self.__next = 0 # next slot of the ring
+        self.__step = None # unconfirmed step
+        self.__signature = empty_coil # absolute empty coil signature of the empty captures
+
+    @property
+    def calibrated(self):
+        return self.calibration is not None
+
+    @property
+    def needs_recalibration(self):
+        return self.recalibration_reason() is not None
+
+    def recalibration_reason(self):
+        """
+        Reason to ask for a reference press
+
+        Returns:
+        'uncalibrated', 'step', 'age' or 'drift', None if the calibration is up to date : str
+        """
+        if not self.calibrated:
+            return 'uncalibrated'
+        if self.__step is not None:
+            return 'step'
+        age = self.count - self.last_capture
+        if age > self.max_age:
+            return 'age'
+        if self.expected_drift() > self.max_drift:
+            return 'drift'
+        return None
+
+    def expected_drift(self):
+        """
+        Returns:
+        relative drift of the coil expected since the last capture, from the drift rate : float
+        """
+        if not self.calibrated:
+            return np.inf
+        return float(np.median(np.abs(self.rate))*(self.count - self.last_capture))
+
+    def drift(self):
+        """
+        Drift statistics of the calibration
+
+        Returns:
+        'shift' (drift_deviation of the calibration from the anchor), 'rate' (relative drift per measurement),
+        'age' (measurements since the last capture), 'expected' (expected drift since the last capture),
+        'captures' (number of each capture kind) and 'recalibrate' (reason or None) : dict
+        """
+        calibrated = self.calibrated
+        return {'shift': float(drift_deviation(self.calibration, self.anchor)) if calibrated else None,
+                'rate': float(np.median(np.abs(self.rate))),
+                'age': self.count - self.last_capture if calibrated else None,
+                'expected': self.expected_drift() if calibrated else None,
+                'captures': dict(self.counts),
+                'recalibrate': self.recalibration_reason()}
+
+    def add_reference(self, Z_ref, flagged=True):
+        """
+        Add a reference press to the calibration (the first one is accepted unless it is far from the empty coil
+        signature)
+
+        Arguments:
+        Z_ref -- reference impedance (F,) : 1D numpy array of complex
+        flagged -- the measurement is flagged as reference (else first measurement used as calibration) : bool
+
+        Returns:
+        REFERENCE, STEP or REJECTED : str
+        """
+        kind = self.__reference_kind(Z_ref)
+        if kind == REFERENCE:
+            self.__add(Z_ref)
+            self.__step = None
+        elif kind == STEP:
+            if self.__step is not None and relative_deviation(Z_ref, self.__step) <= self.empty_threshold:
+                # two presses agree : the coil has moved, the calibration starts again from them
+                self.__reset()
+                self.__add(self.__step)
+                self.__add(Z_ref)
+                self.__step = None
+                kind = REFERENCE
+            else:
+                self.__step = np.array(Z_ref)
+        if kind == REFERENCE and flagged and self.__signature is None:
+            # the coil was empty at this press : its calibration is the signature of the empty captures
+            self.__signature = self.calibration.copy()
+        self.counts[kind] += 1
+        self.count += 1
+        if kind == REFERENCE:
+            self.last_capture = self.count
+        return kind
+
+    def observe(self, Z, is_reference=False):
+        """
+        Sort a new measurement : reference press, empty coil capture or measurement to classify. The calibration
+        is updated by the captures, a measurement does not change it. Before any calibration, the measurement is
+        a reference.
+
+        Arguments:
+        Z -- impedance (F,) : 1D numpy array of complex
+        is_reference -- the measurement is flagged as reference : bool
+
+        Returns:
+        kind of the measurement : str
+        """
+        if is_reference or not self.calibrated:
+            return self.add_reference(Z, is_reference)
+        if self.__is_empty(Z):
+            self.__add(Z)
+            self.counts[EMPTY] += 1
+            self.count += 1
+            self.last_capture = self.count
+            return EMPTY
+        self.count += 1
+        return MEASUREMENT
+
+    def process(self, Z, is_reference):
+        """
+        Observe a block of measurements and compute the features of the measurements to classify, each one
+        calibrated with the calibration before it
+
+        Arguments:
+        Z -- impedance (N, F) : 2D numpy array of complex
+        is_reference -- reference flag of the measurements : 1D numpy array of bool
+
+        Returns:
+        kind of each measurement : 1D numpy array of object
+        features, NaN on the calibration rows : 2D numpy array
+        """
+        N = len(Z)
+        kinds = np.full(N, MEASUREMENT, dtype=object)
+        X = np.full((N, self.extractor.n_features), np.nan)
+
+        # the deviations of the rest of the block are computed again after each change of the calibration only
+        start = 0
+        while start < N:
+            if not self.calibrated:
+                kinds[start] = self.add_reference(Z[start], bool(is_reference[start]))
+                start += 1
+                continue
+            captures = np.asarray(is_reference[start:], dtype=bool) | self.__is_empty(Z[start:])
+            stop = start + (int(np.argmax(captures)) if captures.any() else N - start)
+            if stop > start:
+                self.extractor.transform(Z[start:stop], out=X[start:stop])
+                self.count += stop - start
+            if stop < N:
+                kinds[stop] = self.observe(Z[stop], is_reference[stop])
+            start = stop + 1
+        return kinds, X
+
+    # --- private methods
+    def __is_empty(self, Z):
+        """
+        Empty coil captures : close to the calibration and to the absolute empty coil signature
+
+        Arguments:
+        Z -- impedance (F,) or (N, F) : numpy array of complex
+
+        Returns:
+        True for the empty coil captures : bool or 1D numpy array of bool
+        """
+        if not self.track_empty or self.__signature is None:
+            return np.zeros(Z.shape[:-1], dtype=bool)
+        return ((relative_deviation(Z, self.calibration) <= self.empty_threshold)
+                & (relative_deviation(Z, self.__signature) <= self.max_step))
+
+    def __reference_kind(self, Z_ref):
+        if not self.calibrated:
+            if self.empty_coil is not None and relative_deviation(Z_ref, self.empty_coil) > self.max_step:
+                return REJECTED # coin on the coil at the first calibration
+            return REFERENCE
+        deviation = relative_deviation(Z_ref, self.calibration)
+        if deviation <= self.empty_threshold:
+            return REFERENCE
+        return STEP if deviation <= self.max_step else REJECTED
+
+    def __reset(self):
+        self.__n = 0
+        self.__next = 0
+        self.calibration = None
+        self.anchor = None
+        self.rate[:] = 0
+
+    def __add(self, Z):
+        """
+        Add a capture to the ring and update the calibration, O(window*F)
+
+        Arguments:
+        Z -- empty coil impedance (F,) : 1D numpy array of complex
+        """
+        self.__ring[self.__next] = Z
+        self.__ring_index[self.__next] = self.count
+        self.__next = (self.__next + 1) % self.window
+        self.__n = min(self.__n + 1, self.window)
+
+        ring = self.__ring[:self.__n]
+        t = self.__ring_index[:self.__n]
+
+        # drift : least squares slope of the captures over the measurement index, shrunk by two standard errors
+        # so that the noise of close captures is not taken for a drift. The resistance and the reactance are
+        # taken apart, the reactance is larger and would hide a drift of the resistance.
+        dt = t - t.mean()
+        slope = np.zeros(ring.shape[1], dtype=complex)
+        if self.__n >= 3 and np.any(dt != 0):
+            centered = ring - ring.mean(axis=0)
+            fitted = dt @ centered/(dt @ dt)
+            residual = centered - np.outer(dt, fitted)
+            for part, unit in ((np.real, 1), (np.imag, 1j)):
+                error = np.sqrt(np.sum(part(residual)**2, axis=0)/(self.__n - 2)/(dt @ dt))
+                slope += unit*np.sign(part(fitted))*np.maximum(np.abs(part(fitted)) - 2*error, 0)
+
+        # calibration : median of the captures brought along the drift to the time of the last capture
+        ring = ring + np.outer(self.count - t, slope)
+        self.calibration = np.median(ring.real, axis=0) + 1j*np.median(ring.imag, axis=0)
+        if self.anchor is None:
+            self.anchor = self.calibration.copy()
+        self.rate = np.maximum(np.abs(slope.real)/np.abs(self.calibration.real),
+                               np.abs(slope.imag)/np.abs(self.calibration.imag))
+        self.extractor.set_reference(self.calibration)
+
+
+def replay_file(file_path, spec=DEFAULT_SPEC, empty_coil_path=DEFAULT_EMPTY_COIL, **tracker_args):
+    """
+    Replay the measurements of a file through a calibration tracker
+
+    Arguments:
+    file_path -- data file : str
+    spec -- feature specification : dict
+    empty_coil_path -- data file of empty coil captures (load_empty_coil), None for no signature : str
+    tracker_args -- arguments of CalibrationTracker : dict
+
+    Returns:
+    kind of each measurement : 1D numpy array of object
+    features, NaN on the calibration rows : 2D numpy array
+    tracker : CalibrationTracker
+    """
+    from datafilereader import DataFileReader
+
+    bins = feature_bins(spec)
+    frequency, Z, is_reference, _ = DataFileReader(file_path).read_band(bins)
+    empty_coil = load_empty_coil(frequency, empty_coil_path) if empty_coil_path else None
+    tracker = CalibrationTracker(frequency, spec_on_bins(spec, bins), empty_coil=empty_coil, **tracker_args)
+    kinds, X = tracker.process(Z, is_reference)
+    return kinds, X, tracker
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay data files through the rolling calibration')
+    parser.add_argument('file_paths', nargs='+', type=str, help='data files')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='captures in the calibration')
+    parser.add_argument('--no-empty', action='store_true', help='use the reference presses only')
+    parser.add_argument('--empty-coil', type=str, default=DEFAULT_EMPTY_COIL,
+                        help='empty coil captures of the signature, "" for none')
+    parser.add_argument('--all', action='store_true', help='print the kind of every calibration row')
+    args = parser.parse_args()
+
+    for file_path in args.file_paths:
+        kinds, X, tracker = replay_file(file_path, empty_coil_path=args.empty_coil, window=args.window,
+                                        track_empty=not args.no_empty)
+        stats = tracker.drift()
+        print("{} : {} measurements, captures {}".format(file_path, int(np.sum(kinds == MEASUREMENT)),
+                                                         stats['captures']))
+        if not tracker.calibrated:
+            print("  not calibrated : no reference press without a coin")
+            continue
+        print("  shift {:.4f}, rate {:.2e} /measurement, last capture {} measurements ago, expected drift {:.4f}, "
+              "recalibration : {}".format(stats['shift'], stats['rate'], stats['age'], stats['expected'],
+                                          stats['recalibrate'] or "not needed"))
+        if args.all:
+            for i in np.flatnonzero(kinds != MEASUREMENT):
+                print("  measurement {:>6} : {}".format(i, kinds[i]))
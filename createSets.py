@@ -1,142 +1,210 @@
-
-import h5py
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Create the training, validation and test sets (and the foreign coins sets) from the data files
+
+Usage : python createSets.py [--folders FOLDER ...] [--all-groups] [--workers N] [--dtype float64|float32]
+                            [--cache FOLDER | --no-cache] [--spec FILE]
+"""
+
+import argparse
+import concurrent.futures
+import functools
+import glob
+import os
+import time
 import numpy as np
 from datafilereader import DataFileReader
+from features import FeatureExtractor, DEFAULT_SPEC, load_spec
+from dataset_io import save_dataset
+from feature_cache import DEFAULT_CACHE_DIR, get_cache
 from sklearn.utils import shuffle
-import pickle
-
-enForeign = False
-
-#load data from group 5
-folder = "./data/Groupe5/dataSetAGF-bobine3/"
 
 labels = list(range(0,8))
 labels_name = ["unknown","5_CTS", "10_CTS", "20_CTS", "50_CTS", "1_CHF", "2_CHF", "5_CHF"]
 
-featureListR = [17,20,21,22,26,28,31,32,39,42,44,71]
-featureListL = [4,5,6,7,8,9,10,12,61]
-
-
-#get frequecy of the first coin (always the same)
-dataset = DataFileReader(folder+labels_name[1]+".h5")
-f,_ = dataset.get_all_mesurements()
-
-#create a DataSet with all the measurements of all the coins
-X = []
-Y = []
-
-folders = ["./data/Groupe5/dataSetAGF-bobine3/","./data/Groupe11/", "./data/Groupe10/"]
-for j in range(len(folders)):
-    for i in range(1, 8):
-        dataset = DataFileReader(folders[j]+labels_name[i]+".h5")
+# folders used for the training data
+DEFAULT_FOLDERS = ["./data/Groupe5/dataSetAGF-bobine3/","./data/Groupe11/", "./data/Groupe10/"]
 
-        #get all measured Z for this coin
-        _,Z = dataset.get_all_mesurements()
-        N = len(Z) #number of measurements for this coin
-        R = np.real(Z)
-        L = np.imag(Z)/(2*np.pi*f)
+# foreign coins (1_EUR is kept out, as in the original sets)
+FOREIGN_FOLDER = "./data/foreign/"
+FOREIGN_NAMES = ["1_LST","1ct_EUR","2ct_EUR","2ct_LST","5ct_EUR", "5ct_LST_1991", "5ct_LST_2015", "10ct_EUR", "10ct_LST", "20ct_EUR", "20ct_LST","50ct_LST"]
 
-        # substract all the data by the calibration
-        R = R[1:,:]-R[0,:]
-        L = L[1:,:]-L[0,:]
+SEED = 42
 
-        #extract the needed features
-        R = R[:,featureListR]
-        L = L[:,featureListL]
-        p = R[:,0:9]/L
-        #d = (L[6]-L[5])/(f[10]-f[9])
-        #concatenate the features
-        for n in range(N-1):
-            X.append(np.concatenate((R[n,:],L[n,:],p[n,:]),axis=0))
-            Y.append(i)
-            
-print("number of data :",len(Y))
-print("number of features :",len(X[0]))
-print("number of different classes :",len(set(Y)))
 
-#shuffle the data
-X,Y = shuffle(X,Y,random_state=42)
+def discover_files(folders):
+    """
+    Find the data file of each coin in the folders (and their sub-folders)
 
-#save the data in the different sets
-N = len(Y)
-Ntrain = int(0.6*N)
-Nvalid = int(0.2*N)
-Ntest = N-Ntrain-Nvalid
+    Arguments:
+    folders -- folders to search : list of str
 
+    Returns:
+    (file path, label) of each coin file, folder by folder : list of tuple
+    """
+    files = []
+    for folder in folders:
+        for i in range(1, len(labels_name)):
+            paths = sorted(glob.glob(os.path.join(folder, "**", labels_name[i]+".h5"), recursive=True))
+            files += [(path, labels[i]) for path in paths]
+    return files
 
-# Save the training set
-with open("dataset/trainingset.pkl","wb+") as f:
-    pickle.dump((X[:Ntrain],Y[:Ntrain]), f)
-# Save the validation set
-with open("dataset/validationset.pkl","wb+") as f:
-    pickle.dump((X[Ntrain:Ntrain+Nvalid],Y[Ntrain:Ntrain+Nvalid]), f)
-# Save the test set
-with open("dataset/testingset.pkl","wb+") as f:
-    pickle.dump((X[Ntrain+Nvalid:],Y[Ntrain+Nvalid:]), f)
 
+def extract_features(file_path, cache_dir=None, spec=DEFAULT_SPEC):
+    """
+    Extract the features of all the measurements of a coin file, the first measurement is the calibration
 
+    Arguments:
+    file_path -- coin data file : str
+    cache_dir -- feature cache folder, None to always read the file : str
+    spec -- feature specification : dict
 
-#create a validation set with foreign coins
-X_foreign = []
-Y_foreign = []
+    Returns:
+    features, one row per measurement : 2D numpy array
+    """
+    if cache_dir is not None:
+        return np.array(get_cache(cache_dir).get_features(file_path, spec))
 
-
-folder = "./data/foreign/"
-
-labels_name = ["1_EUR","1_LST","1ct_EUR","2ct_EUR","2ct_LST","5ct_EUR", "5ct_LST_1991", "5ct_LST_2015", "10ct_EUR", "10ct_LST", "20ct_EUR", "20ct_LST","50ct_LST"]
-
-featureListR = [17,20,21,22,26,28,31,32,39,42,44,71]
-featureListL = [4,5,6,7,8,9,10,12,61]
-
-dataset = DataFileReader(folder+labels_name[1]+".h5")
-f,_ = dataset.get_all_mesurements()
-
-
-for i in range(1, len(labels_name)):
-    dataset = DataFileReader(folder+labels_name[i]+".h5")
+    dataset = DataFileReader(file_path)
 
     #get all measured Z for this coin
-    _,Z = dataset.get_all_mesurements()
-    N = len(Z) #number of measurements for this coin
-    R = np.real(Z)
-    L = np.imag(Z)/(2*np.pi*f)
-
-    # substract all the data by the calibration
-    R = R[1:,:]-R[0,:]
-    L = L[1:,:]-L[0,:]
-
-    #extract the needed features
-    R = R[:,featureListR]
-    L = L[:,featureListL]
-    p = R[:,0:9]/L
-    #d = (L[6]-L[5])/(f[10]-f[9])
-    #concatenate the features
-    for n in range(N-1):
-        X_foreign.append(np.concatenate((R[n,:],L[n,:],p[n,:]),axis=0))
-        Y_foreign.append(-1)
-
-X_CHF_foreign = np.concatenate((X_foreign[:50],X[Ntrain+Nvalid:Ntrain+Nvalid+50]),axis=0)
-Y_CHF_foreign = np.concatenate((Y_foreign[:50],np.ones(50)),axis=0)
-
-
-#shuffle the data
-X_CHF_foreign,Y_CHF_foreign = shuffle(X_CHF_foreign,Y_CHF_foreign,random_state=42)
-
-X_valid_foreign = X_CHF_foreign[:60]
-Y_valid_foreign = Y_CHF_foreign[:60]
-X_test_foreign = X_CHF_foreign[60:]
-Y_test_foreign = Y_CHF_foreign[60:]
-
-
-with open("dataset/validset_foreign.pkl","wb+") as f:
-    pickle.dump((X_valid_foreign,Y_valid_foreign), f)
-with open("dataset/testset_foreign.pkl","wb+") as f:
-    pickle.dump((X_test_foreign,Y_test_foreign), f)
-
-print("validation set generated with foreign coins")
-print("number of data :",len(Y_valid_foreign))
-print("number of features :",len(X_valid_foreign[0]))
-print("test set generated with foreign coins")
-print("number of data :",len(Y_test_foreign))
-print("number of features :",len(X_test_foreign[0]))
-
+    f,Z = dataset.get_all_mesurements()
+    extractor = FeatureExtractor(f, **spec)
+    extractor.set_reference(Z[0])
+    return extractor.transform(Z[1:])
+
+
+def extract_all(file_paths, workers=None, cache_dir=None, spec=DEFAULT_SPEC):
+    """
+    Extract the features of several files in a process pool
+
+    Arguments:
+    file_paths -- coin data files : list of str
+    workers -- number of processes (None for the number of CPUs, 1 to stay in this process) : int
+    cache_dir -- feature cache folder, None to always read the files : str
+    spec -- feature specification : dict
+
+    Returns:
+    features of each file, in the order of file_paths : list of 2D numpy arrays
+    """
+    extract = functools.partial(extract_features, cache_dir=cache_dir, spec=spec)
+    if workers == 1:
+        return [extract(path) for path in file_paths]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(extract, file_paths))
+
+
+def build_sets(folders=DEFAULT_FOLDERS, workers=None, dtype=np.float64, out_folder="dataset", cache_dir=None,
+               spec=DEFAULT_SPEC):
+    """
+    Build and save the sets
+
+    Arguments:
+    folders -- folders containing the coin files used for training : list of str
+    workers -- number of processes extracting the features : int
+    dtype -- type of the saved features : numpy dtype
+    out_folder -- folder where the sets are saved : str
+    cache_dir -- feature cache folder, None to always read the files : str
+    spec -- feature specification : dict
+
+    Returns:
+    duration of each stage [s] : dict
+    """
+    timing = {}
+
+    # discover the files
+    t0 = time.perf_counter()
+    coin_files = discover_files(folders)
+    foreign_files = [os.path.join(FOREIGN_FOLDER, name+".h5") for name in FOREIGN_NAMES]
+    timing['discover'] = time.perf_counter() - t0
+
+    # extract the features of all the files at once
+    t0 = time.perf_counter()
+    features = extract_all([path for path,_ in coin_files] + foreign_files, workers, cache_dir, spec)
+    timing['extract'] = time.perf_counter() - t0
+
+    # create a DataSet with all the measurements of all the coins
+    t0 = time.perf_counter()
+    coin_features = features[:len(coin_files)]
+    X = np.concatenate(coin_features, axis=0).astype(dtype, copy=False)
+    Y = np.concatenate([np.full(len(x), label) for x,(_,label) in zip(coin_features, coin_files)])
+    X_foreign = np.concatenate(features[len(coin_files):], axis=0).astype(dtype, copy=False)
+    timing['concatenate'] = time.perf_counter() - t0
+
+    print("number of data :",len(Y))
+    print("number of features :",X.shape[1])
+    print("number of different classes :",len(set(Y)))
+
+    # shuffle the data and split it in the different sets
+    t0 = time.perf_counter()
+    X,Y = shuffle(X,Y,random_state=SEED)
+
+    N = len(Y)
+    Ntrain = int(0.6*N)
+    Nvalid = int(0.2*N)
+
+    sets = {
+        "trainingset": (X[:Ntrain],Y[:Ntrain]),
+        "validationset": (X[Ntrain:Ntrain+Nvalid],Y[Ntrain:Ntrain+Nvalid]),
+        "testingset": (X[Ntrain+Nvalid:],Y[Ntrain+Nvalid:]),
+    }
+    coin_split = {'seed': SEED, 'fractions': [0.6, 0.2, 0.2], 'sizes': [Ntrain, Nvalid, N-Ntrain-Nvalid],
+                  'parts': ["trainingset", "validationset", "testingset"]}
+
+    # validation and test sets with foreign coins (label -1) and coins of the test set (label 1)
+    X_CHF_foreign = np.concatenate((X_foreign[:50],X[Ntrain+Nvalid:Ntrain+Nvalid+50]),axis=0)
+    Y_CHF_foreign = np.concatenate((-np.ones(50),np.ones(50)),axis=0)
+    X_CHF_foreign,Y_CHF_foreign = shuffle(X_CHF_foreign,Y_CHF_foreign,random_state=SEED)
+
+    sets["validset_foreign"] = (X_CHF_foreign[:60],Y_CHF_foreign[:60])
+    sets["testset_foreign"] = (X_CHF_foreign[60:],Y_CHF_foreign[60:])
+    foreign_split = {'seed': SEED, 'fractions': [0.6, 0.4], 'sizes': [60, 40],
+                     'parts': ["validset_foreign", "testset_foreign"],
+                     'n_foreign': 50, 'n_test': 50, 'labels': {'-1': 'foreign', '1': 'test set coin'}}
+    timing['split'] = time.perf_counter() - t0
+
+    # save the sets
+    t0 = time.perf_counter()
+    coin_sources = [{'path': path, 'label': int(label)} for path,label in coin_files]
+    foreign_sources = coin_sources + [{'path': path, 'label': -1} for path in foreign_files]
+    for name, (X_set, Y_set) in sets.items():
+        if name in ("validset_foreign", "testset_foreign"):
+            split = dict(foreign_split, part=name)
+            source_files = foreign_sources
+        else:
+            split = dict(coin_split, part=name)
+            source_files = coin_sources
+        save_dataset(os.path.join(out_folder, name), X_set, Y_set, spec=spec,
+                     labels_name=labels_name, source_files=source_files, split=split)
+    timing['save'] = time.perf_counter() - t0
+
+    print("validation set generated with foreign coins")
+    print("number of data :",len(sets["validset_foreign"][1]))
+    print("test set generated with foreign coins")
+    print("number of data :",len(sets["testset_foreign"][1]))
+
+    return timing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create the datasets from the data files')
+    parser.add_argument('--folders', nargs='+', type=str, default=DEFAULT_FOLDERS, help='folders containing the coin files')
+    parser.add_argument('--all-groups', action='store_true', help='use all the ./data/Groupe* folders')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32'], help='type of the saved features')
+    parser.add_argument('--out', type=str, default='dataset', help='output folder')
+    parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_DIR, help='feature cache folder')
+    parser.add_argument('--no-cache', action='store_true', help='always read the data files')
+    parser.add_argument('--spec', type=str, default=None, help='feature specification JSON (feature_selection.py)')
+    args = parser.parse_args()
+
+    folders = sorted(glob.glob("./data/Groupe*/")) if args.all_groups else args.folders
+    cache_dir = None if args.no_cache else args.cache
+    timing = build_sets(folders, args.workers, np.dtype(args.dtype), args.out, cache_dir, load_spec(args.spec))
+
+    print("\ntiming :")
+    for stage, t in timing.items():
+        print("  {:<12} {:8.1f} ms".format(stage, t*1e3))
+    print("  {:<12} {:8.1f} ms".format("total", sum(timing.values())*1e3))
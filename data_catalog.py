@@ -0,0 +1,319 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Catalog of the data files of the data/ tree, kept in a small SQLite database. The tree is scanned
+              once, and for each file the group, the coil, the coin (parsed from names like 5_CTS, 1_CHF,
+              5ct_LST_1991 or EUR_1), the number of measurements, the reference indexes and a hash of the
+              frequency grid are recorded. The queries ("all the 1_CHF files of the coil bobine3") are answered
+              without opening the data files, and a refresh only reads the files whose size or mtime changed.
+
+Usage : python data_catalog.py refresh [--root FOLDER] [--db FILE] [--full]
+        python data_catalog.py find [--coin COIN] [--group GROUP] [--coil COIL] [--currency CUR] [--label L]
+                                    [--root FOLDER] [--db FILE]
+        python data_catalog.py summary [--root FOLDER] [--db FILE]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import numpy as np
+from datafilereader import DataFileReader
+from features import LABELS
+
+CATALOG_VERSION = 1 # to be incremented when the recorded values change, the catalog is then rebuilt
+DEFAULT_ROOT = "./data"
+DEFAULT_DB = os.environ.get("DATA_CATALOG", "./.data_catalog.sqlite")
+
+# coin names : 5_CTS, 1_CHF, 1_EUR, 10ct_EUR, 5ct_LST_1991, EUR_1
+COIN_NAME = re.compile(r"^(?P<value>\d+)(?P<unit>ct|_CTS|_CHF)?(?:_(?P<currency>[A-Z]{3}))?(?:_(?P<year>\d{4}))?$")
+CURRENCY_FIRST = re.compile(r"^(?P<currency>[A-Z]{3})_(?P<value>\d+)$")
+GROUP_NAME = re.compile(r"^Groupe\d+$")
+COIL_NAME = re.compile(r"(bobine|capteur|coil)[-_]?\d+", re.IGNORECASE)
+
+COLUMNS = ["path", "group_name", "coil", "coin", "currency", "year", "label", "n_measurements", "refs",
+           "n_frequencies", "grid_hash", "size", "mtime_ns", "error"]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,  -- relative to the root, '/' separated
+    group_name TEXT,        -- Groupe5, foreign, Live_files, ... ('' for the files of the root)
+    coil TEXT,              -- bobine3, capteur3, ... (NULL if the path does not tell)
+    coin TEXT,              -- 5_CTS, 1_CHF, 5_CTS_EUR, 1_EUR, unknown (NULL if the name is not a coin)
+    currency TEXT,          -- CHF, EUR, LST
+    year INTEGER,
+    label INTEGER,          -- label of the classifier (features.LABELS), 0 for the foreign coins
+    n_measurements INTEGER,
+    refs TEXT,              -- JSON list of the reference indexes (among the existing measurements)
+    n_frequencies INTEGER,
+    grid_hash TEXT,         -- hash of the frequency vector, equal for files on the same frequency grid
+    size INTEGER,
+    mtime_ns INTEGER,
+    error TEXT              -- why the file could not be read (NULL if it was)
+);
+CREATE INDEX IF NOT EXISTS files_coin ON files (coin, coil, group_name);
+"""
+
+
+def parse_coin(name):
+    """
+    Coin of a data file, from its name
+
+    Arguments:
+    name -- file name without the extension : str
+
+    Returns:
+    coin (5_CTS, 1_CHF, 5_CTS_EUR, 1_EUR, ...), None if not a coin : str
+    currency, None if not a coin : str
+    year, None if not given : int
+    label of the classifier, 0 for the foreign and unknown coins, None if not a coin : int
+    """
+    if name.lower() == "unknown":
+        return "unknown", None, None, 0
+
+    match = COIN_NAME.match(name) or CURRENCY_FIRST.match(name)
+    if match is None:
+        return None, None, None, None
+    parts = match.groupdict()
+    value = int(parts['value'])
+    unit = parts.get('unit')
+    currency = parts.get('currency')
+    if currency is None:
+        if unit not in ("_CTS", "_CHF"):
+            return None, None, None, None
+        currency = "CHF"
+    if currency == "CHF":
+        coin = "{}{}".format(value, unit)
+    elif unit == "ct":
+        coin = "{}_CTS_{}".format(value, currency)
+    else:
+        coin = "{}_{}".format(value, currency)
+    if currency == "CHF":
+        label = LABELS.index(coin) if coin in LABELS else None
+    else:
+        label = 0
+    year = int(parts['year']) if parts.get('year') else None
+    return coin, currency, year, label
+
+
+def parse_path(path):
+    """
+    Group, coil and coin of a data file, from its path
+
+    Arguments:
+    path -- path relative to the root of the tree, '/' separated : str
+
+    Returns:
+    values of the columns group_name, coil, coin, currency, year and label : dict
+    """
+    folders = path.split("/")[:-1]
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    groups = [folder for folder in folders if GROUP_NAME.match(folder)]
+    group = groups[0] if groups else (folders[0] if folders else "")
+    coils = [COIL_NAME.search(folder) for folder in folders]
+    coils = [match.group(0).lower() for match in coils if match]
+
+    coin, currency, year, label = parse_coin(name)
+    return {'group_name': group, 'coil': coils[-1] if coils else None, 'coin': coin, 'currency': currency,
+            'year': year, 'label': label}
+
+
+def grid_hash(frequency):
+    """
+    Hash of a frequency vector
+
+    Arguments:
+    frequency -- frequency vector : 1D numpy array
+
+    Returns:
+    hash : str
+    """
+    frequency = np.ascontiguousarray(frequency, dtype=np.float64)
+    return hashlib.blake2b(frequency.tobytes(), digest_size=8).hexdigest()
+
+
+def read_file_entry(file_path):
+    """
+    Values recorded for a data file, it is read once : the frequency vector, the 'existing' flags and the
+    'Reference' field only
+
+    Arguments:
+    file_path -- data file : str
+
+    Returns:
+    values of the columns n_measurements, refs, n_frequencies, grid_hash and error : dict
+    """
+    try:
+        reader = DataFileReader(file_path)
+        frequency = reader.get_frequency()
+        _, _, is_reference, n = reader.read_band(indexes=[])
+    except (OSError, KeyError, ValueError) as e:
+        return {'n_measurements': None, 'refs': None, 'n_frequencies': None, 'grid_hash': None,
+                'error': "{}: {}".format(type(e).__name__, e)}
+    return {'n_measurements': int(n), 'refs': json.dumps(np.flatnonzero(is_reference).tolist()),
+            'n_frequencies': len(frequency), 'grid_hash': grid_hash(frequency), 'error': None}
+
+
+class DataCatalog:
+    """
+    Class to index the data files of a folder tree and query them without opening them
+
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, db_path=DEFAULT_DB):
+        """
+        Constructor
+
+        Arguments:
+        root -- folder of the data files : str
+        db_path -- SQLite file of the catalog (':memory:' for a catalog of the process only) : str
+        """
+        self.root = root
+        self.db_path = db_path
+        self.__db = sqlite3.connect(db_path)
+        self.__db.row_factory = sqlite3.Row
+        if self.__db.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+            self.__db.execute("DROP TABLE IF EXISTS files")
+            self.__db.execute("PRAGMA user_version = {}".format(CATALOG_VERSION))
+        self.__db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.__db.close()
+
+    # --- public methods
+    def refresh(self, full=False):
+        """
+        Bring the catalog up to date with the tree : the new files and the files whose size or mtime changed are
+        read, the removed files are dropped
+
+        Arguments:
+        full -- read all the files again : bool
+
+        Returns:
+        number of files read, unchanged and removed : dict
+        """
+        known = {row['path']: (row['size'], row['mtime_ns'])
+                 for row in self.__db.execute("SELECT path, size, mtime_ns FROM files")}
+        paths = sorted(glob.glob(os.path.join(self.root, "**", "*.h5"), recursive=True))
+
+        entries = []
+        unchanged = 0
+        for file_path in paths:
+            path = os.path.relpath(file_path, self.root).replace(os.sep, "/")
+            st = os.stat(file_path)
+            stamp = (st.st_size, st.st_mtime_ns)
+            if not full and known.pop(path, None) == stamp:
+                unchanged += 1
+                continue
+            known.pop(path, None)
+            entry = {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            entry.update(parse_path(path))
+            entry.update(read_file_entry(file_path))
+            entries.append(entry)
+
+        with self.__db:
+            self.__db.executemany("INSERT OR REPLACE INTO files ({}) VALUES ({})".format(
+                ", ".join(COLUMNS), ", ".join(":"+column for column in COLUMNS)), entries)
+            self.__db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+        return {'read': len(entries), 'unchanged': unchanged, 'removed': len(known)}
+
+    def find(self, coin=None, group=None, coil=None, currency=None, label=None, grid=None, readable=True):
+        """
+        Files matching the given values (None matches everything)
+
+        Arguments:
+        coin -- coin (5_CTS, 1_CHF, 5_CTS_EUR, 1_EUR, unknown, ...) : str
+        group -- group folder (Groupe5, foreign, ...) : str
+        coil -- coil (bobine3, capteur3, ...) : str
+        currency -- currency (CHF, EUR, LST) : str
+        label -- label of the classifier : int
+        grid -- hash of the frequency grid : str
+        readable -- only the files that could be read : bool
+
+        Returns:
+        files, sorted by path : list of dict (the columns, with 'refs' as a list and 'file_path' the path to open)
+        """
+        conditions, values = [], []
+        for column, value in [("coin", coin), ("group_name", group), ("coil", coil), ("currency", currency),
+                              ("label", label), ("grid_hash", grid)]:
+            if value is not None:
+                conditions.append("{} = ?".format(column))
+                values.append(value.lower() if column == "coil" else value)
+        if readable:
+            conditions.append("error IS NULL")
+        query = "SELECT * FROM files" + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY path"
+        return [self.__to_entry(row) for row in self.__db.execute(query, values)]
+
+    def measurements(self, **query):
+        """
+        Measurements (without the references) of the files matching a query
+
+        Arguments:
+        query -- values of find() : keyword arguments
+
+        Returns:
+        (file path, indexes among the existing measurements of the file) of each file : list of tuple
+        """
+        return [(entry['file_path'], np.setdiff1d(np.arange(entry['n_measurements']), entry['refs']))
+                for entry in self.find(**query)]
+
+    def summary(self):
+        """
+        Number of files and measurements per group, coil and coin
+
+        Returns:
+        (group, coil, coin, number of files, number of measurements) : list of tuple
+        """
+        return [tuple(row) for row in self.__db.execute(
+            "SELECT group_name, coil, coin, COUNT(*), SUM(n_measurements) FROM files "
+            "GROUP BY group_name, coil, coin ORDER BY group_name, coil, coin")]
+
+    # --- private methods
+    def __to_entry(self, row):
+        entry = dict(row)
+        entry['refs'] = json.loads(entry['refs']) if entry['refs'] is not None else None
+        entry['file_path'] = os.path.join(self.root, *entry['path'].split("/"))
+        return entry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Catalog of the data files')
+    parser.add_argument('command', choices=['refresh', 'find', 'summary'], help='action')
+    parser.add_argument('--root', type=str, default=DEFAULT_ROOT, help='folder of the data files')
+    parser.add_argument('--db', type=str, default=DEFAULT_DB, help='SQLite file of the catalog')
+    parser.add_argument('--full', action='store_true', help='read all the files again (refresh)')
+    parser.add_argument('--coin', type=str, default=None, help='coin (find)')
+    parser.add_argument('--group', type=str, default=None, help='group folder (find)')
+    parser.add_argument('--coil', type=str, default=None, help='coil (find)')
+    parser.add_argument('--currency', type=str, default=None, help='currency (find)')
+    parser.add_argument('--label', type=int, default=None, help='label of the classifier (find)')
+    args = parser.parse_args()
+
+    with DataCatalog(args.root, args.db) as catalog:
+        t0 = time.perf_counter()
+        counts = catalog.refresh(args.full)
+        t = time.perf_counter() - t0
+        if args.command == 'refresh':
+            print("{read} files read, {unchanged} unchanged, {removed} removed".format(**counts),
+                  "in {:.1f} ms".format(t*1e3))
+        elif args.command == 'find':
+            entries = catalog.find(args.coin, args.group, args.coil, args.currency, args.label)
+            for entry in entries:
+                print("{:<50} {:>5} measurements, references {}".format(
+                    entry['path'], entry['n_measurements'], entry['refs']))
+            print("{} files, {} measurements".format(len(entries), sum(e['n_measurements'] for e in entries)))
+        else:
+            print("{:<12} {:<10} {:<10} {:>6} {:>13}".format("group", "coil", "coin", "files", "measurements"))
+            for group, coil, coin, n_files, n in catalog.summary():
+                print("{:<12} {:<10} {:<10} {:>6} {:>13}".format(group or "-", coil or "-", coin or "-", n_files, n or 0))
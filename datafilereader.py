@@ -5,7 +5,9 @@ Created : 2024
 Description : Read the content of a data file containing impedance measurements
 """
 
+import datetime
 import time
+from contextlib import contextmanager
 import h5py
 from util.settings import Dtype, Settings
 import numpy as np
@@ -23,22 +25,41 @@ class DataFileReader:
     FREQ_MIN = 0
     FREQ_MAX = 200e3
     LIMIT_FREQ = True
+    DEFAULT_CHUNK_ROWS = 16 # measurements per chunk of the written files
+    SIEVE_BUF_SIZE = 0 # HDF5 raw data sieve buffer of the reads [bytes], 0 to read the selected columns only
+    COLUMN_GAP = 64 # contiguous files : impedance columns closer than this are read in one block (a read call costs more)
     
-    def __init__(self, filename, mode='r', max_str_len=50):   # Mode : 'r' to read, 'a' to edit, 'w' to write
+    def __init__(self, filename, mode='r', max_str_len=50, keep_open=False, swmr=False):   # Mode : 'r' to read, 'a' to edit, 'w' to write
         """
         Constructor
         
         Arguments:
         filename -- path and filename : str
         mode -- 'r' to read, 'a' to edit, 'w' to write : str
+        max_str_len -- length of the string metadata of a new file : int
+        keep_open -- keep a single handle on the file open until close() is called (without the HDF5 file lock,
+                     so that the acquisition tool can still reopen the file to append) : bool
+        swmr -- open the persistent handle in SWMR read mode, so that the acquisition tool can keep appending : bool
         """
         self.__settings = Settings.settings
         self.__filename = filename
+        self.__mode = mode
+        self.__swmr = swmr
         
         # Max metadata length (if string)
         self.__str_len = max_str_len
         
-        f = h5py.File(self.__filename,mode)
+        # Persistent handle state (see open/close)
+        self.__handle = None
+        self.__stamp = None
+        self.__existing_idx = None
+        self.file_opens = 0 # number of times the HDF5 file has been opened by this reader
+        
+        if mode == 'r':
+            f = self.__open_file(persistent=keep_open)
+        else:
+            f = h5py.File(self.__filename,mode)
+            self.file_opens += 1
         
         # Create liste of measurement metadata
         self.__mes_metadata_keys = {           # List of measurement metadata that are not received from serial port
@@ -57,6 +78,7 @@ class DataFileReader:
         self.__metadata_dtypes['formats'] = []
 
         metadata_com_labels = self.__settings['Metadata labels']['com']
+        file_dtype = f['metadata'].dtype if 'metadata' in f else None
         
         for key in list(self.__mes_metadata_keys.keys()):
             self.__metadata_dtypes['names'].append(key)
@@ -72,20 +94,66 @@ class DataFileReader:
                 elif metadata_com_labels[key] == Dtype.bool:
                     self.__metadata_dtypes['formats'].append(('i1', (1,)))
             else:
-                if(list(f.keys()) != []):
-                    if(len(f['metadata'][0][key]) > self.__str_len):
-                        self.__str_len = len(f['metadata'][0][key])
+                if(file_dtype is not None):
+                    if(file_dtype[key].shape[0] > self.__str_len):
+                        self.__str_len = file_dtype[key].shape[0]
                 if self.__mes_metadata_keys[key] == Dtype.string:
                     self.__metadata_dtypes['formats'].append(('i1', (self.__str_len,)))
                 elif self.__mes_metadata_keys[key] == Dtype.uint32:
                     self.__metadata_dtypes['formats'].append(('i4', (1,)))
         
-        f.close()
+        if keep_open and mode == 'r':
+            # reuse the handle opened to size the metadata
+            self.__handle = f
+            self.__stamp = self.__get_file_stamp()
+        else:
+            f.close()
         
         # get the current time stamp of the file
         self.current_modification_timestamp = self.__get_current_modification_timestamp()
         
+    @property
+    def filename(self):
+        return self.__filename
+    
+    def __enter__(self):
+        return self.open()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
     # --- public mehtods
+    def open(self):
+        """
+        Open a persistent handle on the file. All the accessors reuse it until close() is called,
+        the cached dataset handles and 'existing' mask are only refreshed when the file changed on disk.
+
+        Returns:
+        the reader itself : DataFileReader
+        """
+        if self.__handle is None:
+            self.__handle = self.__open_file(persistent=True)
+            self.__stamp = self.__get_file_stamp()
+            self.__existing_idx = None
+        return self
+    
+    def close(self):
+        """
+        Close the persistent handle (if any)
+        """
+        if self.__handle is not None:
+            self.__handle.close()
+        self.__handle = None
+        self.__stamp = None
+        self.__existing_idx = None
+    
+    def is_open(self):
+        """
+        Returns:
+        True if a persistent handle is open : bool
+        """
+        return self.__handle is not None
+    
     def get_reference_impedance_index(self):
         """
         Get the indexes of the reference measurements
@@ -94,11 +162,35 @@ class DataFileReader:
         Reference indexes : 1D numpy array
         """
 
-        ref_index = np.asarray([n for n in range(self.__get_N_mes()) if self.__is_reference(n)])
+        reference = self.get_all_metadata(['Reference'])['Reference']
+        ref_index = np.flatnonzero(reference != 0)
         if ref_index.size == 0:
             return None
         return ref_index
     
+    def get_all_metadata(self, keys=None):
+        """
+        Get the metadata of all measurements in file, read in a single slice
+
+        Arguments:
+        keys -- metadata labels to read (all if None) : list of str
+
+        Returns:
+        metadata : dict of 1D numpy arrays (one entry per measurement), strings are decoded and
+        'Device UID' is given as python int (96 bits)
+        """
+        if keys is None:
+            keys = list(self.__mes_metadata_keys.keys())
+        
+        with self.__file() as f:
+            if self.__is_empty(f):
+                return {key: np.empty(0) for key in keys}
+            
+            mes_existing = self.__get_existing_index(f)
+            metadata_raw = self.__read_rows(f['metadata'], mes_existing, fields=keys)
+        
+        return self.__decode_metadata(metadata_raw, keys)
+    
     def get_all_mesurements(self):
         """
         Get all measurements in file
@@ -112,7 +204,120 @@ class DataFileReader:
 
         frequency,Z = self.__get_impedance_matrix(self.LIMIT_FREQ)
         return frequency,Z
-    
+
+    def get_all_rawdata(self):
+        """
+        Get the raw voltage traces of all measurements in file, read in a single slice
+
+        Returns:
+        vd : 2D numpy array, one row per measurement
+        vs : 2D numpy array, one row per measurement
+        """
+        with self.__file() as f:
+            if self.__is_empty(f):
+                return np.empty((0,0)),np.empty((0,0))
+
+            mes_existing = self.__get_existing_index(f)
+            rawdata = self.__read_rows(f['rawdata'], mes_existing)
+
+        return rawdata[:,0,:],rawdata[:,1,:]
+
+    def get_frequency(self):
+        """
+        Get the frequency vector of the whole sweep (not limited to the band)
+
+        Returns:
+        frequency [Hz] : 1D numpy array (empty if the file has no measurement)
+        """
+        with self.__file() as f:
+            if self.__is_empty(f):
+                return np.empty(0)
+            return f['impedance'][0,0,:]
+
+    def read_since(self, cursor=0):
+        """
+        Get the measurements appended since a cursor, only the new rows are read from the file
+
+        Arguments:
+        cursor -- number of measurements already read (0 to read everything) : int
+
+        Returns:
+        frequency indices of computed impedance : 1D numpy array
+        computed impedance of the new measurements : 2D numpy array of complex numbers
+        is_reference of the new measurements : 1D numpy array of bool
+        new cursor, to give to the next call : int
+        """
+        return self.read_band(cursor=cursor)
+
+    def read_band(self, indexes=None, fmin=None, fmax=None, cursor=0):
+        """
+        Get the measurements on a set of frequencies, only these columns (and the new rows) are read from the file
+
+        Arguments:
+        indexes -- frequency indexes, in the frequency vector of the band (all if None) : list of int
+        fmin -- lower bound of the band (excluded) [Hz], FREQ_MIN if None and LIMIT_FREQ : float
+        fmax -- upper bound of the band (excluded) [Hz], FREQ_MAX if None and LIMIT_FREQ : float
+        cursor -- number of measurements already read (0 to read everything) : int
+
+        Returns:
+        frequency indices of computed impedance (sorted) : 1D numpy array
+        computed impedance of the new measurements : 2D numpy array of complex numbers
+        is_reference of the new measurements : 1D numpy array of bool
+        new cursor, to give to the next call : int
+        """
+        with self.__file() as f:
+            if self.__is_empty(f):
+                return np.empty(0),np.empty((0,0),dtype=complex),np.empty(0,dtype=bool),0
+
+            mes_existing = self.__get_existing_index(f)
+            frequency = f['impedance'][0,0,:]
+            columns = self.__get_columns(frequency, indexes, fmin, fmax)
+
+            new = mes_existing[cursor:] if cursor <= len(mes_existing) else mes_existing[:0]
+            Z = self.__read_impedance(f, new, columns)
+            reference = self.__read_rows(f['metadata'], new, fields=['Reference'])
+
+        is_reference = reference['Reference'][:,0] != 0
+        return frequency[columns],Z,is_reference,len(mes_existing)
+
+    def iter_blocks(self, block_size=4096, indexes=None, fmin=None, fmax=None, keys=None):
+        """
+        Iterate over the measurements by blocks, the file is read block_size rows at a time (the 'existing'
+        flags too), so the memory used does not depend on the size of the file
+
+        Arguments:
+        block_size -- number of file rows per block, a block has fewer measurements if some do not exist : int
+        indexes -- frequency indexes, in the frequency vector of the band (all if None) : list of int
+        fmin -- lower bound of the band (excluded) [Hz], FREQ_MIN if None and LIMIT_FREQ : float
+        fmax -- upper bound of the band (excluded) [Hz], FREQ_MAX if None and LIMIT_FREQ : float
+        keys -- metadata labels to read (all if None) : list of str
+
+        Yields:
+        frequency indices of computed impedance : 1D numpy array
+        computed impedance of the measurements of the block : 2D numpy array of complex numbers
+        is_reference of the measurements of the block : 1D numpy array of bool
+        metadata of the measurements of the block : dict of 1D numpy arrays
+        """
+        if keys is None:
+            keys = list(self.__mes_metadata_keys.keys())
+        fields = list(dict.fromkeys(['Reference'] + list(keys)))
+
+        with self.__file() as f:
+            if self.__is_empty(f):
+                return
+            frequency = f['impedance'][0,0,:]
+            columns = self.__get_columns(frequency, indexes, fmin, fmax)
+            n_rows = f['existing'].shape[0]
+
+            for start in range(0, n_rows, block_size):
+                rows = start + np.flatnonzero(f['existing'][start:start+block_size])
+                if rows.size == 0:
+                    continue
+                Z = self.__read_impedance(f, rows, columns)
+                metadata_raw = self.__read_rows(f['metadata'], rows, fields=fields)
+                is_reference = metadata_raw['Reference'][:,0] != 0
+                yield frequency[columns],Z,is_reference,self.__decode_metadata(metadata_raw, keys)
+
     def get_last_mesurement(self):
         """
         Get the last measurement
@@ -123,13 +328,46 @@ class DataFileReader:
         is_reference : bool
         
         """
-        metadata,vd,vs,frequency,Z = self.__get_mes(-1)
-        if self.LIMIT_FREQ:
-            idx_f = np.logical_and(frequency > self.FREQ_MIN, frequency < self.FREQ_MAX)
-        
-        is_reference = self.__is_reference(self.__get_N_mes()-1)
+        return self.get_mesurement(-1)
+    
+    def get_mesurement(self, n):
+        """
+        Get one measurement, by index
+
+        Argument:
+        n -- measurement index (among the existing measurements) : int
+
+        Returns:
+        frequency indices of computed impedance : 1D numpy array
+        computed impedance : 1D numpy array of complex numbers
+        is_reference : bool
         
-        return frequency[idx_f],Z[idx_f],is_reference
+        """
+        with self.__file() as f:
+            n_ = self.__get_existing_index(f)[n]
+            frequency = f['impedance'][0,0,:]
+            columns = self.__get_columns(frequency)
+            Z = self.__read_impedance(f, np.array([n_]), columns)[0]
+            is_reference = self.__read_fields(f['metadata'], ['Reference'], n_, n_+1)['Reference'][0,0] != 0
+
+        return frequency[columns],Z,is_reference
+    
+    def get_number_of_mesurements(self):
+        """
+        Get the number of existing measurements in file
+
+        Returns:
+        number of measurements : int
+        """
+        return int(self.__get_N_mes())
+    
+    def refresh(self):
+        """
+        Force the persistent handle (if any) to reload the file on the next access, for changes that
+        the file time stamp can not show (several writes within the file system time resolution)
+        """
+        if self.__handle is not None:
+            self.__stamp = None
     
     def has_file_changed(self):
         # determine if the file has changed
@@ -137,7 +375,94 @@ class DataFileReader:
         haschanged = current_timestamp != self.current_modification_timestamp
         self.current_modification_timestamp = current_timestamp
         return haschanged
-    
+
+    # --- write mehtods
+    def create(self, frequency, capacity=0, chunk_rows=DEFAULT_CHUNK_ROWS, compression=None, compression_opts=None,
+               shuffle=False, file_description='', user_name=''):
+        """
+        Create the datasets of an empty file. They are chunked along the measurements (a chunk holds chunk_rows
+        whole measurements) and resizable, append_mesurements() grows them as needed.
+
+        Arguments:
+        frequency -- frequencies of the impedance rows : 1D numpy array
+        capacity -- number of measurements allocated at creation : int
+        chunk_rows -- number of measurements per chunk : int
+        compression -- None, 'gzip', 'lzf' or 'lz4' (needs the hdf5plugin package) : str
+        compression_opts -- gzip level (0-9) : int
+        shuffle -- apply the byte shuffle filter before the compression : bool
+        file_description -- 'File description' attribute : str
+        user_name -- 'User name' attribute : str
+        """
+        filters = self.__get_filters(compression, compression_opts, shuffle)
+
+        with self.__writable_file() as f:
+            if list(f.keys()) != []:
+                raise ValueError("{} already has measurement datasets".format(self.__filename))
+
+            f.attrs['File description'] = file_description
+            f.attrs['User name'] = user_name
+            self.__create_datasets(f, frequency, capacity, chunk_rows, filters)
+
+    def append_mesurements(self, frequency, Z, vd=None, vs=None, metadata=None, is_reference=False):
+        """
+        Append measurements after the last existing one, all of them in one write per dataset.
+        The file is created with the default layout of create() if it has no datasets yet.
+
+        Arguments:
+        frequency -- frequencies of the impedance : 1D numpy array
+        Z -- computed impedance, one row per measurement (or a single measurement) : 2D (or 1D) numpy array of
+             complex numbers
+        vd -- raw voltages vd, same shape as Z (zeros if None) : numpy array
+        vs -- raw voltages vs, same shape as Z (zeros if None) : numpy array
+        metadata -- metadata of the measurements : dict (one value or one value per measurement for each label),
+                    list of dict or structured numpy array with the metadata type of the file
+        is_reference -- the measurements are references : bool or 1D numpy array of bool
+
+        Returns:
+        indexes of the new measurements, as given to get_mesurement : 1D numpy array
+        """
+        Z = np.atleast_2d(Z)
+        n, F = Z.shape
+        if len(frequency) != F:
+            raise ValueError("Z has {} frequencies, {} were given".format(F, len(frequency)))
+
+        impedance = np.empty((n,3,F))
+        impedance[:,0,:] = frequency
+        impedance[:,1,:] = Z.real
+        impedance[:,2,:] = Z.imag
+
+        with self.__writable_file() as f:
+            if 'impedance' not in f:
+                self.__create_datasets(f, frequency, 0, self.DEFAULT_CHUNK_ROWS, {})
+            if f['impedance'].shape[2] != F:
+                raise ValueError("the file has {} frequencies, Z has {}".format(f['impedance'].shape[2], F))
+
+            mes_existing = np.flatnonzero(f['existing'][:])
+            start = mes_existing[-1]+1 if mes_existing.size else 0
+            stop = start+n
+            if stop > f['existing'].shape[0]:
+                if any(f[name].maxshape[0] is not None for name in ('existing', 'impedance', 'rawdata', 'metadata')):
+                    raise ValueError("{} is full ({} measurements) and its datasets are not resizable".format(
+                        self.__filename, f['existing'].shape[0]))
+                for name in ('existing', 'impedance', 'rawdata', 'metadata'):
+                    f[name].resize(stop, axis=0)
+
+            metadata_raw = self.__encode_metadata(metadata, f['metadata'].dtype, n, start, is_reference)
+
+            # the data first, then the 'existing' flags : a reader never sees a flagged empty row
+            f['impedance'][start:stop] = impedance
+            if vd is not None or vs is not None:
+                rawdata = np.zeros((n,2,F))
+                if vd is not None:
+                    rawdata[:,0,:] = vd
+                if vs is not None:
+                    rawdata[:,1,:] = vs
+                f['rawdata'][start:stop] = rawdata
+            f['metadata'][start:stop] = metadata_raw
+            f['existing'][start:stop] = 1
+
+        return np.arange(mes_existing.size, mes_existing.size+n)
+
     # --- private mehtods
     def __get_impedance_matrix(self, limit_f=True):
         """
@@ -149,39 +474,145 @@ class DataFileReader:
         and second dimension represents the frequency index
         """
         
-        f = h5py.File(self.__filename, 'r')
-        if list(f.keys()) == []:
-            return [],[]
-        
-        mes_existing = f['existing'][:].astype(bool)
-        
-        frequency = f['impedance'][0,0,:]
-        Z_array = f['impedance'][mes_existing,1:,:]
-        
-        Z = Z_array[:,0,:]+1j*Z_array[:,1,:]
-        
-        f.close()
-        
-        if limit_f:
-            idx_f = np.logical_and(frequency > self.FREQ_MIN, frequency < self.FREQ_MAX)
-            frequency = frequency[idx_f]
-            Z = Z[:,idx_f]
+        with self.__file() as f:
+            if self.__is_empty(f):
+                return [],[]
+            
+            mes_existing = self.__get_existing_index(f)
+            
+            frequency = f['impedance'][0,0,:]
+            if limit_f:
+                columns = self.__get_columns(frequency)
+            else:
+                columns = self.__get_columns(frequency, fmin=-np.inf, fmax=np.inf)
+            Z = self.__read_impedance(f, mes_existing, columns)
         
-        return frequency,Z
-       
-    def __is_reference(self, n):
+        return frequency[columns],Z
+
+    def __get_columns(self, frequency, indexes=None, fmin=None, fmax=None):
         """
-        Returns the given measurement's 'Reference' attribute
-        
-        Argument:
-        n -- measurement index : int
-        
+        Columns of the impedance to read for a band and a set of frequency indexes
+
+        Arguments:
+        frequency -- frequency vector of the file : 1D numpy array
+        indexes -- frequency indexes, in the frequency vector of the band (all if None) : list of int
+        fmin -- lower bound of the band (excluded) [Hz], FREQ_MIN if None and LIMIT_FREQ : float
+        fmax -- upper bound of the band (excluded) [Hz], FREQ_MAX if None and LIMIT_FREQ : float
+
         Returns:
-        Reference : bool
+        sorted columns : 1D numpy array of int
         """
-        return self.__get_metadata(n)['Reference'] != 0
-    
-        
+        if fmin is None:
+            fmin = self.FREQ_MIN if self.LIMIT_FREQ else -np.inf
+        if fmax is None:
+            fmax = self.FREQ_MAX if self.LIMIT_FREQ else np.inf
+        columns = np.flatnonzero(np.logical_and(frequency > fmin, frequency < fmax))
+        if indexes is not None:
+            columns = np.unique(columns[np.asarray(indexes, dtype=np.intp)])
+
+        return columns
+
+    def __read_impedance(self, f, rows, columns):
+        """
+        Read the impedance of some measurements on some columns. The columns closer than the gap of the dataset
+        are read as one block (a single hyperslab when they are all close), the others are dropped in memory.
+        The gap follows the storage layout (__get_column_gap) : with the contiguous files of the ISS tool, the
+        21 columns of DEFAULT_SPEC (bins 4 to 71) are read as the 68 columns 4..71, one read call per row and
+        part instead of 12 (6x faster from the page cache, the skipped columns are in the same disk pages).
+
+        Arguments:
+        f -- file handle : h5py.File
+        rows -- sorted file indexes of the measurements : 1D numpy array
+        columns -- sorted columns of the impedance : 1D numpy array of int
+
+        Returns:
+        computed impedance : 2D numpy array of complex numbers
+        """
+        if columns.size == 0:
+            selection, take = slice(0,0), None
+        else:
+            gap, width = self.__get_column_gap(f['impedance'])
+            # blocks never span two chunks, a chunk is read and decompressed as a whole
+            breaks = np.flatnonzero((np.diff(columns) > gap) | (np.diff(columns//width) != 0))+1
+            starts = columns[np.concatenate([[0], breaks])]
+            stops = columns[np.concatenate([breaks-1, [-1]])]+1
+            if starts.size == 1:
+                selection = slice(int(starts[0]), int(stops[0]))
+                read = np.arange(starts[0], stops[0])
+            else:
+                selection = read = np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)])
+            take = None if read.size == columns.size else np.searchsorted(read, columns)
+
+        Z_array = self.__read_rows(f['impedance'], rows, (slice(1,3), selection))
+        if take is not None:
+            Z_array = Z_array[:,:,take]
+        return Z_array[:,0,:]+1j*Z_array[:,1,:]
+
+    def __get_column_gap(self, dset):
+        """
+        Largest run of unused impedance columns that is still read with its neighbours, from the storage layout.
+        Contiguous dataset : a row is contiguous on disk, a skipped column costs a copy and a read call much more
+        (measured break-even around 60 columns of 8 bytes), COLUMN_GAP. Chunked dataset : every column of a chunk
+        is read and decompressed anyway, the gap is the chunk width and the blocks stop at the chunk boundaries.
+
+        Arguments:
+        dset -- impedance dataset : h5py.Dataset
+
+        Returns:
+        gap [columns] : int
+        width of the column chunks (number of columns if not chunked) [columns] : int
+        """
+        if dset.chunks is None:
+            return self.COLUMN_GAP, dset.shape[2]
+        return dset.chunks[2], dset.chunks[2]
+
+    def __read_rows(self, dset, rows, selection=(), fields=None):
+        """
+        Read some rows of a dataset in one contiguous slice, from the first to the last row. The rows
+        in between that are not asked for (deleted measurements) are dropped in memory.
+
+        Arguments:
+        dset -- dataset : h5py.Dataset
+        rows -- sorted file indexes of the rows : 1D numpy array
+        selection -- selection on the other axes : tuple
+        fields -- metadata labels to read, for the compound metadata dataset : list of str
+
+        Returns:
+        rows : numpy array
+        """
+        first, last = (int(rows[0]), int(rows[-1])) if rows.size > 0 else (0, -1)
+        if fields is None:
+            data = dset[(slice(first,last+1),)+selection]
+        else:
+            data = self.__read_fields(dset, fields, first, last+1)
+        if last-first+1 == rows.size:
+            return data
+        return data[rows-first]
+
+    def __read_fields(self, dset, keys, start, stop):
+        """
+        Read some fields of the metadata rows start to stop. The memory type is built from the known metadata
+        formats, h5py would build the whole compound type of the file for each read.
+
+        Arguments:
+        dset -- metadata dataset : h5py.Dataset
+        keys -- metadata labels : list of str
+        start -- first row : int
+        stop -- row after the last one : int
+
+        Returns:
+        metadata : structured numpy array
+        """
+        names = self.__metadata_dtypes['names']
+        mem_dtype = np.dtype({'names': keys, 'formats': [self.__metadata_dtypes['formats'][names.index(key)]
+                                                         for key in keys]})
+        metadata_raw = np.empty(stop-start, dtype=mem_dtype)
+        if stop > start:
+            file_space = dset.id.get_space()
+            file_space.select_hyperslab((start,), (stop-start,))
+            dset.id.read(h5py.h5s.create_simple((stop-start,)), file_space, metadata_raw, h5py.h5t.py_create(mem_dtype))
+        return metadata_raw
+       
     def __get_mes(self, n):
         """
         Get measurement data, by index
@@ -197,20 +628,19 @@ class DataFileReader:
         computed impedance : 1D numpy array of complex numbers
         """
         
-        f = h5py.File(self.__filename, 'r')
-        
-        mes_existing = f['existing'][:].astype(bool)
-        n_ = np.where(mes_existing)[0][n]
+        with self.__file() as f:
+            n_ = self.__get_existing_index(f)[n]
+            
+            rawdata = f['rawdata'][n_]
+            Z_array = f['impedance'][n_]
+            metadata_raw = f['metadata'][n_]
         
-        rawdata = f['rawdata'][n_]
         vd = rawdata[0,:]
         vs = rawdata[1,:]
         
-        Z_array = f['impedance'][n_]
         frequency = Z_array[0,:]
         Z = Z_array[1,:]+1j*Z_array[2,:]
 
-        metadata_raw = f['metadata'][n_]
         metadata = {}
 
         for meta_key in list(self.__mes_metadata_keys.keys()):
@@ -221,11 +651,11 @@ class DataFileReader:
                 metadata[meta_key] = meta_str.tobytes().decode('utf-8')
             else:
                 if(meta_key == 'Device UID'):
-                    metadata[meta_key] = (int(metadata_raw[num_key][0]) << 64) + (int(metadata_raw[num_key][1]) << 32) + int(metadata_raw[num_key][2])
+                    # three unsigned 32-bit words stored as int32
+                    words = [int(word) & 0xFFFFFFFF for word in metadata_raw[num_key][:3]]
+                    metadata[meta_key] = (words[0] << 64) + (words[1] << 32) + words[2]
                 else:
                     metadata[meta_key] = metadata_raw[num_key][0]
-                    
-        f.close()
 
         return metadata,vd,vs,frequency,Z
     
@@ -239,27 +669,42 @@ class DataFileReader:
         Returns:
         metadata : dict
         """
-        f = h5py.File(self.__filename, 'r')
+        with self.__file() as f:
+            n_ = self.__get_existing_index(f)[n]
+            metadata_raw = f['metadata'][n_:n_+1]
         
-        mes_existing = f['existing'][:].astype(bool)
-        n_ = np.where(mes_existing)[0][n]
+        keys = list(self.__mes_metadata_keys.keys())
+        metadata = self.__decode_metadata(metadata_raw, keys)
+        return {key: value[0] for key, value in metadata.items()}
+    
+    def __decode_metadata(self, metadata_raw, keys):
+        """
+        Decode raw metadata columns
         
-        metadata_raw = f['metadata'][n_]
+        Arguments:
+        metadata_raw -- raw metadata, one row per measurement : structured numpy array or dict of arrays
+        keys -- metadata labels to decode : list of str
         
+        Returns:
+        metadata : dict of 1D numpy arrays
+        """
         metadata = {}
-
-        for meta_key in list(self.__mes_metadata_keys.keys()):
+        
+        for meta_key in keys:
+            column = np.asarray(metadata_raw[meta_key])
             if(self.__mes_metadata_keys[meta_key] == Dtype.string):
-                # Convert stored metzadata to string
-                meta_str = metadata_raw[meta_key][:np.where(metadata_raw[meta_key] == 0)[0][0]]
-                metadata[meta_key] = meta_str.tobytes().decode('utf-8')
+                # Convert stored metadata to string, everything after the first null byte is dropped
+                chars = column.astype(np.uint8)
+                chars[np.cumsum(chars == 0, axis=1) > 0] = 0
+                chars = np.ascontiguousarray(chars).view('S%d' % chars.shape[1])[:,0]
+                metadata[meta_key] = np.char.decode(chars, 'utf-8')
+            elif(meta_key == 'Device UID'):
+                # three unsigned 32-bit words stored as int32
+                uid = column.astype(np.int32).view(np.uint32).astype(object)
+                metadata[meta_key] = (uid[:,0] << 64) + (uid[:,1] << 32) + uid[:,2]
             else:
-                if(meta_key == 'Device UID'):
-                    metadata[meta_key] = (int(metadata_raw[meta_key][0]) << 64) + (int(metadata_raw[meta_key][1]) << 32) + int(metadata_raw[meta_key][2])
-                else:
-                    metadata[meta_key] = metadata_raw[meta_key][0]
-                    
-        f.close()
+                metadata[meta_key] = column[:,0]
+        
         return metadata
     
     def __get_N_mes(self):
@@ -269,13 +714,223 @@ class DataFileReader:
         Returns:
         Number of measurments : int
         """
-        f = h5py.File(self.__filename, 'r')
-        if(list(f.keys()) == []):
-            N = 0
-        else:
-            N = np.sum(f['existing'][:])
-        f.close()
+        with self.__file() as f:
+            if(self.__is_empty(f)):
+                N = 0
+            else:
+                N = len(self.__get_existing_index(f))
         return N
     
     def __get_current_modification_timestamp(self):
-        return os.path.getmtime(self.__filename)
\ No newline at end of file
+        return os.path.getmtime(self.__filename)
+    
+    def __open_file(self, persistent=False):
+        """
+        Open the file for reading (in SWMR mode if requested)
+        
+        Arguments:
+        persistent -- handle kept open between the accesses, opened without the HDF5 file lock : bool
+        
+        Returns:
+        file handle : h5py.File
+        """
+        self.file_opens += 1
+        fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+        # without the sieve buffer, a band of columns is read alone instead of the 64 kB blocks around it
+        fapl.set_sieve_buf_size(self.SIEVE_BUF_SIZE)
+        if persistent:
+            # a locked read handle would stop the ISS tool from reopening the file in 'a' mode for each measurement
+            fapl.set_file_locking(False, True)
+        flags = h5py.h5f.ACC_RDONLY
+        if self.__swmr:
+            fapl.set_libver_bounds(h5py.h5f.LIBVER_LATEST, h5py.h5f.LIBVER_LATEST)
+            flags |= h5py.h5f.ACC_SWMR_READ
+        else:
+            fapl.set_libver_bounds(h5py.h5f.LIBVER_EARLIEST, h5py.h5f.LIBVER_LATEST)
+        return h5py.File(h5py.h5f.open(os.fsencode(self.__filename), flags, fapl=fapl))
+    
+    @contextmanager
+    def __file(self):
+        """
+        Context giving a readable handle on the file: the persistent one (refreshed if the file changed)
+        or a temporary one closed on exit
+        """
+        if self.__handle is None:
+            f = self.__open_file()
+            try:
+                yield f
+            finally:
+                f.close()
+        else:
+            self.__refresh()
+            yield self.__handle
+    
+    @contextmanager
+    def __writable_file(self):
+        """
+        Context giving a handle on the file opened for writing, closed on exit. The persistent handle (if any)
+        is closed meanwhile, HDF5 does not open a file twice with different modes.
+        """
+        if self.__mode == 'r':
+            raise ValueError("{} is opened read only, create the DataFileReader with mode 'a' or 'w' to write"
+                             .format(self.__filename))
+        reopen = self.__handle is not None
+        self.close()
+        self.file_opens += 1
+        f = h5py.File(self.__filename, 'a')
+        try:
+            yield f
+        finally:
+            f.close()
+            if reopen:
+                self.open()
+
+    def __create_datasets(self, f, frequency, capacity, chunk_rows, filters):
+        """
+        Create the resizable datasets, chunked by whole measurements
+
+        Arguments:
+        f -- file handle : h5py.File
+        frequency -- frequencies of the impedance rows : 1D numpy array
+        capacity -- number of measurements allocated : int
+        chunk_rows -- number of measurements per chunk : int
+        filters -- compression arguments of create_dataset : dict
+        """
+        F = len(frequency)
+        # the 'existing' flags are a byte per measurement, their chunks hold more rows
+        f.create_dataset('existing', shape=(capacity,), maxshape=(None,), dtype=np.int8, fillvalue=0,
+                         chunks=(max(chunk_rows, 1024),), **filters)
+        f.create_dataset('impedance', shape=(capacity,3,F), maxshape=(None,3,F), dtype=np.float64,
+                         chunks=(chunk_rows,3,F), **filters)
+        f.create_dataset('rawdata', shape=(capacity,2,F), maxshape=(None,2,F), dtype=np.float64,
+                         chunks=(chunk_rows,2,F), **filters)
+        f.create_dataset('metadata', shape=(capacity,), maxshape=(None,), dtype=np.dtype(self.__metadata_dtypes),
+                         chunks=(chunk_rows,), **filters)
+        if capacity > 0:
+            f['impedance'][:,0,:] = frequency
+
+    def __get_filters(self, compression, compression_opts, shuffle):
+        """
+        Compression arguments of create_dataset
+
+        Arguments:
+        compression -- None, 'gzip', 'lzf' or 'lz4' : str
+        compression_opts -- gzip level : int
+        shuffle -- byte shuffle filter : bool
+
+        Returns:
+        keyword arguments : dict
+        """
+        filters = {'shuffle': bool(shuffle)}
+        if compression == 'lz4':
+            # lz4 is not built in HDF5, the filter is registered by hdf5plugin
+            try:
+                import hdf5plugin
+            except ImportError:
+                raise ValueError("the lz4 compression needs the hdf5plugin package")
+            filters.update(hdf5plugin.LZ4())
+        elif compression in ('gzip', 'lzf'):
+            filters['compression'] = compression
+            if compression_opts is not None:
+                filters['compression_opts'] = compression_opts
+        elif compression is not None:
+            raise ValueError("unknown compression {}, expected 'gzip', 'lzf' or 'lz4'".format(compression))
+        return filters
+
+    def __encode_metadata(self, metadata, dtype, n, first, is_reference):
+        """
+        Encode the metadata of new measurements in the compound type of the file, the labels that are not given
+        are filled as the acquisition tool does (description 'data k', UID, date and time, software version)
+
+        Arguments:
+        metadata -- metadata, see append_mesurements : dict, list of dict, structured numpy array or None
+        dtype -- metadata type of the file : numpy dtype
+        n -- number of measurements : int
+        first -- file index of the first measurement : int
+        is_reference -- the measurements are references : bool or 1D numpy array of bool
+
+        Returns:
+        raw metadata (n,) : structured numpy array
+        """
+        if isinstance(metadata, np.ndarray) and metadata.dtype == dtype:
+            return metadata
+
+        index = np.arange(first, first+n)
+        values = {
+            'Measurement description' : ["data {}".format(k+1) for k in index],
+            'Measurement UID' :         index,
+            'Date and time' :           datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+            'Software version' :        self.__settings['Software version'],
+            'Reference' :               is_reference
+        }
+        if isinstance(metadata, np.ndarray):
+            values.update({key: metadata[key] for key in metadata.dtype.names})
+        elif isinstance(metadata, (list, tuple)):
+            values.update({key: [mes[key] for mes in metadata] for key in metadata[0]})
+        elif metadata is not None:
+            values.update(metadata)
+
+        metadata_raw = np.zeros(n, dtype=dtype)
+        for meta_key, value in values.items():
+            if meta_key not in dtype.names:
+                raise ValueError("unknown metadata label {}".format(meta_key))
+            value = np.asarray(value)
+            if(self.__mes_metadata_keys[meta_key] == Dtype.string and value.dtype.kind in 'US'):
+                # null terminated utf-8 bytes, truncated to the field length
+                str_len = dtype[meta_key].shape[0]
+                chars = np.char.encode(np.broadcast_to(value, (n,)), 'utf-8').astype('S%d' % (str_len-1))
+                metadata_raw[meta_key][:,:str_len-1] = chars.view(np.int8).reshape(n, str_len-1)
+            elif(meta_key == 'Device UID' and value.ndim < 2):
+                uid = np.broadcast_to(value.astype(object), (n,))
+                metadata_raw[meta_key] = np.array([[(u >> 64) & 0xFFFFFFFF, (u >> 32) & 0xFFFFFFFF, u & 0xFFFFFFFF]
+                                                   for u in uid], dtype=np.uint32).view(np.int32)
+            else:
+                metadata_raw[meta_key] = value.reshape(n, -1) if value.size == n*dtype[meta_key].shape[0] else value
+        return metadata_raw
+
+    def __is_empty(self, f):
+        """
+        Returns:
+        True if the file has no measurement rows (no datasets yet or empty resizable datasets) : bool
+        """
+        return 'existing' not in f or f['existing'].shape[0] == 0
+
+    def __refresh(self):
+        """
+        Refresh the persistent handle and drop the cached 'existing' mask if the file changed on disk
+        """
+        stamp = self.__get_file_stamp()
+        if stamp == self.__stamp:
+            return
+        
+        if self.__swmr and list(self.__handle.keys()) != []:
+            # the writer keeps the file open, only pull the new dataset extents
+            for dset in self.__handle.values():
+                dset.refresh()
+        else:
+            # without SWMR the HDF5 metadata cache is stale, the file has to be reopened
+            self.__handle.close()
+            self.__handle = self.__open_file(persistent=True)
+        
+        self.__stamp = stamp
+        self.__existing_idx = None
+    
+    def __get_existing_index(self, f):
+        """
+        Get the file indexes of the existing measurements (cached while the persistent handle is up to date)
+        
+        Argument:
+        f -- file handle : h5py.File
+        
+        Returns:
+        indexes of the existing measurements : 1D numpy array
+        """
+        if self.__handle is None:
+            return np.flatnonzero(f['existing'][:])
+        if self.__existing_idx is None:
+            self.__existing_idx = np.flatnonzero(f['existing'][:])
+        return self.__existing_idx
+    
+    def __get_file_stamp(self):
+        st = os.stat(self.__filename)
+        return st.st_size, st.st_mtime_ns
\ No newline at end of file
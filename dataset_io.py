@@ -0,0 +1,274 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Columnar dataset format used for the training, validation and test sets.
+              A dataset is a folder with one .npy file per column (X features, Y labels) and a
+              manifest.json describing it (feature names, frequency indexes, source files, split).
+              The columns are loaded memory-mapped, so opening a dataset costs almost nothing, and can be
+              written by blocks of rows (DatasetWriter).
+
+Usage : python dataset_io.py convert FILE.pkl [FILE.pkl ...] [--out FOLDER]
+        python dataset_io.py info FOLDER [FOLDER ...]
+"""
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from features import DEFAULT_SPEC, feature_names
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+COLUMNS = ("X", "Y")
+
+
+def save_dataset(folder, X, Y, spec=DEFAULT_SPEC, **manifest):
+    """
+    Save a dataset, an existing dataset in the folder is replaced
+
+    Arguments:
+    folder -- folder of the dataset : str
+    X -- features, one row per measurement : 2D array like
+    Y -- labels : 1D array like
+    spec -- feature specification of X (FeatureExtractor.spec) : dict
+    manifest -- other values stored in the manifest (source_files, split, ...) : json values
+
+    Returns:
+    manifest : dict
+    """
+    X = np.ascontiguousarray(X)
+    Y = np.ascontiguousarray(Y)
+    if X.ndim != 2 or Y.ndim != 1 or len(X) != len(Y):
+        raise ValueError("X must be (N, n_features) and Y (N,), got {} and {}".format(X.shape, Y.shape))
+
+    manifest = make_manifest(len(X), {name: (a.dtype, a.shape) for name, a in zip(COLUMNS, (X, Y))}, spec,
+                             **manifest)
+
+    # written in a temporary folder swapped at the end, a reader never sees a half written dataset
+    tmp = make_temporary_folder(folder)
+    for name, a in zip(COLUMNS, (X, Y)):
+        np.save(os.path.join(tmp, name+".npy"), a)
+    write_manifest(tmp, manifest)
+    replace_folder(tmp, folder)
+    return manifest
+
+
+def load_dataset(folder, mmap=True):
+    """
+    Load a dataset
+
+    Arguments:
+    folder -- folder of the dataset : str
+    mmap -- memory-map the columns (read-only) instead of reading them : bool
+
+    Returns:
+    X : 2D numpy array
+    Y : 1D numpy array
+    """
+    manifest = load_manifest(folder)
+    X, Y = (np.load(os.path.join(folder, name+".npy"), mmap_mode='r' if mmap else None) for name in COLUMNS)
+    if len(X) != manifest['n_samples'] or len(Y) != manifest['n_samples']:
+        raise ValueError("{} : the columns do not match the manifest".format(folder))
+    return X, Y
+
+
+def load_manifest(folder):
+    """
+    Read the manifest of a dataset
+
+    Arguments:
+    folder -- folder of the dataset : str
+
+    Returns:
+    manifest : dict
+    """
+    with open(os.path.join(folder, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version', 0) > FORMAT_VERSION:
+        raise ValueError("{} : dataset format {} is not supported".format(folder, manifest['format_version']))
+    return manifest
+
+
+def convert_pickle(pkl_path, folder=None, **manifest):
+    """
+    Convert a pickled (X, Y) dataset, as written by the former createSets.py
+
+    Arguments:
+    pkl_path -- pickled dataset : str
+    folder -- folder of the converted dataset, the pickle path without extension if None : str
+    manifest -- other values stored in the manifest : json values
+
+    Returns:
+    folder of the converted dataset : str
+    """
+    if folder is None:
+        folder = os.path.splitext(pkl_path)[0]
+    with open(pkl_path, 'rb') as f:
+        X, Y = pickle.load(f)
+    # lists of rows are stacked in a single block
+    X = np.stack([np.asarray(x) for x in X]) if isinstance(X, (list, tuple)) else np.asarray(X)
+    Y = np.asarray(Y)
+    save_dataset(folder, X, Y, converted_from=os.path.basename(pkl_path), **manifest)
+    return folder
+
+
+def make_manifest(n_samples, columns, spec=DEFAULT_SPEC, **manifest):
+    """
+    Manifest of a dataset
+
+    Arguments:
+    n_samples -- number of rows : int
+    columns -- (dtype, shape) of the X and Y columns : dict
+    spec -- feature specification of X (FeatureExtractor.spec) : dict
+    manifest -- other values stored in the manifest (source_files, split, ...) : json values
+
+    Returns:
+    manifest : dict
+    """
+    n_features = int(columns['X'][1][1])
+    manifest = dict(manifest)
+    manifest.update({
+        'format_version': FORMAT_VERSION,
+        'n_samples': int(n_samples),
+        'n_features': n_features,
+        'columns': {name: {'dtype': str(np.dtype(dtype)), 'shape': [int(n) for n in shape]}
+                    for name, (dtype, shape) in columns.items()},
+        'feature_spec': spec,
+        'feature_names': feature_names(spec),
+    })
+    if len(manifest['feature_names']) != n_features:
+        raise ValueError("the feature specification does not match the {} columns of X".format(n_features))
+    return manifest
+
+
+def make_temporary_folder(folder):
+    # temporary folder next to the dataset folder (same file system, the rename is atomic)
+    parent = os.path.dirname(os.path.abspath(folder))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+
+
+def write_manifest(folder, manifest):
+    with open(os.path.join(folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.write("\n")
+
+
+def replace_folder(tmp, folder):
+    # swap the written dataset with the former one
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp, folder)
+
+
+class DatasetWriter:
+    """
+    Class to write a dataset by blocks of rows, without holding it in memory. The number of rows is given
+    beforehand, the columns are memory-mapped .npy files of a temporary folder swapped at close() :
+
+        with DatasetWriter(folder, n_samples, spec) as writer:
+            for X, Y in blocks:
+                writer.write(X, Y)
+    """
+
+    def __init__(self, folder, n_samples, spec=DEFAULT_SPEC, dtype=np.float64, y_dtype=np.int64, **manifest):
+        """
+        Constructor
+
+        Arguments:
+        folder -- folder of the dataset, an existing dataset is replaced at close() : str
+        n_samples -- number of rows : int
+        spec -- feature specification of X (FeatureExtractor.spec) : dict
+        dtype -- type of X : numpy dtype
+        y_dtype -- type of Y : numpy dtype
+        manifest -- other values stored in the manifest (source_files, ...) : json values
+        """
+        self.folder = folder
+        self.n_samples = int(n_samples)
+        self.n_written = 0
+        n_features = len(feature_names(spec))
+        columns = {'X': (dtype, (self.n_samples, n_features)), 'Y': (y_dtype, (self.n_samples,))}
+        self.manifest = make_manifest(self.n_samples, columns, spec, **manifest)
+        self.__tmp = make_temporary_folder(folder)
+        self.__X = np.lib.format.open_memmap(os.path.join(self.__tmp, "X.npy"), mode='w+', dtype=dtype,
+                                             shape=(self.n_samples, n_features))
+        self.__Y = np.lib.format.open_memmap(os.path.join(self.__tmp, "Y.npy"), mode='w+', dtype=y_dtype,
+                                             shape=(self.n_samples,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, X, Y):
+        """
+        Write the next rows
+
+        Arguments:
+        X -- features (n, n_features) : 2D array like
+        Y -- labels (n,) : 1D array like
+        """
+        n = len(X)
+        if len(Y) != n:
+            raise ValueError("X has {} rows and Y {}".format(n, len(Y)))
+        if self.n_written + n > self.n_samples:
+            raise ValueError("the dataset has {} rows, {} written".format(self.n_samples, self.n_written + n))
+        self.__X[self.n_written:self.n_written+n] = X
+        self.__Y[self.n_written:self.n_written+n] = Y
+        self.n_written += n
+
+    def close(self):
+        """
+        Write the manifest and move the dataset to its folder
+
+        Returns:
+        manifest : dict
+        """
+        if self.n_written != self.n_samples:
+            self.abort()
+            raise ValueError("{} rows written out of {}".format(self.n_written, self.n_samples))
+        self.__X.flush()
+        self.__Y.flush()
+        del self.__X, self.__Y
+        write_manifest(self.__tmp, self.manifest)
+        replace_folder(self.__tmp, self.folder)
+        return self.manifest
+
+    def abort(self):
+        # drop the temporary folder, the former dataset is kept
+        self.__X = self.__Y = None
+        shutil.rmtree(self.__tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Columnar datasets')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help='convert pickled datasets')
+    convert.add_argument('pkl_paths', nargs='+', type=str, help='pickled datasets')
+    convert.add_argument('--out', type=str, default=None, help='output folder (default: next to the pickles)')
+    info = subparsers.add_parser('info', help='describe datasets')
+    info.add_argument('folders', nargs='+', type=str, help='dataset folders')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        for path in args.pkl_paths:
+            folder = None
+            if args.out is not None:
+                folder = os.path.join(args.out, os.path.splitext(os.path.basename(path))[0])
+            print(path, "->", convert_pickle(path, folder))
+    else:
+        for folder in args.folders:
+            manifest = load_manifest(folder)
+            X, Y = load_dataset(folder)
+            labels, counts = np.unique(Y, return_counts=True)
+            print("{} : {} samples x {} features ({}), labels {}".format(
+                folder, manifest['n_samples'], manifest['n_features'], X.dtype,
+                dict(zip(labels.tolist(), counts.tolist()))))
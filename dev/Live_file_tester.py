@@ -1,16 +1,14 @@
 import os
 import numpy as np
 from datafilereader import DataFileReader
+from features import FeatureExtractor, LABELS
 import pickle
 import glob
 
 # Path to the data folder containing the live files
 folder_path = "./data/Live_files/" 
 
-# Set up features
-featureListR = [17, 20, 21, 22, 26, 28, 31, 32, 39, 42, 44, 71]
-featureListL = [4, 5, 6, 7, 8, 9, 10, 12, 61]
-labels = ["unknown", "5_CTS", "10_CTS", "20_CTS", "50_CTS", "1_CHF", "2_CHF", "5_CHF"]
+labels = LABELS
 
 # Load the pre-trained models
 with open("data/Tests/modelAn1.pkl", "rb") as f:
@@ -50,8 +48,6 @@ def process_files(folder_path):
         
         # Get all measured Z for this coin
         f, Z = dataset.get_all_mesurements()
-        R = np.real(Z)
-        L = np.imag(Z) / (2 * np.pi * f)
         
         # Get the calibration index
         C_idx = dataset.get_reference_impedance_index()
@@ -59,35 +55,24 @@ def process_files(folder_path):
             print(f"No reference measurement found in {file_path}")
             continue
         
-        R_cal = R[C_idx,:]
-        L_cal = L[C_idx,:]
+        # Calibrate with the reference measurement and remove it from the list of measurements
+        extractor = FeatureExtractor(f)
+        extractor.set_reference(Z[C_idx,:])
+        Z = np.delete(Z, C_idx, axis=0)
         
-        # Remove the calibration index from the list of measurements
-        R = np.delete(R, C_idx, axis=0)
-        L = np.delete(L, C_idx, axis=0)
-        
-        # Calibrate the coin measurements
-        R = R - R_cal
-        L = L - L_cal
         # Extract the needed features
-        R = R[:, featureListR]
-        L = L[:, featureListL]
-        
-        # Ensure no zero or near-zero values in L to avoid division by zero
-        L[L == 0] = np.nan  # Replace zero with NaN to handle safely
-        p = R[:,0:9] / L
+        features = extractor.transform(Z)
         
         # Collect results for each measurement
         results = []
         
         # Get the number of measurements after removing calibration
-        N = R.shape[0]
+        N = features.shape[0]
 
         for j in range(N):
-            # Concatenate the features
-            X = np.concatenate((R[j, :], L[j, :], p[j, :]), axis=0)
-            # Check for NaN values before prediction
-            if np.isnan(X).any():
+            X = features[j, :]
+            # Check for NaN values before prediction (a zero inductance gives a non finite ratio)
+            if not np.isfinite(X).all():
                 results.append(("Measurement {}".format(j), "Skipped due to NaN"))
                 continue
             
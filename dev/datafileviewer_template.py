@@ -2,7 +2,9 @@
 Cours :       MachLearn - Metal classifier project
 Created : 2024
 
-Description : Displaying the content of a data file containing impedance measurements
+Description : Displaying the content of a data file containing impedance measurements.
+              DataFileViewer draws every measurement as new lines, LiveDataFileViewer keeps the cost of an update
+              constant while the file grows (ring of the last measurements, density of the older ones, blitting).
 """
 
 import os
@@ -49,8 +51,8 @@ class DataFileViewer():
         
         """
         # get data
-        frequency,Z = self.dfr.get_all_mesurements()
-        ref_idx = self.dfr.get_reference_impedance_index()
+        frequency,Z,is_reference,self.cursor = self.dfr.read_since(0)
+        ref_idx = np.flatnonzero(is_reference) if is_reference.any() else None
         self.__plot_figure(frequency,Z,ref_idx)
 
         
@@ -67,8 +69,13 @@ class DataFileViewer():
         #print("Checking for changes : ,", haschanged, " at ", time.time())
         if haschanged:
             print("File has changed, updating plot")
-            frequency,Z,is_reference = self.dfr.get_last_mesurement()
-            ref_idx = 0 if is_reference else None # if the last measurement is a reference set the corresponding index 0
+            # read only the measurements added since the last update
+            frequency,Z,is_reference,cursor = self.dfr.read_since(self.cursor)
+            if cursor < self.cursor:
+                # the file has been rewritten, read it again from the beginning
+                frequency,Z,is_reference,cursor = self.dfr.read_since(0)
+            self.cursor = cursor
+            ref_idx = np.flatnonzero(is_reference) if is_reference.any() else None
             
             self.__plot_figure(frequency,Z,ref_idx)
             
@@ -159,4 +166,286 @@ class DataFileViewer():
         plots_axes['R'].set_title('Impedance vs Frequency')
         plt.pause(0.01)
 
-        return fig, plots_axes
\ No newline at end of file
+        return fig, plots_axes
+
+class LiveDataFileViewer():
+    """
+        Class to display a data file from the ISS while it is written, at a constant cost per update
+
+        The last ring_size measurements are lines whose data are replaced in place (the newest in red), the
+        last reference is dashed. They are blitted over a background holding the density image and the min/max
+        envelope of the older measurements, which is drawn again every background_every measurements leaving
+        the ring. Only the new rows are read from the file.
+    """
+
+    def __init__(self, file_path, ring_size=20, n_bins=128, background_every=None, update_interval=1000):
+        """
+            Constructor
+
+            Arguments:
+            file_path -- path and filename of the data file : str
+            ring_size -- number of measurements drawn as lines : int
+            n_bins -- number of value bins of the density image : int
+            background_every -- measurements leaving the ring between two draws of the background (ring_size if
+                                None) : int
+            update_interval -- update interval [ms] : int
+        """
+        # determine if the file is available
+        if not os.path.isfile(file_path):
+            raise ValueError("File does not exist")
+
+        # set the attributes
+        self.file_path = file_path
+        self.dfr = DataFileReader(file_path)
+        self.ring_size = ring_size
+        self.n_bins = n_bins
+        self.background_every = background_every or ring_size
+        self.cursor = 0
+        self.n_measurements = 0 # measurements received, references excluded
+        self.frequency = None
+
+        # create the figure, the artists are created with the first measurements (frequency vector)
+        self.fig, self.plots_axes = self.__create_figure()
+        self.__artists = None
+        self.__background = None
+        self.fig.canvas.mpl_connect('draw_event', self.__on_draw)
+        self.plot()
+
+        # canvas timer rather than FuncAnimation : with blit=True it takes a new background on new limits only
+        self.update_interval = update_interval
+        self.timer = self.fig.canvas.new_timer(interval=self.update_interval)
+        self.timer.add_callback(self.update_plot, None)
+        self.timer.start()
+
+    def plot(self):
+        """
+            Display the current content of the data file
+
+        """
+        self.cursor = 0
+        self.n_measurements = 0
+        self.__artists = None
+        for ax in self.plots_axes.values():
+            for artist in ax.lines + ax.images + ax.texts:
+                artist.remove()
+        self.__read()
+        self.fig.canvas.draw()
+
+    def update_plot(self, frame):
+        """
+            Update the figure if the file has changed
+
+            Arguments:
+            frame -- frame number : int
+
+            Returns:
+            True if the file has changed : bool
+        """
+        haschanged = self.dfr.has_file_changed()
+        if haschanged:
+            if self.__read() or self.__background is None:
+                self.fig.canvas.draw()
+            else:
+                self.__blit()
+        return haschanged
+
+    # ----------------- private methods -------------------------
+    def __read(self):
+        """
+            Read the measurements added since the last update and push them in the ring
+
+            Returns:
+            True if the background has to be drawn again : bool
+        """
+        frequency,Z,is_reference,cursor = self.dfr.read_since(self.cursor)
+        if cursor < self.cursor:
+            # the file has been rewritten, start again
+            self.plot()
+            return False
+        self.cursor = cursor
+        if len(Z) == 0:
+            return False
+
+        if self.__artists is None:
+            self.__create_artists(frequency, Z)
+        values = self.__to_values(Z)
+
+        # references are dashed, only the last one is kept
+        ref_idx = np.flatnonzero(is_reference)
+        if ref_idx.size > 0:
+            for key, line in self.__artists['reference'].items():
+                line.set_ydata(values[key][ref_idx[-1]])
+
+        new = {key: v[~is_reference] for key, v in values.items()}
+        self.n_measurements += len(new['R'])
+        redraw = self.__update_limits(values)
+
+        for key in self.plots_axes:
+            ring = np.concatenate([self.__ring[key], new[key]])
+            self.__add_to_background(key, ring[:-self.ring_size])
+            self.__ring[key] = ring[-self.ring_size:]
+            # the lines keep their style, the newest measurement is always in the last line
+            lines = self.__artists['ring'][key]
+            empty = len(lines) - len(self.__ring[key])
+            for line, y in zip(lines[empty:], self.__ring[key]):
+                line.set_ydata(y)
+
+        self.__artists['count']['R'].set_text('{} measurements'.format(self.n_measurements))
+        if self.__pending >= self.background_every:
+            self.__pending = 0
+            redraw = True
+        return redraw
+
+    def __to_values(self, Z):
+        """
+            Resistance [Ohm] and inductance [uH] of measurements
+
+            Arguments:
+            Z -- impedance array : np.array
+
+            Returns:
+            values of each axis : dict of 2D numpy arrays
+        """
+        return {'R': np.real(Z), 'L': np.imag(Z)/(2*np.pi*self.frequency)*1e6}
+
+    def __create_artists(self, frequency, Z):
+        """
+            Create the artists, their number does not depend on the number of measurements
+
+            Arguments:
+            frequency -- frequency array : np.array
+            Z -- first impedance measurements : np.array
+        """
+        self.frequency = frequency
+        values = self.__to_values(Z)
+        nan = np.full(len(frequency), np.nan)
+        self.__ring = {}
+        self.__density = {}
+        self.__envelope = {}
+        self.__pending = 0 # measurements added to the background since it was drawn
+        self.__artists = {'ring': {}, 'reference': {}, 'count': {}, 'low': {}, 'high': {}, 'density': {}}
+        for key, ax in self.plots_axes.items():
+            # value range of the density, with a margin for the next measurements
+            lo, hi = np.nanmin(values[key]), np.nanmax(values[key])
+            margin = 0.5*(hi - lo) if hi > lo else 1
+            self.__density[key] = (lo - margin, hi + margin, np.zeros((self.n_bins, len(frequency))))
+            self.__envelope[key] = (np.full(len(frequency), np.inf), np.full(len(frequency), -np.inf))
+            self.__ring[key] = np.empty((0, len(frequency)))
+
+            # background
+            self.__artists['density'][key] = ax.imshow(self.__density[key][2], origin='lower', aspect='auto',
+                                                      extent=(frequency[0], frequency[-1], lo - margin, hi + margin),
+                                                      cmap='Greys', interpolation='nearest', vmin=0, vmax=1)
+            self.__artists['low'][key], = ax.plot(frequency, nan, color='gray', linewidth=0.5)
+            self.__artists['high'][key], = ax.plot(frequency, nan, color='gray', linewidth=0.5)
+
+            # blitted
+            self.__artists['reference'][key], = ax.plot(frequency, nan, 'b--', animated=True)
+            self.__artists['ring'][key] = [ax.plot(frequency, nan, color='blue', linewidth=1, animated=True)[0]
+                                           for _ in range(self.ring_size - 1)]
+            self.__artists['ring'][key].append(ax.plot(frequency, nan, color='red', linewidth=2, animated=True)[0])
+            ax.set_xlim(frequency[0], frequency[-1])
+            ax.set_ylim(lo - margin, hi + margin)
+        ax = self.plots_axes['R']
+        self.__artists['count']['R'] = ax.text(0.01, 0.95, '', transform=ax.transAxes, verticalalignment='top',
+                                               animated=True)
+
+    def __update_limits(self, values):
+        """
+            Widen the y limits if new measurements are out of them
+
+            Arguments:
+            values -- values of each axis : dict of 2D numpy arrays
+
+            Returns:
+            True if a limit changed : bool
+        """
+        changed = False
+        for key, ax in self.plots_axes.items():
+            lo, hi = ax.get_ylim()
+            v_lo, v_hi = np.nanmin(values[key]), np.nanmax(values[key])
+            if v_lo < lo or v_hi > hi:
+                margin = 0.25*(max(hi, v_hi) - min(lo, v_lo))
+                ax.set_ylim(min(lo, v_lo - margin), max(hi, v_hi + margin))
+                changed = True
+        return changed
+
+    def __add_to_background(self, key, values):
+        """
+            Accumulate measurements leaving the ring in the density image and the envelope of an axis. Values
+            out of the range of the density are counted in its first or last bin.
+
+            Arguments:
+            key -- axis : str
+            values -- measurements (N, frequency) : 2D numpy array
+        """
+        if len(values) == 0:
+            return
+        lo, hi, density = self.__density[key]
+        rows = np.clip(((values - lo)/(hi - lo)*self.n_bins).astype(np.intp), 0, self.n_bins - 1)
+        cols = np.broadcast_to(np.arange(density.shape[1]), rows.shape)
+        density += np.bincount((rows*density.shape[1] + cols).ravel(),
+                               minlength=density.size).reshape(density.shape)
+        image = np.log1p(density)
+        self.__artists['density'][key].set_data(image)
+        self.__artists['density'][key].set_clim(0, max(image.max(), 1))
+
+        low, high = self.__envelope[key]
+        np.fmin(low, np.nanmin(values, axis=0), out=low)
+        np.fmax(high, np.nanmax(values, axis=0), out=high)
+        self.__artists['low'][key].set_ydata(low)
+        self.__artists['high'][key].set_ydata(high)
+        if key == 'R':
+            self.__pending += len(values)
+
+    def __get_animated(self):
+        """
+            Returns:
+            the artists drawn over the background : list of matplotlib artists
+        """
+        if self.__artists is None:
+            return []
+        artists = []
+        for group in ('reference', 'ring', 'count'):
+            for value in self.__artists[group].values():
+                artists += value if isinstance(value, list) else [value]
+        return artists
+
+    def __on_draw(self, event):
+        """
+            Keep the background after a draw of the figure (first draw, resize, new limits) and draw the
+            measurements over it
+
+            Arguments:
+            event -- draw event : matplotlib.backend_bases.DrawEvent
+        """
+        self.__background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.__get_animated():
+            self.fig.draw_artist(artist)
+
+    def __blit(self):
+        """
+            Draw the measurements over the background, the rest of the figure is not drawn again
+
+        """
+        self.fig.canvas.restore_region(self.__background)
+        for artist in self.__get_animated():
+            self.fig.draw_artist(artist)
+        self.fig.canvas.blit(self.fig.bbox)
+        self.fig.canvas.flush_events()
+
+    def __create_figure(self):
+        """
+            Create the figure
+
+        """
+        plt.show(block=False) # Display the plot window in non-blocking mode
+        fig, ax = plt.subplots(2, 1, figsize=(10, 8))
+        plots_axes = {'R': ax[0], 'L': ax[1]}
+        plots_axes['L'].set_xlabel('Frequency (Hz)')
+        plots_axes['R'].set_ylabel('R [Ohm]')
+        plots_axes['L'].set_ylabel('L [uH]')
+        plots_axes['R'].set_title('Impedance vs Frequency')
+        plt.pause(0.01)
+
+        return fig, plots_axes
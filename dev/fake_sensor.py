@@ -0,0 +1,164 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Emulation of the ISS acquisition tool, to run the live tools without the device.
+              The measurements of an existing data file are written again, one by one, in a new file.
+
+Usage : python -m dev.fake_sensor [--interval SECONDS] [--bundle FOLDER] SOURCE [SOURCE ...]
+        runs the multi-sensor live service on one fake sensor per source file
+        python -m dev.fake_sensor --live-test [--interval SECONDS] [--bundle FOLDER] SOURCE
+        runs liveTest on one fake sensor (the file is reopened in 'a' mode for each measurement, as the ISS
+        tool does, while the reader of liveTest keeps it open)
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import h5py
+import live_service
+import tester_functions
+from model_bundle import DEFAULT_BUNDLE
+from svm_inference import load_predictors
+
+
+class FakeSensorWriter:
+    """
+    Class to append the measurements of a source file to a new data file, as the ISS tool does
+    (the datasets are preallocated and the 'existing' flags are set one by one)
+
+    """
+
+    def __init__(self, source, file_path):
+        """
+        Constructor
+
+        Arguments:
+        source -- data file containing the measurements to replay : str
+        file_path -- data file to create : str
+        """
+        self.source = source
+        self.file_path = file_path
+
+        shutil.copyfile(source, file_path)
+        with h5py.File(file_path, 'a') as f:
+            self.n_available = int(f['existing'][:].sum())
+            self.__rows = [n for n in range(len(f['existing'])) if f['existing'][n]]
+            f['existing'][:] = 0
+        self.n_written = 0
+
+    def append(self, n=1, retries=50):
+        """
+        Append the next measurements of the source file
+
+        Arguments:
+        n -- number of measurements to append : int
+        retries -- number of retries while the file is locked by a reader : int
+
+        Returns:
+        number of measurements appended : int
+        """
+        rows = self.__rows[self.n_written:self.n_written+n]
+        for attempt in range(retries):
+            try:
+                with h5py.File(self.file_path, 'a') as f:
+                    for row in rows:
+                        f['existing'][row] = 1
+                break
+            except OSError:
+                if attempt == retries - 1:
+                    raise
+                time.sleep(0.01)
+        # only counted once written, a failed append is replayed by the next call
+        self.n_written += len(rows)
+        return len(rows)
+
+    def run(self, interval=1.0, count=None, delay=0.0):
+        """
+        Append the measurements one by one at a fixed rate
+
+        Arguments:
+        interval -- time between two measurements [s] : float
+        count -- number of measurements to append (all if None) : int
+        delay -- time before the first measurement [s] : float
+        """
+        count = self.n_available if count is None else min(count, self.n_available)
+        time.sleep(delay)
+        while self.n_written < count:
+            time.sleep(interval)
+            self.append()
+
+
+async def run_demo(sources, interval, bundle_path=DEFAULT_BUNDLE):
+    """
+    Run the live service on one fake sensor per source file until all the measurements are replayed
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        writers = [FakeSensorWriter(source, os.path.join(tmp_dir, f"sensor{n}.h5")) for n, source in enumerate(sources)]
+        # same models, features and scaling as live_service.main
+        SVM, SVMO, bundle = load_predictors(bundle_path)
+        service = live_service.LiveClassificationService(
+            {f"sensor{n}": writer.file_path for n, writer in enumerate(writers)}, SVM, SVMO, bundle.labels,
+            spec=bundle.feature_spec, scale=bundle.scale)
+        printer = asyncio.ensure_future(live_service.print_events(service))
+
+        processes = [multiprocessing.Process(target=writer.run, args=(interval,)) for writer in writers]
+        for process in processes:
+            process.start()
+
+        running = asyncio.ensure_future(service.run())
+        while any(process.is_alive() for process in processes):
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(2*service.poll_timeout) # let the service catch up
+        service.stop()
+        await running
+        printer.cancel()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run_live_test(source, interval, bundle_path=DEFAULT_BUNDLE, delay=3.0):
+    """
+    Run liveTest on one fake sensor until all the measurements of the source file are replayed
+
+    Arguments:
+    source -- data file containing the measurements to replay : str
+    interval -- time between two measurements [s] : float
+    bundle_path -- folder of the model bundle : str
+    delay -- time given to liveTest to load the models before the first measurement [s] : float
+
+    Returns:
+    True if every measurement was appended while liveTest was reading the file : bool
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        writer = FakeSensorWriter(source, os.path.join(tmp_dir, "sensor0.h5"))
+        # the writer raises (non-zero exit code) when the file stays locked after its retries
+        process = multiprocessing.Process(target=writer.run, args=(interval, None, delay))
+        process.start()
+        tester_functions.liveTest(writer.file_path, bundle_path, idle_timeout=delay + 10*interval + 1)
+        process.join()
+        return process.exitcode == 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the live service on fake sensors')
+    parser.add_argument('sources', nargs='*', type=str, help='data files to replay',
+                        default=["./data/Live_files/test_set_1.h5", "./data/Live_files/test_set_2.h5",
+                                 "./data/Live_files/test_set_3.h5"])
+    parser.add_argument('--interval', type=float, default=0.05, help='time between two measurements [s]')
+    parser.add_argument('--live-test', action='store_true', help='run liveTest on the first source file')
+    parser.add_argument('--bundle', type=str, default=DEFAULT_BUNDLE, help='model bundle folder')
+    args = parser.parse_args()
+    if args.live_test:
+        ok = run_live_test(args.sources[0], args.interval, args.bundle)
+        print("all the measurements appended" if ok else "the writer could not append (file locked)")
+    else:
+        asyncio.run(run_demo(args.sources, args.interval, args.bundle))
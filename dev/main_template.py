@@ -8,7 +8,7 @@ import os
 import os.path
 import argparse
 import matplotlib.pyplot as plt
-from dev.datafileviewer_template import DataFileViewer
+from dev.datafileviewer_template import DataFileViewer, LiveDataFileViewer
 import matplotlib
 
 if __name__ == "__main__":
@@ -18,6 +18,8 @@ if __name__ == "__main__":
     # create the parser
     parser = argparse.ArgumentParser(description='Display the impedance data from a file')
     parser.add_argument('--file_path',nargs='?', type=str, help='path to the file to display')
+    parser.add_argument('--live', type=int, default=0, metavar='N',
+                        help='constant cost viewer keeping the last N measurements as lines (0 : every measurement)')
     args = parser.parse_args()
     file_path = args.file_path
 
@@ -34,7 +36,10 @@ if __name__ == "__main__":
         raise ValueError("File does not exist")
     
     # Start the viewer to display the content of the file
-    imdisp = DataFileViewer(file_path)
+    if args.live > 0:
+        imdisp = LiveDataFileViewer(file_path, ring_size=args.live)
+    else:
+        imdisp = DataFileViewer(file_path)
     plt.show() # Display the figure and keep it open
 
     
@@ -0,0 +1,217 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : On-disk cache of the R/L matrices and features extracted from the data files.
+              Entries are keyed by the path, size, modification time and number of measurements of the data
+              file (and by the feature specification), stored as .npy files loaded memory-mapped, and evicted
+              least recently used first. get_cache gives one cache per folder and per process.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import h5py
+import numpy as np
+from datafilereader import DataFileReader
+from features import FeatureExtractor, DEFAULT_SPEC
+
+CACHE_VERSION = 2 # to be incremented when the cached computations change
+DEFAULT_CACHE_DIR = os.environ.get("FEATURE_CACHE_DIR", "./.feature_cache")
+DEFAULT_MAX_BYTES = 512*2**20
+
+
+class FeatureCache:
+    """
+    Class to cache the values computed from the data files
+
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Constructor
+
+        Arguments:
+        cache_dir -- folder of the cache : str
+        max_bytes -- maximum size of the cache, the least recently used entries are evicted above it : int
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # --- public methods
+    def file_key(self, file_path):
+        """
+        Key of a data file : its path, size, modification time and number of existing measurements.
+        The file is not hashed, hashing it costs more than reading the measurements again.
+
+        Arguments:
+        file_path -- data file : str
+
+        Returns:
+        key : list
+        """
+        st = os.stat(file_path)
+        with h5py.File(file_path, 'r') as f:
+            n_measurements = int(np.count_nonzero(f['existing'][:])) if 'existing' in f else 0
+        return [os.path.abspath(file_path), st.st_size, st.st_mtime_ns, n_measurements]
+
+    def get_measurements(self, file_path):
+        """
+        Get the frequency, resistance and inductance of all the measurements of a file (not calibrated)
+
+        Arguments:
+        file_path -- data file : str
+
+        Returns:
+        frequency : 1D numpy array
+        R : 2D numpy array (measurement, frequency)
+        L : 2D numpy array (measurement, frequency)
+        is_reference : 1D numpy array of bool
+        """
+        def compute():
+            frequency,Z,is_reference,_ = DataFileReader(file_path).read_since(0)
+            return {'frequency': frequency, 'R': np.real(Z), 'L': np.imag(Z)/(2*np.pi*frequency),
+                    'is_reference': is_reference}
+
+        entry = self.__get(self.__key(self.file_key(file_path), 'measurements'), compute)
+        return entry['frequency'], entry['R'], entry['L'], entry['is_reference']
+
+    def get_features(self, file_path, spec=None):
+        """
+        Get the features of all the measurements of a coin file, calibrated by its first measurement
+        (as done to create the datasets)
+
+        Arguments:
+        file_path -- coin data file : str
+        spec -- feature specification (FeatureExtractor.spec), default one if None : dict
+
+        Returns:
+        features, one row per measurement but the first one : 2D numpy array
+        """
+        spec = DEFAULT_SPEC if spec is None else spec
+
+        def compute():
+            frequency,Z = DataFileReader(file_path).get_all_mesurements()
+            extractor = FeatureExtractor(frequency, **spec)
+            extractor.set_reference(Z[0])
+            return {'features': extractor.transform(Z[1:]), 'spec': extractor.spec}
+
+        entry = self.__get(self.__key(self.file_key(file_path), 'features', spec), compute)
+        return entry['features']
+
+    def size(self):
+        """
+        Returns:
+        total size of the cache entries [bytes] : int
+        """
+        return sum(size for _,size,_ in self.__entries())
+
+    def clear(self):
+        """
+        Remove all the entries
+        """
+        for path,_,_ in self.__entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+    # --- private methods
+    def __key(self, *parts):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([CACHE_VERSION] + list(parts)).encode('utf-8'))
+        return h.hexdigest()
+
+    def __get(self, key, compute):
+        """
+        Load an entry, or compute and store it
+
+        Arguments:
+        key -- entry key : str
+        compute -- function returning the entry as a dict of numpy arrays (and json values) : callable
+
+        Returns:
+        entry, arrays are memory-mapped : dict
+        """
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(path):
+            try:
+                entry = self.__load(path)
+                os.utime(path) # last use, for the eviction
+                self.hits += 1
+                return entry
+            except (OSError, ValueError):
+                shutil.rmtree(path, ignore_errors=True) # incomplete entry
+
+        self.misses += 1
+        entry = compute()
+        self.__store(path, entry)
+        self.__evict()
+        return entry
+
+    def __load(self, path):
+        with open(os.path.join(path, 'entry.json')) as f:
+            entry = json.load(f)
+        for name in entry.pop('arrays'):
+            entry[name] = np.load(os.path.join(path, name+'.npy'), mmap_mode='r')
+        return entry
+
+    def __store(self, path, entry):
+        # written in a temporary folder renamed at the end, so that concurrent writers never see partial entries
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        arrays = [name for name, value in entry.items() if isinstance(value, np.ndarray)]
+        for name in arrays:
+            np.save(os.path.join(tmp, name+'.npy'), entry[name])
+        values = {name: value for name, value in entry.items() if name not in arrays}
+        values['arrays'] = arrays
+        with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+            json.dump(values, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True) # stored meanwhile by another process
+
+    def __entries(self):
+        """
+        Returns:
+        (path, size, last use) of each entry : list of tuple
+        """
+        entries = []
+        for item in os.scandir(self.cache_dir):
+            if item.is_dir() and not item.name.startswith('.'):
+                size = sum(f.stat().st_size for f in os.scandir(item.path))
+                entries.append((item.path, size, item.stat().st_mtime))
+        return entries
+
+    def __evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        """
+        entries = sorted(self.__entries(), key=lambda entry: entry[2])
+        total = sum(size for _,size,_ in entries)
+        for path,size,_ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+_caches = {} # cache of each folder, in this process
+
+
+def get_cache(cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Cache of a folder, created once per process
+
+    Arguments:
+    cache_dir -- folder of the cache : str
+
+    Returns:
+    cache : FeatureCache
+    """
+    key = os.path.abspath(cache_dir)
+    if key not in _caches:
+        _caches[key] = FeatureCache(cache_dir)
+    return _caches[key]
@@ -0,0 +1,306 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Data-driven selection of the frequency bins used as features. The calibrated measurements of the
+              coins are stacked in a (class, measurement, candidate) tensor, the candidates being R(f), L(f) and
+              R(f)/L(f) on every frequency bin of the band, and the separation of every pair of classes is
+              computed on every candidate at once (Fisher ratio or mutual information). Bins are then added
+              greedily, each one for the pairs of coins it separates better than the bins already chosen, until
+              the budget of features is spent.
+
+              The chosen bins are written as a feature specification (features.save_spec), used by createSets.py
+              (--spec) for the training sets and stored in the model bundle (model_bundle.py build --spec) for
+              the live inference.
+
+Usage : python feature_selection.py [--folders FOLDER ...] [--budget N] [--score fisher|mi] [--kinds R L R/L]
+                                    [--out FILE] [--evaluate] [--no-cache]
+"""
+
+import argparse
+import time
+import numpy as np
+from createSets import DEFAULT_FOLDERS, discover_files
+from datafilereader import DataFileReader
+from feature_cache import DEFAULT_CACHE_DIR, get_cache
+from features import DEFAULT_SPEC, LABELS, feature_names, save_spec
+
+KINDS = ("R", "L", "R/L")
+SCORES = ("fisher", "mi")
+DEFAULT_BUDGET = 30 # number of features of DEFAULT_SPEC
+DEFAULT_OUT = "models/feature_spec.json"
+MI_LEVELS = 16 # quantization levels of the values for the mutual information
+
+
+def load_classes(folders=DEFAULT_FOLDERS, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Calibrated resistance and inductance of the coin files, stacked by class. The first measurement of each file
+    is its calibration, as for the training sets.
+
+    Arguments:
+    folders -- folders containing the coin files : list of str
+    cache_dir -- feature cache folder, None to always read the files : str
+
+    Returns:
+    frequency [Hz] : 1D numpy array
+    R [Ohm] and L [H] (class, measurement, frequency), padded with NaN : tuple of 3D numpy arrays
+    labels of the classes : 1D numpy array of int
+    """
+    by_label = {}
+    for path, label in discover_files(folders):
+        if cache_dir is not None:
+            frequency, R, L, _ = get_cache(cache_dir).get_measurements(path)
+        else:
+            frequency, Z = DataFileReader(path).get_all_mesurements()
+            R, L = np.real(Z), np.imag(Z)/(2*np.pi*frequency)
+        by_label.setdefault(label, []).append((R[1:] - R[0], L[1:] - L[0]))
+
+    labels = np.array(sorted(by_label))
+    counts = [sum(len(R) for R, _ in by_label[label]) for label in labels]
+    R_all = np.full((len(labels), max(counts), len(frequency)), np.nan)
+    L_all = np.full_like(R_all, np.nan)
+    for c, label in enumerate(labels):
+        R_all[c, :counts[c]] = np.concatenate([R for R, _ in by_label[label]])
+        L_all[c, :counts[c]] = np.concatenate([L for _, L in by_label[label]])
+    return frequency, (R_all, L_all), labels
+
+
+def candidates(R, L, kinds=KINDS):
+    """
+    Candidate features : the values of each kind on every frequency bin
+
+    Arguments:
+    R -- resistance (class, measurement, frequency) : 3D numpy array
+    L -- inductance (class, measurement, frequency) : 3D numpy array
+    kinds -- kinds of candidates among 'R', 'L' and 'R/L' : tuple of str
+
+    Returns:
+    values (class, measurement, candidate) : 3D numpy array
+    (kind, frequency index) of each candidate : list of tuple
+    """
+    values = {'R': lambda: R, 'L': lambda: L}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values['R/L'] = lambda: np.where(np.isfinite(R/L), R/L, np.nan)
+        V = np.concatenate([values[kind]() for kind in kinds], axis=2)
+    index = [(kind, i) for kind in kinds for i in range(R.shape[2])]
+    return V, index
+
+
+def class_pairs(n_classes):
+    """
+    Arguments:
+    n_classes -- number of classes : int
+
+    Returns:
+    first and second class of every pair : tuple of 1D numpy arrays
+    """
+    return np.triu_indices(n_classes, k=1)
+
+
+def fisher_separation(V):
+    """
+    Fisher ratio of every pair of classes on every candidate, (mean_i - mean_j)^2 / (var_i + var_j)
+
+    Arguments:
+    V -- values (class, measurement, candidate), NaN for missing measurements : 3D numpy array
+
+    Returns:
+    separation (pair, candidate) : 2D numpy array
+    """
+    mean = np.nanmean(V, axis=1)
+    var = np.nanvar(V, axis=1)
+    i, j = class_pairs(V.shape[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S = (mean[i] - mean[j])**2/(var[i] + var[j])
+    return np.nan_to_num(S, nan=0.0, posinf=0.0)
+
+
+def mi_separation(V, levels=MI_LEVELS):
+    """
+    Mutual information [bit] between the class and the quantized value, for every pair of classes (the
+    measurements of the two classes only) on every candidate. The values are quantized on the quantiles of all
+    the classes.
+
+    Arguments:
+    V -- values (class, measurement, candidate), NaN for missing measurements : 3D numpy array
+    levels -- number of quantization levels : int
+
+    Returns:
+    separation (pair, candidate) : 2D numpy array
+    """
+    C, M, K = V.shape
+    # quantile level of every value, the missing values are ranked last and left out
+    flat = V.reshape(C*M, K)
+    valid = ~np.isnan(flat)
+    ranks = np.argsort(np.argsort(np.where(valid, flat, np.inf), axis=0), axis=0)
+    q = np.minimum(ranks*levels//np.maximum(valid.sum(axis=0), 1), levels - 1)
+
+    # counts (class, candidate, level) in one bincount
+    c = np.repeat(np.arange(C), M)[:, None]
+    k = np.arange(K)[None, :]
+    codes = ((c*K + k)*levels + q)[valid]
+    n = np.bincount(codes, minlength=C*K*levels).reshape(C, K, levels).astype(np.float64)
+
+    i, j = class_pairs(C)
+    n_pair = n[i] + n[j]                          # (pair, candidate, level)
+    total = n_pair.sum(axis=2, keepdims=True)
+    mi = np.zeros(n_pair.shape[:2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for n_c in (n[i], n[j]):
+            p_cq = n_c/total
+            p_c = n_c.sum(axis=2, keepdims=True)/total
+            p_q = n_pair/total
+            mi += np.nansum(np.where(p_cq > 0, p_cq*np.log2(p_cq/(p_c*p_q)), 0), axis=2)
+    return mi
+
+
+def select_bins(S, index, budget=DEFAULT_BUDGET):
+    """
+    Greedy selection of the candidates : each step adds the candidate with the largest gain per new feature, the
+    gain being the increase of sum over the pairs of log(1 + best separation of the pair). A pair separated
+    already gains little, so the bins spread over the pairs that are hard to tell apart. An R/L candidate also
+    adds the R and L features of its bin, as the ratio features are computed from them.
+
+    Arguments:
+    S -- separation (pair, candidate) : 2D numpy array
+    index -- (kind, frequency index) of each candidate : list of tuple
+    budget -- maximum number of features : int
+
+    Returns:
+    feature specification : dict
+    """
+    column = {key: k for k, key in enumerate(index)}
+    chosen = {kind: [] for kind in KINDS}
+    coverage = np.zeros(S.shape[0])
+    n_features = 0
+
+    while True:
+        best, best_gain = None, 0.0
+        # separation and cost of every candidate with the features it brings along
+        for k, (kind, i) in enumerate(index):
+            if i in chosen[kind]:
+                continue
+            brought = [(kind, i)]
+            if kind == "R/L":
+                brought += [(other, i) for other in ("R", "L") if i not in chosen[other]]
+            cost = len(brought)
+            if n_features + cost > budget:
+                continue
+            separation = np.max([S[:, column[key]] for key in brought if key in column], axis=0)
+            gain = np.sum(np.log1p(np.maximum(coverage, separation)) - np.log1p(coverage))/cost
+            if gain > best_gain:
+                best, best_gain = (brought, separation), gain
+        if best is None:
+            break
+        brought, separation = best
+        for kind, i in brought:
+            chosen[kind].append(i)
+        coverage = np.maximum(coverage, separation)
+        n_features += len(brought)
+
+    # the ratio bins come first in both lists, n_ratio features R[k]/L[k] are computed from them
+    ratio = chosen["R/L"]
+    return {'featureListR': ratio + [i for i in chosen["R"] if i not in ratio],
+            'featureListL': ratio + [i for i in chosen["L"] if i not in ratio],
+            'n_ratio': len(ratio)}
+
+
+def spec_features(spec, R, L):
+    """
+    Features of a specification, computed on the calibrated values (as FeatureExtractor.transform)
+
+    Arguments:
+    spec -- feature specification : dict
+    R -- resistance (class, measurement, frequency) : 3D numpy array
+    L -- inductance (class, measurement, frequency) : 3D numpy array
+
+    Returns:
+    features (class, measurement, feature) : 3D numpy array
+    """
+    R_f = R[..., spec['featureListR']]
+    L_f = L[..., spec['featureListL']]
+    n = spec['n_ratio']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.concatenate([R_f, L_f, R_f[..., :n]/L_f[..., :n]], axis=2)
+
+
+def worst_pairs(S, labels, n=3):
+    """
+    Pairs of classes the least separated by a set of features
+
+    Arguments:
+    S -- separation (pair, feature) : 2D numpy array
+    labels -- labels of the classes : 1D numpy array
+    n -- number of pairs : int
+
+    Returns:
+    (class name, class name, best separation) of the n worst pairs : list of tuple
+    """
+    i, j = class_pairs(len(labels))
+    best = S.max(axis=1)
+    return [(LABELS[labels[i[p]]], LABELS[labels[j[p]]], float(best[p])) for p in np.argsort(best)[:n]]
+
+
+def cross_val_accuracy(spec, R, L, labels, folds=5):
+    """
+    Cross-validated accuracy of an RBF SVM (standardized features) trained on a feature specification
+
+    Arguments:
+    spec -- feature specification : dict
+    R -- resistance (class, measurement, frequency) : 3D numpy array
+    L -- inductance (class, measurement, frequency) : 3D numpy array
+    labels -- labels of the classes : 1D numpy array
+    folds -- number of folds : int
+
+    Returns:
+    mean accuracy : float
+    """
+    from sklearn.model_selection import StratifiedKFold, cross_val_score
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.svm import SVC
+
+    X = spec_features(spec, R, L)
+    Y = np.broadcast_to(labels[:, None], X.shape[:2])
+    keep = ~np.isnan(R[..., 0]) & np.all(np.isfinite(X), axis=2)
+    model = make_pipeline(StandardScaler(), SVC(kernel='rbf'))
+    cv = StratifiedKFold(folds, shuffle=True, random_state=42)
+    return float(np.mean(cross_val_score(model, X[keep], Y[keep], cv=cv)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Select the frequency bins used as features')
+    parser.add_argument('--folders', nargs='+', type=str, default=DEFAULT_FOLDERS, help='folders of the coin files')
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET, help='maximum number of features')
+    parser.add_argument('--score', type=str, default='fisher', choices=SCORES, help='separation of two classes')
+    parser.add_argument('--kinds', nargs='+', type=str, default=list(KINDS), choices=KINDS, help='candidates')
+    parser.add_argument('--out', type=str, default=DEFAULT_OUT, help='feature specification JSON')
+    parser.add_argument('--evaluate', action='store_true', help='cross-validated SVM accuracy of both specs')
+    parser.add_argument('--no-cache', action='store_true', help='always read the data files')
+    args = parser.parse_args()
+
+    frequency, (R, L), labels = load_classes(args.folders, None if args.no_cache else DEFAULT_CACHE_DIR)
+    print("{} classes, {} measurements, {} frequency bins".format(len(labels), np.sum(~np.isnan(R[..., 0])),
+                                                                  len(frequency)))
+
+    t0 = time.perf_counter()
+    separation = fisher_separation if args.score == 'fisher' else mi_separation
+    V, index = candidates(R, L, tuple(args.kinds))
+    S = separation(V)
+    spec = select_bins(S, index, args.budget)
+    t = time.perf_counter() - t0
+    print("{} separation of {} pairs on {} candidates and selection in {:.1f} ms".format(
+        args.score, S.shape[0], S.shape[1], t*1e3))
+
+    for name, s in [("default", DEFAULT_SPEC), ("selected", spec)]:
+        S_spec = separation(spec_features(s, R, L))
+        print("{:<9} {:>3} features, least separated pairs {}".format(name, len(feature_names(s)), ", ".join(
+            "{}/{} {:.2f}".format(*pair) for pair in worst_pairs(S_spec, labels))))
+        if args.evaluate:
+            print("{:<9} cross-validated accuracy {:.3f}".format("", cross_val_accuracy(s, R, L, labels)))
+
+    save_spec(args.out, spec, selection={'score': args.score, 'budget': args.budget, 'kinds': args.kinds,
+                                         'folders': args.folders,
+                                         'frequencies': [float(frequency[i]) for i in spec['featureListR']]})
+    print("R bins {}\nL bins {}\nn_ratio {}\nspecification saved in {}".format(
+        spec['featureListR'], spec['featureListL'], spec['n_ratio'], args.out))
@@ -0,0 +1,212 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Feature extraction shared by the training set creation, the file tester and the live tester
+"""
+
+import json
+import numpy as np
+
+# coin classes, index = label used by the classifier
+LABELS = ["unknown", "5_CTS", "10_CTS", "20_CTS", "50_CTS", "1_CHF", "2_CHF", "5_CHF"]
+
+# frequency indexes (of the frequency vector limited by DataFileReader) used as features
+FEATURE_LIST_R = [17, 20, 21, 22, 26, 28, 31, 32, 39, 42, 44, 71]
+FEATURE_LIST_L = [4, 5, 6, 7, 8, 9, 10, 12, 61]
+N_RATIO = 9 # number of R/L ratios : p = R[0:N_RATIO]/L
+DEFAULT_SPEC = {'featureListR': FEATURE_LIST_R, 'featureListL': FEATURE_LIST_L, 'n_ratio': N_RATIO}
+
+
+def feature_names(spec=DEFAULT_SPEC):
+    """
+    Names of the features, in the order of the feature vector
+
+    Arguments:
+    spec -- feature specification : dict
+
+    Returns:
+    names : list of str
+    """
+    R = spec['featureListR']
+    L = spec['featureListL']
+    return ([f"R[{i}]" for i in R] + [f"L[{i}]" for i in L] +
+            [f"R[{i}]/L[{j}]" for i,j in zip(R[:spec['n_ratio']], L[:spec['n_ratio']])])
+
+
+def save_spec(path, spec, **info):
+    """
+    Save a feature specification in a JSON file, read back by load_spec (training sets, model bundles)
+
+    Arguments:
+    path -- JSON file : str
+    spec -- feature specification : dict
+    info -- other values stored with it (how it was selected, ...) : json values
+    """
+    spec = {'featureListR': [int(i) for i in spec['featureListR']],
+            'featureListL': [int(i) for i in spec['featureListL']], 'n_ratio': int(spec['n_ratio'])}
+    feature_names(spec) # checks the keys
+    with open(path, 'w') as f:
+        json.dump(dict(info, feature_spec=spec), f, indent=1)
+        f.write("\n")
+
+
+def load_spec(path=None):
+    """
+    Load a feature specification from a JSON file with a 'feature_spec' entry : a file written by save_spec,
+    the manifest of a dataset or of a model bundle
+
+    Arguments:
+    path -- JSON file, None for the default specification : str
+
+    Returns:
+    feature specification : dict
+    """
+    if path is None:
+        return DEFAULT_SPEC
+    with open(path) as f:
+        spec = json.load(f)['feature_spec']
+    if spec['n_ratio'] > min(len(spec['featureListR']), len(spec['featureListL'])):
+        raise ValueError("{} : n_ratio can not be larger than the number of R or L features".format(path))
+    return spec
+
+
+def feature_bins(spec=DEFAULT_SPEC):
+    """
+    Frequency indexes used by the features, the only columns to read (DataFileReader.read_band)
+
+    Arguments:
+    spec -- feature specification : dict
+
+    Returns:
+    sorted frequency indexes : list of int
+    """
+    return sorted(set(spec['featureListR']) | set(spec['featureListL']))
+
+
+def spec_on_bins(spec, bins):
+    """
+    Feature specification for impedance read on some frequency indexes only
+
+    Arguments:
+    spec -- feature specification : dict
+    bins -- sorted frequency indexes of the columns read, they contain feature_bins(spec) : list of int
+
+    Returns:
+    feature specification indexing the columns read : dict
+    """
+    bins = np.asarray(bins)
+    position = lambda indexes: np.searchsorted(bins, indexes).tolist()
+    return dict(spec, featureListR=position(spec['featureListR']), featureListL=position(spec['featureListL']))
+
+
+class FeatureExtractor:
+    """
+    Class to compute the features [R, L, R/L] of calibrated impedance measurements
+
+    Only the selected frequency bins are read from the impedance, and the 2*pi*f divisor is
+    computed once. Works on a single spectrum (F,) or on a batch (N, F).
+    """
+
+    def __init__(self, frequency, featureListR=FEATURE_LIST_R, featureListL=FEATURE_LIST_L, n_ratio=N_RATIO):
+        """
+        Constructor
+
+        Arguments:
+        frequency -- frequency vector of the measurements : 1D numpy array
+        featureListR -- frequency indexes of the resistance features : list of int
+        featureListL -- frequency indexes of the inductance features : list of int
+        n_ratio -- number of R/L ratio features : int
+        """
+        if n_ratio > min(len(featureListR), len(featureListL)):
+            raise ValueError("n_ratio can not be larger than the number of R or L features")
+
+        self.frequency = np.asarray(frequency)
+        for name, indexes in (("featureListR", featureListR), ("featureListL", featureListL)):
+            bad = [i for i in indexes if not 0 <= i < len(self.frequency)]
+            if bad:
+                raise ValueError("{} indexes {} are out of the {} frequency bins".format(name, bad, len(self.frequency)))
+        self.featureListR = list(featureListR)
+        self.featureListL = list(featureListL)
+        self.n_ratio = n_ratio
+
+        self.__idx_R = np.asarray(self.featureListR, dtype=np.intp)
+        self.__idx_L = np.asarray(self.featureListL, dtype=np.intp)
+        self.__omega_L = 2*np.pi*self.frequency[self.__idx_L]
+
+        nR = len(self.featureListR)
+        nL = len(self.featureListL)
+        self.__sl_R = slice(0, nR)
+        self.__sl_L = slice(nR, nR+nL)
+        self.__sl_p = slice(nR+nL, nR+nL+n_ratio)
+        self.n_features = nR + nL + n_ratio
+
+        # calibration (reference measurement) on the selected bins
+        self.__R_cal = np.zeros(nR)
+        self.__L_cal = np.zeros(nL)
+
+    @property
+    def spec(self):
+        """
+        Returns:
+        feature specification : dict
+        """
+        return {'featureListR': self.featureListR, 'featureListL': self.featureListL, 'n_ratio': self.n_ratio}
+
+    def set_reference(self, Z_ref):
+        """
+        Set the calibration measurement subtracted from every measurement
+
+        Arguments:
+        Z_ref -- reference impedance (F,) or several references (K, F) that are averaged : numpy array of complex
+        """
+        Z_ref = np.asarray(Z_ref)
+        R_cal = np.real(Z_ref)[..., self.__idx_R]
+        L_cal = np.imag(Z_ref)[..., self.__idx_L]/self.__omega_L
+        if Z_ref.ndim == 2:
+            R_cal = np.mean(R_cal, axis=0)
+            L_cal = np.mean(L_cal, axis=0)
+        self.__R_cal[:] = R_cal
+        self.__L_cal[:] = L_cal
+
+    def transform(self, Z, out=None):
+        """
+        Compute the features of calibrated measurements. A zero inductance gives a non finite ratio,
+        rows that are not finite have to be discarded by the caller.
+
+        Arguments:
+        Z -- impedance (F,) or (N, F) : numpy array of complex
+        out -- preallocated output buffer of n_features (or N*n_features) values : numpy array of float64
+
+        Returns:
+        features (n_features,) or (N, n_features) : numpy array (out if given)
+        """
+        Z = np.asarray(Z)
+        N = 1 if Z.ndim == 1 else Z.shape[0]
+        if out is None:
+            out = np.empty((self.n_features,) if Z.ndim == 1 else (N, self.n_features))
+        elif not out.flags.c_contiguous:
+            raise ValueError("out must be a contiguous buffer, the features would be written in a copy")
+        X = out.reshape(N, self.n_features)
+        Z2 = Z.reshape(N, -1)
+        if Z2.shape[1] != len(self.frequency):
+            raise ValueError("Z has {} frequency bins, expected {}".format(Z2.shape[1], len(self.frequency)))
+
+        R = X[:, self.__sl_R]
+        L = X[:, self.__sl_L]
+        p = X[:, self.__sl_p]
+
+        # resistance and inductance on the selected bins only ('clip' writes straight into out, the indexes
+        # are checked by the constructor)
+        np.take(Z2.real, self.__idx_R, axis=1, out=R, mode='clip')
+        np.take(Z2.imag, self.__idx_L, axis=1, out=L, mode='clip')
+        np.divide(L, self.__omega_L, out=L)
+
+        # calibrate
+        np.subtract(R, self.__R_cal, out=R)
+        np.subtract(L, self.__L_cal, out=L)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(R[:, 0:self.n_ratio], L[:, 0:self.n_ratio], out=p)
+
+        return out
@@ -0,0 +1,264 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Recompute the impedance from the raw voltage traces ('rawdata' vd / vs) of the data files.
+              The sensor coil and the shunt resistor are in series, vd is measured across both and vs across
+              the shunt, so Z(f) = R_shunt (Vd(f) - Vs(f)) / Vs(f). The spectra are computed for a whole batch of
+              measurements, with a real FFT for the full sweep or with a DFT matrix product at chosen frequencies
+              (a band, a denser grid than the FFT bins, ...).
+
+              The recomputed impedance matches the impedance stored by the sensor to ~0.3 % (median) below
+              200 kHz : the sensor averages its impedance over the sequences, the raw data is their sum.
+
+Usage : python impedance_engine.py [FILE ...] [--oversampling K] [--fmin F] [--fmax F]
+"""
+
+import argparse
+import glob
+import os
+import time
+import numpy as np
+from datafilereader import DataFileReader
+
+# metadata giving the acquisition settings
+SHUNT_KEY = 'Shunt resistor [Ohm]'
+FS_KEY = 'Sampling frequency [Hz]'
+N_POINTS_KEY = 'Number of points'
+SETTINGS_KEYS = [SHUNT_KEY, FS_KEY, N_POINTS_KEY]
+# acquisition settings of the ISS sensors (all the bundled files)
+DEFAULT_N_POINTS = 508
+DEFAULT_FS = 1.4e6
+DEFAULT_R_SHUNT = 100
+
+
+def fft_frequencies(n_points, fs):
+    """
+    Frequencies of the FFT bins, in the order of the files (fftshift, from -fs/2)
+
+    Arguments:
+    n_points -- number of samples of a trace : int
+    fs -- sampling frequency [Hz] : float
+
+    Returns:
+    frequencies [Hz] : 1D numpy array
+    """
+    return np.fft.fftshift(np.fft.fftfreq(n_points, 1/fs))
+
+
+def band_frequencies(n_points, fs, fmin=DataFileReader.FREQ_MIN, fmax=DataFileReader.FREQ_MAX, oversampling=1):
+    """
+    Frequencies of a band, on the FFT grid or on a denser grid
+
+    Arguments:
+    n_points -- number of samples of a trace : int
+    fs -- sampling frequency [Hz] : float
+    fmin -- lower bound of the band (excluded) [Hz] : float
+    fmax -- upper bound of the band (excluded) [Hz] : float
+    oversampling -- number of frequencies per FFT bin : int
+
+    Returns:
+    frequencies [Hz] : 1D numpy array
+    """
+    step = fs/(n_points*oversampling)
+    frequency = np.arange(np.floor(fmin/step), np.ceil(fmax/step) + 1)*step
+    return frequency[(frequency > fmin) & (frequency < fmax)]
+
+
+class ImpedanceEngine:
+    """
+    Class to compute the impedance of a batch of measurements from their raw voltage traces
+
+    With frequencies=None the whole FFT sweep is computed (same grid and order as the 'impedance' of the files),
+    otherwise the spectra are evaluated at the given frequencies by a product with a DFT matrix built once.
+    """
+
+    def __init__(self, n_points=DEFAULT_N_POINTS, fs=DEFAULT_FS, r_shunt=DEFAULT_R_SHUNT, frequencies=None):
+        """
+        Constructor
+
+        Arguments:
+        n_points -- number of samples of a trace : int
+        fs -- sampling frequency [Hz] : float
+        r_shunt -- shunt resistor [Ohm] : float
+        frequencies -- frequencies to compute [Hz], the FFT grid if None : 1D numpy array
+        """
+        if n_points <= 0 or fs <= 0 or r_shunt <= 0:
+            raise ValueError("invalid acquisition settings (n_points={}, fs={}, r_shunt={})".format(
+                n_points, fs, r_shunt))
+        self.n_points = int(n_points)
+        self.fs = float(fs)
+        self.r_shunt = float(r_shunt)
+
+        if frequencies is None:
+            self.frequency = fft_frequencies(self.n_points, self.fs)
+            self.__dft = None
+        else:
+            self.frequency = np.asarray(frequencies, dtype=np.float64)
+            # cos and -sin columns : the real and imaginary parts of the spectra in one real product
+            phase = 2*np.pi*np.outer(np.arange(self.n_points), self.frequency/self.fs)
+            self.__dft = np.concatenate([np.cos(phase), -np.sin(phase)], axis=1)
+
+    @classmethod
+    def from_metadata(cls, metadata, frequencies=None):
+        """
+        Engine for the acquisition settings of a file
+
+        Arguments:
+        metadata -- metadata of the measurements (DataFileReader.get_all_metadata or one measurement) : dict
+        frequencies -- frequencies to compute [Hz], the FFT grid if None : 1D numpy array
+
+        Returns:
+        engine : ImpedanceEngine
+        """
+        settings = []
+        for key in SETTINGS_KEYS:
+            values = np.unique(np.atleast_1d(metadata[key]))
+            if values.size != 1:
+                raise ValueError("the measurements have several values of {} : {}".format(key, values))
+            settings.append(values[0].item())
+        r_shunt, fs, n_points = settings
+        return cls(n_points, fs, r_shunt, frequencies)
+
+    def spectrum(self, x):
+        """
+        Spectra of traces, at the frequencies of the engine
+
+        Arguments:
+        x -- traces (N, n_points) : 2D numpy array
+
+        Returns:
+        spectra (N, n_frequencies) : 2D numpy array of complex numbers
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if x.shape[-1] != self.n_points:
+            raise ValueError("the traces have {} samples, the engine expects {}".format(x.shape[-1], self.n_points))
+
+        if self.__dft is None:
+            # real traces : the negative frequencies are the conjugates of the positive ones
+            X = np.fft.rfft(x, axis=-1)
+            n_neg = self.n_points//2
+            return np.concatenate([np.conj(X[..., n_neg:0:-1]), X[..., :self.n_points - n_neg]], axis=-1)
+
+        product = x @ self.__dft
+        K = len(self.frequency)
+        return product[..., :K] + 1j*product[..., K:]
+
+    def impedance(self, vd, vs):
+        """
+        Impedance of a batch of measurements
+
+        Arguments:
+        vd -- traces across the coil and the shunt (N, n_points) : 2D numpy array
+        vs -- traces across the shunt (N, n_points) : 2D numpy array
+
+        Returns:
+        impedance (N, n_frequencies) : 2D numpy array of complex numbers
+        """
+        vd = np.asarray(vd, dtype=np.float64)
+        vs = np.asarray(vs, dtype=np.float64)
+        # both traces in one transform
+        spectra = self.spectrum(np.concatenate([np.atleast_2d(vd), np.atleast_2d(vs)], axis=0))
+        Vd, Vs = np.split(spectra, 2, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Z = (Vd - Vs)/Vs
+        Z *= self.r_shunt
+        return Z if vd.ndim == 2 else Z[0]
+
+
+def recompute_file(file_path, frequencies=None):
+    """
+    Recompute the impedance of all measurements of a file from their raw data
+
+    Arguments:
+    file_path -- data file : str
+    frequencies -- frequencies to compute [Hz], the FFT grid if None : 1D numpy array
+
+    Returns:
+    frequencies [Hz] : 1D numpy array
+    impedance (N, n_frequencies) : 2D numpy array of complex numbers
+    """
+    reader = DataFileReader(file_path)
+    engine = ImpedanceEngine.from_metadata(reader.get_all_metadata(SETTINGS_KEYS), frequencies)
+    vd, vs = reader.get_all_rawdata()
+    return engine.frequency, engine.impedance(vd, vs)
+
+
+def rawdata_by_settings(file_paths):
+    """
+    Raw traces of data files grouped by acquisition settings, so that files recorded with another trace length
+    or sampling frequency get their own engine
+
+    Arguments:
+    file_paths -- data files : list of str
+
+    Returns:
+    (vd, vs) traces by (n_points, fs, r_shunt) : dict of tuple of 2D numpy arrays
+    """
+    groups = {}
+    for file_path in file_paths:
+        reader = DataFileReader(file_path)
+        if reader.get_number_of_mesurements() == 0:
+            continue
+        engine = ImpedanceEngine.from_metadata(reader.get_all_metadata(SETTINGS_KEYS))
+        vd, vs = reader.get_all_rawdata()
+        group = groups.setdefault((engine.n_points, engine.fs, engine.r_shunt), ([], []))
+        group[0].append(vd)
+        group[1].append(vs)
+    return {settings: (np.concatenate(vd), np.concatenate(vs)) for settings, (vd, vs) in groups.items()}
+
+
+def compare_to_stored(file_path, fmin=DataFileReader.FREQ_MIN, fmax=DataFileReader.FREQ_MAX):
+    """
+    Compare the recomputed impedance to the impedance stored in a file, on the FFT bins of a band
+
+    Arguments:
+    file_path -- data file : str
+    fmin -- lower bound of the band (excluded) [Hz] : float
+    fmax -- upper bound of the band (excluded) [Hz] : float
+
+    Returns:
+    relative differences |Z - Z_stored| / |Z_stored| (N, n_frequencies) : 2D numpy array
+    """
+    reader = DataFileReader(file_path)
+    reader.LIMIT_FREQ = False
+    frequency, Z_stored = reader.get_all_mesurements()
+    band = (frequency > fmin) & (frequency < fmax)
+
+    engine = ImpedanceEngine.from_metadata(reader.get_all_metadata(SETTINGS_KEYS), frequency[band])
+    vd, vs = reader.get_all_rawdata()
+    Z = engine.impedance(vd, vs)
+    return np.abs(Z - Z_stored[:, band])/np.abs(Z_stored[:, band])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recompute the impedance from the raw data and compare it')
+    parser.add_argument('files', nargs='*', type=str, default=None, help='data files (all of ./data if none)')
+    parser.add_argument('--fmin', type=float, default=DataFileReader.FREQ_MIN, help='lower bound of the band [Hz]')
+    parser.add_argument('--fmax', type=float, default=DataFileReader.FREQ_MAX, help='upper bound of the band [Hz]')
+    parser.add_argument('--oversampling', type=int, default=4, help='frequencies per FFT bin of the dense grid')
+    args = parser.parse_args()
+    files = args.files or sorted(glob.glob(os.path.join("./data", "**", "*.h5"), recursive=True))
+
+    errors = []
+    for path in files:
+        error = compare_to_stored(path, args.fmin, args.fmax)
+        errors.append(error.reshape(-1))
+        print("{:<60} {:>5} measurements, relative difference median {:.2e} max {:.2e}".format(
+            path, len(error), np.median(error), np.max(error)))
+    errors = np.concatenate(errors)
+    print("\nall files : median {:.2e}, p95 {:.2e}, max {:.2e}".format(
+        np.median(errors), np.percentile(errors, 95), np.max(errors)))
+
+    # throughput on all the raw data of the files, one engine per acquisition settings
+    for (n_points, fs, r_shunt), (vd, vs) in rawdata_by_settings(files).items():
+        print("\n{} points at {:.0f} Hz, {} measurements".format(n_points, fs, len(vd)))
+        for name, frequencies in [("FFT, full sweep", None),
+                                  ("DFT, band", band_frequencies(n_points, fs, args.fmin, args.fmax)),
+                                  ("DFT, band x{}".format(args.oversampling),
+                                   band_frequencies(n_points, fs, args.fmin, args.fmax, args.oversampling))]:
+            engine = ImpedanceEngine(n_points, fs, r_shunt, frequencies)
+            t0 = time.perf_counter()
+            engine.impedance(vd, vs)
+            t = time.perf_counter() - t0
+            print("{:<20} {:>5} frequencies {:>10.0f} measurements/s".format(name, len(engine.frequency), len(vd)/t))
@@ -0,0 +1,222 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Latency instrumentation of the live path (file change detection, HDF5 read, features, gate, classifier).
+              Each stage has a fixed log-spaced histogram, so the recording costs the same whatever the run length.
+              Switched on by the METAL_LATENCY environment variable, the report is written at exit :
+
+                METAL_LATENCY=1                    -> latency_report.json
+                METAL_LATENCY=path/report.json     -> JSON report
+                METAL_LATENCY=path/report.csv      -> CSV report
+
+Usage : METAL_LATENCY=report.json python -m dev.fake_sensor   (records the live service on three fake sensors)
+        python latency.py REPORT.json   (prints a report)
+"""
+
+import atexit
+import csv
+import json
+import math
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+ENV_VAR = "METAL_LATENCY"
+DEFAULT_REPORT = "latency_report.json"
+
+# histogram bins : 1 us to 1000 s, 40 bins per decade (~6 % resolution)
+MIN_LATENCY = 1e-6
+DECADES = 9
+BINS_PER_DECADE = 40
+PERCENTILES = (50, 95, 99)
+LOG_MIN_LATENCY = math.log10(MIN_LATENCY)
+
+
+class LatencyRecorder:
+    """
+    Class to record the duration of the stages of the live path in histograms
+
+    Stages are timed with clock() / lap(), which do nothing when the recorder is disabled :
+
+        t = LATENCY.clock()
+        ...read...
+        t = LATENCY.lap('read', t)
+        ...features...
+        t = LATENCY.lap('features', t)
+    """
+
+    def __init__(self, enabled=True, report_path=None):
+        """
+        Constructor
+
+        Arguments:
+        enabled -- record the durations : bool
+        report_path -- report written at exit (.json or .csv), None to not write it : str
+        """
+        self.enabled = enabled
+        self.report_path = report_path
+        self.edges = MIN_LATENCY*10**(np.arange(DECADES*BINS_PER_DECADE + 1)/BINS_PER_DECADE)
+        self.__stages = {} # stage -> [histogram, count, sum, min, max]
+        self.__lock = threading.Lock()
+        if enabled and report_path is not None:
+            atexit.register(self.dump, report_path)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Recorder configured by the METAL_LATENCY environment variable (disabled if not set)
+        """
+        value = os.environ.get(ENV_VAR, "")
+        if value in ("", "0"):
+            return cls(enabled=False)
+        return cls(enabled=True, report_path=DEFAULT_REPORT if value == "1" else value)
+
+    # --- recording
+    def clock(self):
+        """
+        Returns:
+        current time [s] (0 when disabled) : float
+        """
+        return time.perf_counter() if self.enabled else 0.0
+
+    def lap(self, stage, start):
+        """
+        Record the duration of a stage started at a clock() time
+
+        Arguments:
+        stage -- name of the stage : str
+        start -- clock() at the start of the stage : float
+
+        Returns:
+        current time, start of the next stage : float
+        """
+        if not self.enabled:
+            return 0.0
+        now = time.perf_counter()
+        self.record(stage, now - start)
+        return now
+
+    def record(self, stage, seconds):
+        """
+        Record a duration
+
+        Arguments:
+        stage -- name of the stage : str
+        seconds -- duration [s] : float
+        """
+        if not self.enabled:
+            return
+        if seconds > 0:
+            b = int((math.log10(seconds) - LOG_MIN_LATENCY)*BINS_PER_DECADE)
+            b = min(max(b, 0), len(self.edges) - 2)
+        else:
+            b = 0
+        with self.__lock:
+            entry = self.__stages.get(stage)
+            if entry is None:
+                entry = self.__stages[stage] = [[0]*(len(self.edges) - 1), 0, 0.0, math.inf, 0.0]
+            entry[0][b] += 1
+            entry[1] += 1
+            entry[2] += seconds
+            entry[3] = min(entry[3], seconds)
+            entry[4] = max(entry[4], seconds)
+
+    def record_since_write(self, stage, mtime_ns):
+        """
+        Record the time elapsed since a file was written (wall clock)
+
+        Arguments:
+        stage -- name of the stage : str
+        mtime_ns -- modification time of the file [ns] : int
+        """
+        if self.enabled:
+            self.record(stage, (time.time_ns() - mtime_ns)*1e-9)
+
+    def reset(self):
+        with self.__lock:
+            self.__stages.clear()
+
+    # --- report
+    def summary(self):
+        """
+        Statistics of each stage, the percentiles are the upper edge of their histogram bin
+
+        Returns:
+        {stage: {count, mean, min, max, p50, p95, p99}} [s] : dict
+        """
+        with self.__lock:
+            stages = {stage: (np.array(entry[0]),) + tuple(entry[1:]) for stage, entry in self.__stages.items()}
+
+        summary = {}
+        for stage, (histogram, count, total, low, high) in stages.items():
+            cumulative = np.cumsum(histogram)
+            stats = {'count': int(count), 'mean': total/count, 'min': low, 'max': high}
+            for q in PERCENTILES:
+                b = int(np.searchsorted(cumulative, q/100*count))
+                stats['p{}'.format(q)] = min(float(self.edges[b + 1]), high)
+            summary[stage] = stats
+        return summary
+
+    def dump(self, path=None):
+        """
+        Write the report, JSON (with the histograms) or CSV depending on the extension
+
+        Arguments:
+        path -- report file, report_path if None : str
+        """
+        path = path or self.report_path
+        summary = self.summary()
+        if not summary:
+            return
+        if os.path.splitext(path)[1].lower() == ".csv":
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['stage', 'count', 'mean_ms', 'min_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'])
+                for stage, stats in summary.items():
+                    writer.writerow([stage, stats['count']] + ["{:.4f}".format(stats[key]*1e3) for key in
+                                                               ('mean', 'min', 'p50', 'p95', 'p99', 'max')])
+            return
+
+        with self.__lock:
+            histograms = {stage: {str(b): n for b, n in enumerate(entry[0]) if n}
+                          for stage, entry in self.__stages.items()}
+        report = {
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'command': sys.argv,
+            'unit': 's',
+            'bins': {'min': MIN_LATENCY, 'per_decade': BINS_PER_DECADE},
+            'stages': summary,
+            'histograms': histograms, # bin index -> count, bin b covers [min*10^(b/per_decade), min*10^((b+1)/per_decade)[
+        }
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+            f.write("\n")
+
+
+def print_summary(summary):
+    """
+    Print the statistics of each stage
+
+    Arguments:
+    summary -- LatencyRecorder.summary() or 'stages' of a JSON report : dict
+    """
+    print("{:<12} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "stage", "count", "mean [ms]", "p50 [ms]", "p95 [ms]", "p99 [ms]", "max [ms]"))
+    for stage, stats in summary.items():
+        print("{:<12} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            stage, stats['count'], *(stats[key]*1e3 for key in ('mean', 'p50', 'p95', 'p99', 'max'))))
+
+
+# recorder of the process, used by the live tools
+LATENCY = LatencyRecorder.from_env()
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            report = json.load(f)
+        print(path, ":", " ".join(report['command']))
+        print_summary(report['stages'])
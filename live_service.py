@@ -0,0 +1,237 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Live classification of the coins measured by several ISS sensors at the same time
+
+Usage : python live_service.py FILE [FILE ...]
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import os
+import time
+import numpy as np
+from datafilereader import DataFileReader
+from calibration import CalibrationTracker, MEASUREMENT, REJECTED, STEP, load_empty_coil
+from features import LABELS, DEFAULT_SPEC
+from model_bundle import DEFAULT_BUNDLE
+from svm_inference import load_predictors
+from latency import LATENCY
+from tester_functions import classify_batch
+from watcher import MeasurementWatcher
+
+# event pushed on the service queue for every new measurement
+ClassificationEvent = collections.namedtuple('ClassificationEvent', ['sensor', 'index', 'verdict', 'timestamp'])
+
+CALIBRATION = "Calibration"
+CALIBRATION_VERDICTS = {REJECTED: "Calibration rejected", STEP: "Calibration step"} # other captures : CALIBRATION
+RECALIBRATION = "Recalibration needed"
+
+
+class SensorState:
+    """
+    Live state of one sensor : reader, watcher and rolling calibration
+
+    """
+
+    def __init__(self, name, file_path, backend='auto', spec=DEFAULT_SPEC):
+        """
+        Constructor
+
+        Arguments:
+        name -- name of the sensor : str
+        file_path -- data file written by the sensor : str
+        backend -- watcher backend : str
+        spec -- feature specification of the models : dict
+        """
+        self.name = name
+        self.spec = spec
+        self.reader = DataFileReader(file_path)
+        self.watcher = MeasurementWatcher(self.reader, backend=backend)
+        self.cursor = self.watcher.cursor # next measurement to classify
+        self.calibration = None # created on the first measurement (frequency vector of the file)
+        self.recalibration = None # reason of the last recalibration request
+
+    def observe(self, frequency, Z, is_reference):
+        """
+        Update the calibration with a block of new measurements and compute the features of the coins
+
+        Arguments:
+        frequency -- frequency vector : 1D numpy array
+        Z -- impedance of the new measurements : 2D numpy array of complex
+        is_reference -- reference flag of the new measurements : 1D numpy array of bool
+
+        Returns:
+        kind of each measurement (calibration.py) : 1D numpy array of object
+        features, NaN on the calibration rows : 2D numpy array
+        """
+        if self.calibration is None:
+            self.calibration = CalibrationTracker(frequency, self.spec, empty_coil=load_empty_coil(frequency))
+        return self.calibration.process(Z, is_reference)
+
+    def close(self):
+        self.watcher.close()
+
+
+class LiveClassificationService:
+    """
+    Class to watch several sensor files concurrently and classify their new measurements.
+
+    Every sensor has its own rolling calibration (calibration.py) : the first measurement written after the
+    start without a coin on the coil, then the measurements flagged as reference and the empty coil presses. A recalibration event is
+    pushed when the calibration of a sensor gets stale. The file waits and reads run in one thread per sensor
+    and the models in a shared thread pool, so a slow sensor never stalls the others.
+
+    """
+
+    def __init__(self, sensors, SVM, SVMO, labels=LABELS, max_workers=None, backend='auto', poll_timeout=0.5,
+                 spec=DEFAULT_SPEC, scale=None):
+        """
+        Constructor
+
+        Arguments:
+        sensors -- data file of each sensor, by sensor name : dict
+        SVM -- coin classifier
+        SVMO -- one-class model (-1 for unknown coins)
+        labels -- names of the classes : list of str
+        max_workers -- number of threads running the models : int
+        backend -- watcher backend : str
+        poll_timeout -- maximum time a sensor waits before checking if the service has been stopped [s] : float
+        spec -- feature specification of the models : dict
+        scale -- function applied to the features before the models (ModelBundle.scale), None for raw features : callable
+        """
+        self.sensors = {name: SensorState(name, file_path, backend, spec) for name, file_path in sensors.items()}
+        self.SVM = SVM
+        self.SVMO = SVMO
+        self.labels = labels
+        self.scale = scale
+        self.poll_timeout = poll_timeout
+
+        self.events = asyncio.Queue()
+        self.__io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.sensors), 1),
+                                                               thread_name_prefix='sensor-io')
+        self.__model_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                                  thread_name_prefix='sensor-model')
+        self.__stopping = False
+
+    async def run(self):
+        """
+        Watch all the sensors until stop() is called
+        """
+        self.__stopping = False
+        try:
+            await asyncio.gather(*[self.__watch_sensor(sensor) for sensor in self.sensors.values()])
+        finally:
+            for sensor in self.sensors.values():
+                sensor.close()
+            self.__io_pool.shutdown(wait=False)
+            self.__model_pool.shutdown(wait=False)
+
+    def stop(self):
+        """
+        Stop the service (the sensors stop within poll_timeout)
+        """
+        self.__stopping = True
+
+    async def __watch_sensor(self, sensor):
+        """
+        Watch one sensor and push an event for each of its new measurements
+
+        Arguments:
+        sensor -- sensor to watch : SensorState
+        """
+        loop = asyncio.get_running_loop()
+        while not self.__stopping:
+            try:
+                new = await loop.run_in_executor(self.__io_pool, sensor.watcher.poll, self.poll_timeout)
+                if not new:
+                    continue
+                t = LATENCY.clock()
+                frequency, Z, is_reference, cursor = await loop.run_in_executor(
+                    self.__io_pool, sensor.reader.read_since, sensor.cursor)
+                LATENCY.lap('read', t)
+            except OSError:
+                # the file is still locked by the acquisition tool, the end of its write wakes the watcher again
+                sensor.watcher.cursor = sensor.cursor
+                continue
+
+            first = sensor.cursor
+            sensor.cursor = cursor
+            await self.__process(sensor, first, frequency, Z, is_reference)
+
+    async def __process(self, sensor, first, frequency, Z, is_reference):
+        """
+        Calibrate and classify a block of new measurements of one sensor
+
+        Arguments:
+        sensor -- sensor that measured the block : SensorState
+        first -- index of the first measurement of the block : int
+        frequency -- frequency vector : 1D numpy array
+        Z -- impedance of the new measurements : 2D numpy array of complex
+        is_reference -- reference flag of the new measurements : 1D numpy array of bool
+        """
+        loop = asyncio.get_running_loop()
+
+        # each measurement is calibrated with the calibration before it, the captures update the calibration
+        t = LATENCY.clock()
+        kinds, X = sensor.observe(frequency, Z, is_reference)
+        coins = np.flatnonzero(kinds == MEASUREMENT)
+        verdicts = np.array([CALIBRATION_VERDICTS.get(kind, CALIBRATION) for kind in kinds], dtype=object)
+        if coins.size:
+            X = X[coins]
+            if self.scale is not None:
+                X = self.scale(X)
+            LATENCY.lap('features', t)
+            verdicts[coins] = await loop.run_in_executor(
+                self.__model_pool, classify_batch, X, self.SVM, self.SVMO, self.labels)
+
+        timestamp = time.time()
+        for j, verdict in enumerate(verdicts):
+            await self.events.put(ClassificationEvent(sensor.name, first + j, verdict, timestamp))
+        reason = sensor.calibration.recalibration_reason()
+        if reason is not None and reason != sensor.recalibration:
+            await self.events.put(ClassificationEvent(sensor.name, first + len(Z) - 1, RECALIBRATION, timestamp))
+        sensor.recalibration = reason
+        if sensor.watcher.last_write_ns is not None:
+            LATENCY.record_since_write('verdict', sensor.watcher.last_write_ns)
+
+
+async def print_events(service):
+    """
+    Print the events of the service as they arrive
+    """
+    while True:
+        event = await service.events.get()
+        if event.verdict == CALIBRATION:
+            print(f"[{event.sensor}] measurement {event.index} : calibration done")
+        elif event.verdict == RECALIBRATION:
+            print(f"[{event.sensor}] after measurement {event.index} : please recalibrate (one short press in the air)")
+        else:
+            print(f"[{event.sensor}] measurement {event.index} : {event.verdict}")
+
+
+async def main(file_paths, bundle_path=DEFAULT_BUNDLE):
+    SVM, SVMO, bundle = load_predictors(bundle_path)
+    sensors = {os.path.splitext(os.path.basename(path))[0] + f"#{n}": path for n, path in enumerate(file_paths)}
+    service = LiveClassificationService(sensors, SVM, SVMO, bundle.labels,
+                                        spec=bundle.feature_spec, scale=bundle.scale)
+    printer = asyncio.ensure_future(print_events(service))
+    print("Please calibrate each sensor (one short press in the air), then measure the coins")
+    try:
+        await service.run()
+    finally:
+        printer.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Live classification of several ISS sensors')
+    parser.add_argument('file_paths', nargs='+', type=str, help='data file written by each sensor')
+    parser.add_argument('--bundle', type=str, default=DEFAULT_BUNDLE, help='model bundle folder')
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.file_paths, args.bundle))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,356 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Model bundle used by the live tools : coin classifier, one-class gate, optional scaler,
+              feature specification and label list, versioned in a single folder.
+              The parameters of the SVM models are also exported as plain .npy arrays, and the bundles
+              are loaded once per process through a registry keyed by their content hash.
+
+Usage : python model_bundle.py build [--classifier FILE.pkl] [--gate FILE.pkl] [--scaler FILE.pkl] [--spec FILE]
+                                     [--out FOLDER]
+        python model_bundle.py info [FOLDER ...]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+import numpy as np
+from features import DEFAULT_SPEC, LABELS, feature_names, load_spec
+
+FORMAT_VERSION = 1
+MANIFEST = "bundle.json"
+DEFAULT_BUNDLE = "models/bundle"
+COMPONENTS = ("classifier", "gate", "scaler")
+
+
+def export_parameters(model):
+    """
+    Export the parameters of a model into plain numpy arrays
+
+    Arguments:
+    model -- fitted SVC, OneClassSVM or StandardScaler (other models are not exported)
+
+    Returns:
+    kind of the model : str (None if the model can not be exported)
+    parameters : dict of numpy arrays
+    """
+    name = type(model).__name__
+    kernel = getattr(model, 'kernel', None)
+    if name == 'SVC' and kernel == 'linear':
+        return 'svc_linear', {'coef': model.coef_, 'intercept': model.intercept_, 'classes': model.classes_}
+    if name in ('SVC', 'OneClassSVM') and kernel == 'rbf':
+        parameters = {'support_vectors': model.support_vectors_, 'dual_coef': model.dual_coef_,
+                      'intercept': model.intercept_, 'gamma': np.asarray(model._gamma, dtype=np.float64)}
+        if name == 'SVC':
+            parameters.update({'n_support': model.n_support_, 'classes': model.classes_})
+            return 'svc_rbf', parameters
+        return 'oneclass_rbf', parameters
+    if name == 'StandardScaler':
+        return 'standard_scaler', {'mean': model.mean_, 'scale': model.scale_}
+    return None, {}
+
+
+def save_bundle(folder, classifier, gate, scaler=None, labels=LABELS, spec=DEFAULT_SPEC, **info):
+    """
+    Save a model bundle, an existing bundle in the folder is replaced
+
+    Arguments:
+    folder -- folder of the bundle : str
+    classifier -- fitted coin classifier
+    gate -- fitted one-class model (-1 for unknown coins)
+    scaler -- fitted scaler applied to the features before the models, None if the models use the raw features
+    labels -- names of the classes : list of str
+    spec -- feature specification the models were trained with (FeatureExtractor.spec) : dict
+    info -- other values stored in the manifest (training set, notes, ...) : json values
+
+    Returns:
+    manifest : dict
+    """
+    import sklearn
+
+    # the models must take the features of the spec, else the bundle only fails at inference
+    n_features = len(feature_names(spec))
+    for name, model in zip(COMPONENTS, (classifier, gate, scaler)):
+        n_model = getattr(model, 'n_features_in_', None)
+        if n_model is not None and n_model != n_features:
+            raise ValueError("the {} expects {} features, the feature specification gives {}".format(
+                name, n_model, n_features))
+
+    parent = os.path.dirname(os.path.abspath(folder))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+
+    components = {}
+    for name, model in zip(COMPONENTS, (classifier, gate, scaler)):
+        if model is None:
+            continue
+        file_name = name + ".pkl"
+        with open(os.path.join(tmp, file_name), 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        kind, parameters = export_parameters(model)
+        for key, value in parameters.items():
+            np.save(os.path.join(tmp, "{}.{}.npy".format(name, key)), np.asarray(value), allow_pickle=False)
+        components[name] = {
+            'type': type(model).__name__,
+            'params': repr(model),
+            'file': file_name,
+            'hash': file_hash(os.path.join(tmp, file_name)),
+            'kind': kind,
+            'arrays': sorted(parameters),
+        }
+
+    manifest = dict(info)
+    manifest.update({
+        'format_version': FORMAT_VERSION,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'sklearn_version': sklearn.__version__,
+        'labels': list(labels),
+        'feature_spec': spec,
+        'components': components,
+    })
+    with open(os.path.join(tmp, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.write("\n")
+
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp, folder)
+    return manifest
+
+
+def file_hash(file_path):
+    """
+    Content hash of a file
+
+    Arguments:
+    file_path -- file : str
+
+    Returns:
+    hash : str
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ModelBundle:
+    """
+    Class to access a saved model bundle.
+
+    The manifest and the exported arrays are read when the bundle is opened, the pickled models
+    only when they are first used (after checking their hash against the manifest).
+
+    """
+
+    def __init__(self, folder):
+        """
+        Constructor
+
+        Arguments:
+        folder -- folder of the bundle : str
+        """
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST), 'rb') as f:
+            raw = f.read()
+        self.manifest = json.loads(raw)
+        if self.manifest.get('format_version', 0) > FORMAT_VERSION:
+            raise ValueError("{} : bundle format {} is not supported".format(folder, self.manifest['format_version']))
+
+        # the manifest holds the hash of every file, its own hash is the content hash of the bundle
+        self.key = hashlib.blake2b(raw, digest_size=16).hexdigest()
+        self.labels = self.manifest['labels']
+        self.feature_spec = self.manifest['feature_spec']
+
+        self.__models = {}
+        self.__parameters = {name: {key: np.load(os.path.join(folder, "{}.{}.npy".format(name, key)),
+                                                 mmap_mode='r', allow_pickle=False)
+                                    for key in component['arrays']}
+                             for name, component in self.manifest['components'].items()}
+        self.__lock = threading.Lock()
+        self.__version_checked = False
+
+    @property
+    def classifier(self):
+        return self.model('classifier')
+
+    @property
+    def gate(self):
+        return self.model('gate')
+
+    @property
+    def scaler(self):
+        return self.model('scaler')
+
+    def has(self, name):
+        """
+        Returns:
+        True if the bundle contains the component : bool
+        """
+        return name in self.manifest['components']
+
+    def kind(self, name):
+        """
+        Returns:
+        kind of the exported parameters of a component, None if they are not exported : str
+        """
+        return self.manifest['components'][name]['kind'] if self.has(name) else None
+
+    def parameters(self, name):
+        """
+        Exported parameters of a component
+
+        Arguments:
+        name -- 'classifier', 'gate' or 'scaler' : str
+
+        Returns:
+        parameters, memory-mapped read-only : dict of numpy arrays
+        """
+        return self.__parameters.get(name, {})
+
+    def model(self, name):
+        """
+        Fitted model of a component, unpickled once
+
+        Arguments:
+        name -- 'classifier', 'gate' or 'scaler' : str
+
+        Returns:
+        model (None if the bundle does not contain the component)
+        """
+        if not self.has(name):
+            return None
+        with self.__lock:
+            if name not in self.__models:
+                component = self.manifest['components'][name]
+                path = os.path.join(self.folder, component['file'])
+                if file_hash(path) != component['hash']:
+                    raise ValueError("{} does not match the bundle manifest".format(path))
+                self.__check_sklearn_version()
+                with open(path, 'rb') as f:
+                    self.__models[name] = pickle.load(f)
+            return self.__models[name]
+
+    def __check_sklearn_version(self):
+        """
+        Warn (once per bundle) if the pickled models were saved with another version of scikit-learn
+        """
+        if self.__version_checked:
+            return
+        self.__version_checked = True
+        import sklearn
+        saved = self.manifest.get('sklearn_version')
+        if saved is not None and saved != sklearn.__version__:
+            warnings.warn("{} : models saved with scikit-learn {}, loaded with {}, rebuild the bundle if the "
+                          "predictions differ".format(self.folder, saved, sklearn.__version__), stacklevel=3)
+
+    def scale(self, X):
+        """
+        Apply the scaler of the bundle to features (X is returned as is without scaler)
+
+        Arguments:
+        X -- features, one row per measurement : 2D numpy array
+
+        Returns:
+        features for the models : 2D numpy array
+        """
+        if not self.has('scaler'):
+            return X
+        parameters = self.parameters('scaler')
+        return (X - parameters['mean'])/parameters['scale']
+
+
+class ModelRegistry:
+    """
+    Class to load each model bundle once per process, bundles with the same content are shared
+
+    """
+
+    def __init__(self):
+        self.__keys = {} # (path, size, mtime) of the manifest -> content hash
+        self.__bundles = {} # content hash -> bundle
+        self.__lock = threading.Lock()
+
+    def load(self, folder=DEFAULT_BUNDLE):
+        """
+        Load a bundle, or get it from the registry
+
+        Arguments:
+        folder -- folder of the bundle : str
+
+        Returns:
+        bundle : ModelBundle
+        """
+        st = os.stat(os.path.join(folder, MANIFEST))
+        memo = (os.path.abspath(folder), st.st_size, st.st_mtime_ns)
+        with self.__lock:
+            key = self.__keys.get(memo)
+            if key is not None:
+                return self.__bundles[key]
+            bundle = ModelBundle(folder)
+            bundle = self.__bundles.setdefault(bundle.key, bundle)
+            self.__keys[memo] = bundle.key
+            return bundle
+
+    def clear(self):
+        with self.__lock:
+            self.__keys.clear()
+            self.__bundles.clear()
+
+
+REGISTRY = ModelRegistry()
+
+
+def load_bundle(folder=DEFAULT_BUNDLE):
+    """
+    Load a bundle through the process registry
+
+    Arguments:
+    folder -- folder of the bundle : str
+
+    Returns:
+    bundle : ModelBundle
+    """
+    return REGISTRY.load(folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Model bundles')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='build a bundle from pickled models')
+    build.add_argument('--classifier', type=str, default="models/model1.pkl", help='pickled coin classifier')
+    build.add_argument('--gate', type=str, default="models/modelOneVsAll.pkl", help='pickled one-class model')
+    build.add_argument('--scaler', type=str, default=None, help='pickled scaler')
+    build.add_argument('--spec', type=str, default=None,
+                       help='feature specification JSON of the models (or the manifest of their dataset)')
+    build.add_argument('--out', type=str, default=DEFAULT_BUNDLE, help='bundle folder')
+    info = subparsers.add_parser('info', help='describe bundles')
+    info.add_argument('folders', nargs='*', type=str, default=[DEFAULT_BUNDLE], help='bundle folders')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        models = {}
+        for name in COMPONENTS:
+            path = getattr(args, name)
+            if path is not None:
+                with open(path, 'rb') as f:
+                    models[name] = pickle.load(f)
+        sources = {name: getattr(args, name) for name in models}
+        save_bundle(args.out, models['classifier'], models['gate'], models.get('scaler'), spec=load_spec(args.spec),
+                    sources=sources)
+        print("bundle saved in", args.out)
+    else:
+        for folder in args.folders:
+            bundle = ModelBundle(folder)
+            print("{} ({}, sklearn {}) :".format(folder, bundle.key, bundle.manifest['sklearn_version']))
+            for name, component in bundle.manifest['components'].items():
+                print("  {:<10} {:<40} exported as {}".format(name, component['params'], component['kind']))
@@ -0,0 +1,295 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Headless reports of the data files, one per data folder : for each coin the median and the
+              percentile bands of the calibrated R(f) and L(f), and their 2-D histograms (density of the
+              measurements over frequency and value). The statistics are computed with NumPy on all the
+              measurements at once, the figures are rendered off screen (Agg) in a process pool, so the cost
+              does not depend on the number of lines a plot would need.
+
+              Each folder gives bands.png, density.png and report.html, and OUT/index.html links the folders.
+              The folders and the coins come from the catalog of the data files (data_catalog.py).
+
+Usage : python report.py [--root FOLDER] [--out FOLDER] [--group GROUP] [--workers N] [--bins N] [--db FILE]
+"""
+
+import argparse
+import concurrent.futures
+import html
+import os
+import time
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from datafilereader import DataFileReader
+from data_catalog import DataCatalog, DEFAULT_ROOT, DEFAULT_DB
+
+DEFAULT_OUT = "./reports"
+PERCENTILES = (5, 25, 50, 75, 95)
+PNG_OPTIONS = {"compress_level": 1} # fast zlib level, the images are a few hundred kB
+AXES = (("R", "R [Ohm]"), ("L", "L [uH]"))
+
+
+def calibrated_values(file_path):
+    """
+    Calibrated resistance and inductance of the measurements of a file, on the frequencies of the band. The
+    calibration is the mean of the reference measurements, the first measurement if there is none.
+
+    Arguments:
+    file_path -- data file : str
+
+    Returns:
+    frequency [Hz] : 1D numpy array
+    values of the measurements (references excluded) for 'R' [Ohm] and 'L' [uH] : dict of 2D numpy arrays
+    """
+    frequency, Z, is_reference, _ = DataFileReader(file_path).read_band()
+    if len(Z) == 0:
+        return frequency, {key: np.empty((0, len(frequency))) for key, _ in AXES}
+    if not is_reference.any():
+        is_reference = np.zeros(len(Z), dtype=bool)
+        is_reference[0] = True
+    Z = Z - Z[is_reference].mean(axis=0)
+    Z = Z[~is_reference]
+    return frequency, {'R': np.real(Z), 'L': np.imag(Z)/(2*np.pi*frequency)*1e6}
+
+
+def coin_statistics(values, percentiles=PERCENTILES):
+    """
+    Mean and percentiles of measurements, frequency by frequency
+
+    Arguments:
+    values -- measurements (N, frequency) : 2D numpy array
+    percentiles -- percentiles to compute : tuple of float
+
+    Returns:
+    'mean' (frequency,) and 'percentiles' (len(percentiles), frequency) : dict of numpy arrays
+    """
+    if len(values) == 0:
+        nan = np.full(values.shape[1], np.nan)
+        return {'mean': nan, 'percentiles': np.tile(nan, (len(percentiles), 1))}
+    return {'mean': values.mean(axis=0), 'percentiles': np.percentile(values, percentiles, axis=0)}
+
+
+def density_image(values, lo, hi, n_bins):
+    """
+    2-D histogram of measurements : number of measurements in each value bin, frequency by frequency. Values
+    out of [lo, hi] are not counted.
+
+    Arguments:
+    values -- measurements (N, frequency) : 2D numpy array
+    lo -- lower bound of the values : float
+    hi -- upper bound of the values : float
+    n_bins -- number of value bins : int
+
+    Returns:
+    counts (n_bins, frequency) : 2D numpy array of int
+    """
+    n_frequencies = values.shape[1]
+    rows = np.floor((values - lo)/(hi - lo)*n_bins).astype(np.intp)
+    cols = np.broadcast_to(np.arange(n_frequencies), values.shape)
+    inside = (rows >= 0) & (rows < n_bins)
+    counts = np.bincount(rows[inside]*n_frequencies + cols[inside], minlength=n_bins*n_frequencies)
+    return counts.reshape(n_bins, n_frequencies)
+
+
+def value_range(values_list, low=0.5, high=99.5):
+    """
+    Common value range of several sets of measurements, the extreme values are left out
+
+    Arguments:
+    values_list -- measurements (N, frequency) : list of 2D numpy arrays
+    low -- lower percentile : float
+    high -- upper percentile : float
+
+    Returns:
+    lower and upper bounds : tuple of float
+    """
+    values = np.concatenate([v.ravel() for v in values_list if v.size > 0]) if values_list else np.empty(0)
+    if values.size == 0:
+        return 0.0, 1.0
+    lo, hi = np.percentile(values, [low, high])
+    margin = 0.05*(hi - lo) if hi > lo else 1
+    return lo - margin, hi + margin
+
+
+def render_bands(frequency, coins, path):
+    """
+    Median and percentile bands of each coin, R and L
+
+    Arguments:
+    frequency -- frequency [Hz] : 1D numpy array
+    coins -- (name, statistics of 'R' and 'L') of each coin : list of tuple
+    path -- PNG file : str
+    """
+    fig = Figure(figsize=(12, 9))
+    FigureCanvasAgg(fig)
+    for i, (key, label) in enumerate(AXES):
+        ax = fig.add_subplot(2, 1, i + 1)
+        for name, stats in coins:
+            p = stats[key]['percentiles']
+            line, = ax.plot(frequency, p[len(PERCENTILES)//2], label=name, linewidth=1)
+            ax.fill_between(frequency, p[0], p[-1], color=line.get_color(), alpha=0.15, linewidth=0)
+            ax.fill_between(frequency, p[1], p[-2], color=line.get_color(), alpha=0.3, linewidth=0)
+        ax.set_ylabel(label)
+        ax.grid(True, alpha=0.3)
+    ax.set_xlabel("Frequency [Hz]")
+    fig.axes[0].set_title("median, {}-{} and {}-{} percentile bands (calibrated)".format(
+        PERCENTILES[1], PERCENTILES[-2], PERCENTILES[0], PERCENTILES[-1]))
+    fig.axes[0].legend(loc='upper left', fontsize='small', ncol=2)
+    fig.subplots_adjust(left=0.08, right=0.98, bottom=0.07, top=0.95, hspace=0.15)
+    fig.savefig(path, dpi=80, pil_kwargs=PNG_OPTIONS)
+
+
+def render_density(frequency, coins, ranges, path):
+    """
+    2-D histograms of each coin, R and L : the histograms of the coins are stacked in one image per quantity
+    (one strip per coin, on common value ranges), a figure with two axes whatever the number of coins
+
+    Arguments:
+    frequency -- frequency [Hz] : 1D numpy array
+    coins -- (name, density images of 'R' and 'L') of each coin : list of tuple
+    ranges -- value range of 'R' and 'L' : dict of tuple
+    path -- PNG file : str
+    """
+    fig = Figure(figsize=(12, 1.2*max(len(coins), 1) + 1.5))
+    FigureCanvasAgg(fig)
+    fig.subplots_adjust(left=0.1, right=0.98, bottom=0.5/fig.get_figheight(), top=1 - 0.6/fig.get_figheight(),
+                        wspace=0.05)
+    extent = (frequency[0], frequency[-1], 0, len(coins)) if len(frequency) else (0, 1, 0, 1)
+    for col, (key, label) in enumerate(AXES):
+        ax = fig.add_subplot(1, 2, col + 1)
+        if coins:
+            # each strip normalized by its maximum, the coins with few measurements stay visible
+            strips = [np.log1p(images[key])/max(np.log1p(images[key]).max(), 1) for _, images in coins]
+            ax.imshow(np.concatenate(strips[::-1]), origin='lower', aspect='auto', cmap='magma',
+                      interpolation='nearest', extent=extent)
+        ax.set_yticks(np.arange(len(coins)) + 0.5)
+        ax.set_yticklabels([name for name, _ in coins][::-1] if col == 0 else [])
+        ax.hlines(np.arange(1, len(coins)), *extent[:2], color='white', linewidth=0.5)
+        ax.set_title("{}, each strip from {:.3g} to {:.3g}".format(label, *ranges[key]), fontsize='medium')
+        ax.set_xlabel("Frequency [Hz]")
+    fig.savefig(path, dpi=80, pil_kwargs=PNG_OPTIONS)
+
+
+def render_folder(folder, entries, out_folder, n_bins=100):
+    """
+    Report of a data folder
+
+    Arguments:
+    folder -- folder relative to the root of the catalog : str
+    entries -- catalog entries of the files of the folder : list of dict
+    out_folder -- folder of the report : str
+    n_bins -- number of value bins of the 2-D histograms : int
+
+    Returns:
+    summary of the folder : dict
+    """
+    os.makedirs(out_folder, exist_ok=True)
+    coins = []
+    frequency = np.empty(0)
+    for entry in entries:
+        f, values = calibrated_values(entry['file_path'])
+        if len(f) > len(frequency):
+            frequency = f
+        name = entry['coin'] or os.path.splitext(os.path.basename(entry['path']))[0]
+        coins.append((name, entry, values))
+    # files on another frequency grid than the folder are left out of the figures
+    coins = [coin for coin in coins if coin[2]['R'].shape[1] == len(frequency)]
+
+    ranges = {key: value_range([values[key] for _, _, values in coins]) for key, _ in AXES}
+    stats = [(name, {key: coin_statistics(values[key]) for key, _ in AXES}) for name, _, values in coins]
+    images = [(name, {key: density_image(values[key], *ranges[key], n_bins) for key, _ in AXES})
+              for name, _, values in coins]
+    render_bands(frequency, stats, os.path.join(out_folder, "bands.png"))
+    render_density(frequency, images, ranges, os.path.join(out_folder, "density.png"))
+
+    rows = "".join("<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n".format(
+        html.escape(name), html.escape(entry['path']), len(values['R']), html.escape(str(entry['refs'])))
+        for name, entry, values in coins)
+    with open(os.path.join(out_folder, "report.html"), 'w') as f:
+        f.write(HTML_FOLDER.format(title=html.escape(folder or "."), rows=rows))
+    return {'folder': folder, 'n_files': len(coins), 'n_measurements': sum(len(v['R']) for _, _, v in coins)}
+
+
+def render_reports(root=DEFAULT_ROOT, out=DEFAULT_OUT, group=None, workers=None, n_bins=100, db_path=DEFAULT_DB):
+    """
+    Reports of all the data folders of a tree, rendered in a process pool
+
+    Arguments:
+    root -- folder of the data files : str
+    out -- folder of the reports : str
+    group -- only the folders of a group (Groupe5, foreign, ...), all if None : str
+    workers -- number of processes (None for the number of CPUs, 1 to stay in this process) : int
+    n_bins -- number of value bins of the 2-D histograms : int
+    db_path -- SQLite file of the catalog : str
+
+    Returns:
+    summary of each folder : list of dict
+    """
+    with DataCatalog(root, db_path) as catalog:
+        catalog.refresh()
+        entries = catalog.find(group=group)
+    folders = {}
+    for entry in sorted(entries, key=lambda e: (e['label'] if e['label'] is not None else 99, e['path'])):
+        folders.setdefault(os.path.dirname(entry['path']), []).append(entry)
+
+    jobs = [(folder, folder_entries, os.path.join(out, folder or "root"), n_bins)
+            for folder, folder_entries in sorted(folders.items())]
+    if workers == 1:
+        summaries = [render_folder(*job) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            summaries = list(pool.map(render_folder, *zip(*jobs))) if jobs else []
+
+    rows = "".join('<tr><td><a href="{}/report.html">{}</a></td><td>{}</td><td>{}</td></tr>\n'.format(
+        html.escape(summary['folder'] or "root"), html.escape(summary['folder'] or "."), summary['n_files'],
+        summary['n_measurements']) for summary in summaries)
+    os.makedirs(out, exist_ok=True)
+    with open(os.path.join(out, "index.html"), 'w') as f:
+        f.write(HTML_INDEX.format(rows=rows))
+    return summaries
+
+
+HTML_FOLDER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+<h1>{title}</h1>
+<table border="1" cellspacing="0" cellpadding="4">
+<tr><th>coin</th><th>file</th><th>measurements</th><th>references</th></tr>
+{rows}</table>
+<h2>Median and percentile bands</h2>
+<img src="bands.png">
+<h2>Density of the measurements</h2>
+<img src="density.png">
+</body></html>
+"""
+
+HTML_INDEX = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Data reports</title></head>
+<body>
+<h1>Data reports</h1>
+<table border="1" cellspacing="0" cellpadding="4">
+<tr><th>folder</th><th>files</th><th>measurements</th></tr>
+{rows}</table>
+</body></html>
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Headless reports of the data folders')
+    parser.add_argument('--root', type=str, default=DEFAULT_ROOT, help='folder of the data files')
+    parser.add_argument('--out', type=str, default=DEFAULT_OUT, help='folder of the reports')
+    parser.add_argument('--group', type=str, default=None, help='only the folders of a group')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (1 : no pool)')
+    parser.add_argument('--bins', type=int, default=100, help='value bins of the 2-D histograms')
+    parser.add_argument('--db', type=str, default=DEFAULT_DB, help='SQLite file of the catalog')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    summaries = render_reports(args.root, args.out, args.group, args.workers, args.bins, args.db)
+    t = time.perf_counter() - t0
+    for summary in summaries:
+        print("{:<35} {:>3} files {:>6} measurements".format(summary['folder'] or ".", summary['n_files'],
+                                                               summary['n_measurements']))
+    print("{} folders in {:.1f} s, index in {}".format(len(summaries), t, os.path.join(args.out, "index.html")))
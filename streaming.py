@@ -0,0 +1,229 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Feature extraction and classification of data files of any size at constant memory. The file is
+              read by blocks (DataFileReader.iter_blocks) on the columns of the features only, and each block is
+              calibrated, featurized and classified before the next one is read.
+
+              Calibration of the measurements :
+                latest -- the last reference measurement before them, as the live tools (for long logs with
+                          periodic calibrations)
+                all    -- the mean of all the reference measurements of the file, as process_files (first pass
+                          over the reference rows)
+              Without a reference before them, the first measurement of the file is the calibration.
+
+Usage : python streaming.py classify FILE.h5 [--bundle FOLDER] [--block N] [--calibration latest|all] [--out CSV]
+        python streaming.py features FILE.h5 OUT_FOLDER [--block N] [--calibration latest|all] [--label L]
+                                     [--dtype float64|float32]
+"""
+
+import argparse
+import csv
+import time
+import numpy as np
+from datafilereader import DataFileReader
+from features import FeatureExtractor, DEFAULT_SPEC, feature_bins, spec_on_bins
+from dataset_io import DatasetWriter
+from model_bundle import DEFAULT_BUNDLE
+from svm_inference import load_predictors
+from tester_functions import classify_batch
+
+DEFAULT_BLOCK = 4096
+CALIBRATIONS = ("latest", "all")
+
+
+def mean_reference(reader, bins, block_size=DEFAULT_BLOCK):
+    """
+    Mean of the reference measurements of a file, on some frequency indexes
+
+    Arguments:
+    reader -- data file : DataFileReader
+    bins -- frequency indexes : list of int
+    block_size -- number of file rows read at a time : int
+
+    Returns:
+    mean reference impedance, None if the file has no reference : 1D numpy array of complex numbers
+    """
+    total, count = 0, 0
+    for _, Z, is_reference, _ in reader.iter_blocks(block_size, bins, keys=[]):
+        total = total + Z[is_reference].sum(axis=0)
+        count += np.count_nonzero(is_reference)
+    return total/count if count else None
+
+
+def stream_features(reader, spec=DEFAULT_SPEC, block_size=DEFAULT_BLOCK, calibration="latest"):
+    """
+    Features of the measurements of a file, block by block. The reference measurements calibrate the
+    measurements and are not returned.
+
+    Arguments:
+    reader -- data file : DataFileReader
+    spec -- feature specification : dict
+    block_size -- number of file rows read at a time : int
+    calibration -- 'latest' or 'all', see the module description : str
+
+    Yields:
+    indexes of the measurements (among the existing measurements of the file) : 1D numpy array
+    features, one row per measurement : 2D numpy array
+    """
+    if calibration not in CALIBRATIONS:
+        raise ValueError("unknown calibration {}, expected one of {}".format(calibration, CALIBRATIONS))
+    bins = feature_bins(spec)
+    spec = spec_on_bins(spec, bins)
+    extractor = None
+    if calibration == "all":
+        Z_ref = mean_reference(reader, bins, block_size)
+
+    first = 0
+    for frequency, Z, is_reference, _ in reader.iter_blocks(block_size, bins, keys=[]):
+        index = np.arange(first, first + len(Z))
+        first += len(Z)
+        if extractor is None:
+            extractor = FeatureExtractor(frequency, **spec)
+            if calibration == "all" and Z_ref is not None:
+                extractor.set_reference(Z_ref)
+            elif not is_reference[0]:
+                # no calibration before the first measurement, it is the calibration
+                extractor.set_reference(Z[0])
+                is_reference = is_reference.copy()
+                is_reference[0] = True
+
+        if calibration == "all":
+            keep = ~is_reference
+            if keep.any():
+                yield index[keep], extractor.transform(Z[keep])
+            continue
+
+        # the block is split on the reference measurements, each part uses the reference before it
+        bounds = list(np.flatnonzero(is_reference)) + [len(Z)]
+        start = 0
+        for stop in bounds:
+            if stop > start:
+                yield index[start:stop], extractor.transform(Z[start:stop])
+            if stop < len(Z):
+                extractor.set_reference(Z[stop])
+                start = stop + 1
+
+
+def classify_stream(reader, bundle_path=DEFAULT_BUNDLE, block_size=DEFAULT_BLOCK, calibration="latest"):
+    """
+    Classify the measurements of a file, block by block
+
+    Arguments:
+    reader -- data file : DataFileReader
+    bundle_path -- folder of the model bundle : str
+    block_size -- number of file rows read at a time : int
+    calibration -- 'latest' or 'all', see the module description : str
+
+    Yields:
+    indexes of the measurements (among the existing measurements of the file) : 1D numpy array
+    verdicts (label, 'Unknown' or 'Classification error') : 1D numpy array of object
+    """
+    SVM, SVMO, bundle = load_predictors(bundle_path)
+    for index, X in stream_features(reader, bundle.feature_spec, block_size, calibration):
+        yield index, classify_batch(bundle.scale(X), SVM, SVMO, bundle.labels)
+
+
+def count_measurements(reader, block_size=DEFAULT_BLOCK, calibration="latest"):
+    """
+    Number of measurements returned by stream_features : the measurements that are not references, minus
+    the first measurement when it is used as calibration
+
+    Arguments:
+    reader -- data file : DataFileReader
+    block_size -- number of file rows read at a time : int
+    calibration -- 'latest' or 'all', see the module description : str
+
+    Returns:
+    number of measurements : int
+    """
+    n_rows, n_references, first_is_reference = 0, 0, None
+    for _, _, is_reference, _ in reader.iter_blocks(block_size, indexes=[], keys=[]):
+        if first_is_reference is None:
+            first_is_reference = bool(is_reference[0])
+        n_rows += len(is_reference)
+        n_references += np.count_nonzero(is_reference)
+    if n_rows == 0:
+        return 0
+    first_is_calibration = n_references == 0 if calibration == "all" else not first_is_reference
+    return n_rows - n_references - int(first_is_calibration)
+
+
+def featurize_file(file_path, out_folder, spec=DEFAULT_SPEC, block_size=DEFAULT_BLOCK, calibration="latest",
+                   label=-1, dtype=np.float64):
+    """
+    Write the features of all the measurements of a file in a dataset, block by block
+
+    Arguments:
+    file_path -- data file : str
+    out_folder -- folder of the dataset : str
+    spec -- feature specification : dict
+    block_size -- number of file rows read at a time : int
+    calibration -- 'latest' or 'all', see the module description : str
+    label -- label of all the measurements (Y) : int
+    dtype -- type of the saved features : numpy dtype
+
+    Returns:
+    number of measurements : int
+    """
+    reader = DataFileReader(file_path)
+    n = count_measurements(reader, block_size, calibration)
+    with DatasetWriter(out_folder, n, spec, dtype, source_files=[file_path], calibration=calibration) as writer:
+        for _, X in stream_features(reader, spec, block_size, calibration):
+            writer.write(X, np.full(len(X), label))
+    return n
+
+
+def peak_memory_mb():
+    # maximum resident set size of the process (kB on Linux), None where the resource module does not exist (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+if __name__ == "__main__":
+    import warnings
+
+    parser = argparse.ArgumentParser(description='Block by block classification and feature extraction')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ('classify', 'features'):
+        sub = subparsers.add_parser(command, help='classify a file' if command == 'classify' else 'featurize a file')
+        sub.add_argument('file_path', type=str, help='data file')
+        sub.add_argument('--block', type=int, default=DEFAULT_BLOCK, help='file rows read at a time')
+        sub.add_argument('--calibration', type=str, default='latest', choices=CALIBRATIONS, help='calibration')
+    subparsers.choices['classify'].add_argument('--bundle', type=str, default=DEFAULT_BUNDLE, help='model bundle')
+    subparsers.choices['classify'].add_argument('--out', type=str, default=None, help='CSV file of the verdicts')
+    subparsers.choices['features'].add_argument('out_folder', type=str, help='dataset folder')
+    subparsers.choices['features'].add_argument('--label', type=int, default=-1, help='label of the measurements')
+    subparsers.choices['features'].add_argument('--dtype', type=str, default='float64', choices=['float64', 'float32'])
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    t0 = time.perf_counter()
+    reader = DataFileReader(args.file_path)
+    if args.command == 'features':
+        n = featurize_file(args.file_path, args.out_folder, block_size=args.block, calibration=args.calibration,
+                           label=args.label, dtype=np.dtype(args.dtype))
+    else:
+        n = 0
+        counts = {}
+        out = open(args.out, 'w', newline='') if args.out else None
+        writer = csv.writer(out) if out else None
+        if writer:
+            writer.writerow(['measurement', 'verdict'])
+        for index, verdicts in classify_stream(reader, args.bundle, args.block, args.calibration):
+            n += len(index)
+            for verdict, count in zip(*np.unique(verdicts.astype(str), return_counts=True)):
+                counts[str(verdict)] = counts.get(str(verdict), 0) + int(count)
+            if writer:
+                writer.writerows(zip(index.tolist(), verdicts.tolist()))
+        if out:
+            out.close()
+        print(dict(sorted(counts.items())))
+    t = time.perf_counter() - t0
+    peak = peak_memory_mb()
+    print("{} measurements in {:.2f} s ({:.0f} measurements/s), peak memory {}".format(
+        n, t, n/t, "{:.0f} MB".format(peak) if peak is not None else "unknown"))
@@ -0,0 +1,251 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : NumPy inference of the exported SVM models (model_bundle.py) : one-vs-one linear SVC classifier
+              and RBF one-class gate. The decision functions are evaluated with the precomputed weight matrices
+              and support vectors, without the input validation and libsvm dispatch of sklearn.
+
+Usage : python svm_inference.py [--bundle FOLDER] [DATASET ...]
+"""
+
+import argparse
+import numpy as np
+from model_bundle import DEFAULT_BUNDLE, load_bundle
+
+
+class LinearOvOClassifier:
+    """
+    Class to evaluate a linear SVC trained one-vs-one (sklearn SVC(kernel='linear'))
+
+    Every pair of classes (i, j), i < j, has a decision value x.w + b, positive votes for i and
+    negative for j. The predicted class has the most votes, the lowest class wins the ties (as libsvm).
+    """
+
+    def __init__(self, coef, intercept, classes):
+        """
+        Constructor
+
+        Arguments:
+        coef -- weights of each pair of classes (n_pairs, n_features) : 2D numpy array
+        intercept -- bias of each pair of classes (n_pairs,) : 1D numpy array
+        classes -- labels of the classes (n_classes,) : 1D numpy array
+        """
+        self.coef_T = np.ascontiguousarray(np.asarray(coef, dtype=np.float64).T)
+        self.intercept = np.array(intercept, dtype=np.float64)
+        self.classes_ = np.array(classes)
+        n_classes = len(self.classes_)
+        if self.coef_T.shape[1] != n_classes*(n_classes-1)//2 or self.intercept.shape != (self.coef_T.shape[1],):
+            raise ValueError("the weights do not match {} classes one-vs-one".format(n_classes))
+
+        self.n_features_in_ = self.coef_T.shape[0]
+        # votes = (dec > 0) @ (P - M) + sum(M), with P / M the class winning each pair (libsvm order)
+        # for a positive / negative decision value, one-hot encoded
+        pairs = [(i, j) for i in range(n_classes) for j in range(i+1, n_classes)]
+        P = np.zeros((len(pairs), n_classes))
+        M = np.zeros((len(pairs), n_classes))
+        for k, (i, j) in enumerate(pairs):
+            P[k, i] = 1
+            M[k, j] = 1
+        self.__vote_diff = P - M
+        self.__vote_base = M.sum(axis=0)
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        return cls(parameters['coef'], parameters['intercept'], parameters['classes'])
+
+    def decision_function(self, X):
+        """
+        Decision values of each pair of classes (as SVC.decision_function with decision_function_shape='ovo')
+
+        Arguments:
+        X -- features (N, n_features) : 2D numpy array
+
+        Returns:
+        decision values (N, n_pairs) : 2D numpy array
+        """
+        dec = np.asarray(X, dtype=np.float64) @ self.coef_T
+        dec += self.intercept
+        return dec
+
+    def predict(self, X):
+        """
+        Predict the classes
+
+        Arguments:
+        X -- features (N, n_features) : 2D numpy array
+
+        Returns:
+        labels (N,) : 1D numpy array
+        """
+        positive = (self.decision_function(X) > 0).astype(np.float64)
+        votes = positive @ self.__vote_diff
+        votes += self.__vote_base
+        return self.classes_[np.argmax(votes, axis=1)]
+
+
+class RBFOneClass:
+    """
+    Class to evaluate a one-class SVM with a RBF kernel (sklearn OneClassSVM(kernel='rbf'))
+
+    decision(x) = sum_i a_i exp(-gamma |x - sv_i|^2) + b, the measurement is accepted (+1) if it is positive
+    and rejected (-1) otherwise.
+    """
+
+    def __init__(self, support_vectors, dual_coef, intercept, gamma):
+        """
+        Constructor
+
+        Arguments:
+        support_vectors -- support vectors (n_SV, n_features) : 2D numpy array
+        dual_coef -- weights of the support vectors (1, n_SV) : 2D numpy array
+        intercept -- bias (1,) : 1D numpy array
+        gamma -- kernel coefficient : float
+        """
+        self.support_vectors = np.array(support_vectors, dtype=np.float64)
+        self.dual_coef = np.array(dual_coef, dtype=np.float64).reshape(-1)
+        self.intercept = float(np.asarray(intercept).reshape(-1)[0])
+        self.gamma = float(gamma)
+        if self.dual_coef.shape[0] != self.support_vectors.shape[0]:
+            raise ValueError("the dual coefficients do not match the support vectors")
+
+        self.n_features_in_ = self.support_vectors.shape[1]
+        self.__sv_T = np.ascontiguousarray(self.support_vectors.T)
+        self.__sv_sq = np.einsum('ij,ij->i', self.support_vectors, self.support_vectors)
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        return cls(parameters['support_vectors'], parameters['dual_coef'], parameters['intercept'],
+                   parameters['gamma'])
+
+    def decision_function(self, X):
+        """
+        Decision values (as OneClassSVM.decision_function)
+
+        Arguments:
+        X -- features (N, n_features) : 2D numpy array
+
+        Returns:
+        decision values (N,) : 1D numpy array
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError("X has {} features, the model expects {}".format(X.shape[-1], self.n_features_in_))
+
+        # |x - sv|^2 = |x|^2 + |sv|^2 - 2 x.sv, all the support vectors in one product
+        d2 = X @ self.__sv_T
+        d2 *= -2
+        d2 += self.__sv_sq
+        d2 += np.einsum('ij,ij->i', X, X)[:, None]
+        np.maximum(d2, 0, out=d2)
+        d2 *= -self.gamma
+        np.exp(d2, out=d2)
+        return d2 @ self.dual_coef + self.intercept
+
+    def predict(self, X):
+        """
+        Accept or reject measurements
+
+        Arguments:
+        X -- features (N, n_features) : 2D numpy array
+
+        Returns:
+        +1 (accepted) or -1 (rejected) (N,) : 1D numpy array of int
+        """
+        return np.where(self.decision_function(X) > 0, 1, -1)
+
+
+# predictor class of each kind of exported parameters (model_bundle.export_parameters)
+PREDICTORS = {
+    'svc_linear': LinearOvOClassifier,
+    'oneclass_rbf': RBFOneClass,
+}
+
+_predictors = {} # bundle content hash -> (classifier, gate)
+
+
+def load_predictor(bundle, name):
+    """
+    NumPy predictor of a bundle component, the sklearn model if its kind has no NumPy predictor
+
+    Arguments:
+    bundle -- model bundle : ModelBundle
+    name -- 'classifier' or 'gate' : str
+
+    Returns:
+    predictor with predict() and decision_function()
+    """
+    predictor = PREDICTORS.get(bundle.kind(name))
+    if predictor is None:
+        return bundle.model(name)
+    return predictor.from_parameters(bundle.parameters(name))
+
+
+def load_predictors(bundle_path=DEFAULT_BUNDLE):
+    """
+    Predictors of the classifier and of the gate of a bundle, built once per bundle
+
+    Arguments:
+    bundle_path -- folder of the model bundle : str
+
+    Returns:
+    coin classifier, one-class gate, bundle
+    """
+    bundle = load_bundle(bundle_path)
+    if bundle.key not in _predictors:
+        _predictors[bundle.key] = (load_predictor(bundle, 'classifier'), load_predictor(bundle, 'gate'))
+    return _predictors[bundle.key] + (bundle,)
+
+
+def compare_to_sklearn(bundle, X):
+    """
+    Compare the NumPy predictors of a bundle to its sklearn models
+
+    Arguments:
+    bundle -- model bundle : ModelBundle
+    X -- features (N, n_features) : 2D numpy array
+
+    Returns:
+    for the classifier and the gate, (same predictions, max relative difference of the decision values) : dict
+    """
+    import copy
+
+    results = {}
+    for name in ('classifier', 'gate'):
+        model = bundle.model(name)
+        predictor = load_predictor(bundle, name)
+        if predictor is model:
+            continue
+        if name == 'classifier':
+            model = copy.copy(model)
+            model.decision_function_shape = 'ovo'
+        Xs = bundle.scale(X)
+        dec_ref = model.decision_function(Xs)
+        dec = predictor.decision_function(Xs)
+        scale = max(np.max(np.abs(dec_ref)), np.finfo(np.float64).tiny)
+        results[name] = (bool(np.array_equal(predictor.predict(Xs), model.predict(Xs))),
+                         float(np.max(np.abs(dec - dec_ref))/scale))
+    return results
+
+
+if __name__ == "__main__":
+    import warnings
+    from dataset_io import load_dataset
+
+    parser = argparse.ArgumentParser(description='Check the NumPy predictors against the sklearn models')
+    parser.add_argument('datasets', nargs='*', type=str,
+                        default=["dataset/trainingset", "dataset/validationset", "dataset/testingset",
+                                 "dataset/validset_foreign", "dataset/testset_foreign"], help='dataset folders')
+    parser.add_argument('--bundle', type=str, default=DEFAULT_BUNDLE, help='model bundle folder')
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    bundle = load_bundle(args.bundle)
+    ok = True
+    for folder in args.datasets:
+        X, _ = load_dataset(folder)
+        for name, (same, diff) in compare_to_sklearn(bundle, X).items():
+            ok = ok and same
+            print("{:<26} {:<10} predictions {:<9} max relative decision difference {:.1e}".format(
+                folder, name, "equal" if same else "DIFFERENT", diff))
+    raise SystemExit(0 if ok else 1)
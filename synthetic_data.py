@@ -0,0 +1,439 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Synthetic data files for load and scale tests, in the layout written by the ISS acquisition tool
+              ('existing' flags, 'impedance' frequency / real / imaginary rows, 'rawdata' vd / vs rows and the
+              compound 'metadata' of util.settings). The measurements are drawn from the statistics of real coin
+              files, with references interleaved, and can be appended live at a set rate.
+
+Usage : python synthetic_data.py generate OUT.h5 [--n N] [--coins FILE ...] [--reference-every K]
+                                          [--noise gaussian|resample|none] [--noise-scale S] [--seed SEED]
+        python synthetic_data.py live OUT.h5 [--rate HZ] [--count N] [--capacity N] [--swmr] [...]
+"""
+
+import argparse
+import datetime
+import glob
+import os
+import time
+import h5py
+import numpy as np
+from util.settings import Dtype, Settings
+
+DEFAULT_COINS = sorted(glob.glob("./data/Groupe5/dataSetAGF-bobine3/*.h5"))
+NOISE_MODELS = ("gaussian", "resample", "none")
+STR_LEN = 50
+
+# metadata of the measurements that are not received from the serial port (as in DataFileReader)
+MES_METADATA = {
+    'Measurement description': Dtype.string,
+    'Measurement UID': Dtype.uint32,
+    'Date and time': Dtype.string,
+    'Software version': Dtype.string,
+}
+DTYPE_FORMATS = {
+    Dtype.uint16: ('<i2', (1,)),
+    Dtype.uint32: ('<i4', (1,)),
+    Dtype.uint96: ('<i4', (3,)),
+    Dtype.float32: ('<f4', (1,)),
+    Dtype.string: ('i1', (STR_LEN,)),
+    Dtype.bool: ('i1', (1,)),
+}
+# values of the ISS sensor, used when the source file does not have them
+DEFAULT_METADATA = {
+    'Software version': Settings.settings['Software version'],
+    'Number of points': 508,
+    'Number of sequences': 10,
+    'Shunt resistor [Ohm]': 100,
+    'Reference voltage [V]': 3.0,
+    'Sampling frequency [Hz]': 1.4e6,
+    'Hardware version': '1.0',
+    'Firmware version': '1.0',
+}
+
+
+def metadata_dtype():
+    """
+    Compound type of the measurement metadata, built from util.settings as DataFileReader does
+
+    Returns:
+    metadata type : numpy dtype
+    """
+    keys = dict(MES_METADATA)
+    keys.update(Settings.settings['Metadata labels']['com'])
+    return np.dtype({'names': list(keys), 'formats': [DTYPE_FORMATS[t] for t in keys.values()]})
+
+
+def encode_strings(strings):
+    """
+    Encode strings as null-terminated int8 arrays of the metadata
+
+    Arguments:
+    strings -- strings : list of str
+
+    Returns:
+    encoded strings (N, STR_LEN) : 2D numpy array of int8
+    """
+    encoded = np.array([s.encode('utf-8')[:STR_LEN-1] for s in strings], dtype='S{}'.format(STR_LEN))
+    return encoded.view(np.int8).reshape(len(strings), STR_LEN)
+
+
+class CoinModel:
+    """
+    Class to draw synthetic measurements of a coin from the statistics of a real data file.
+
+    The coin is stored relative to the calibration of its file (coin - reference), so coins measured with
+    different sensors can be mixed in one file calibrated by a single reference.
+    """
+
+    def __init__(self, file_path, name=None):
+        """
+        Constructor
+
+        Arguments:
+        file_path -- real data file of the coin, its reference rows (or its first row) are the calibration : str
+        name -- name of the coin, the file name if None : str
+        """
+        self.file_path = file_path
+        self.name = name or os.path.splitext(os.path.basename(file_path))[0]
+        with h5py.File(file_path, 'r') as f:
+            rows = np.flatnonzero(f['existing'][:])
+            impedance = f['impedance'][rows[0]:rows[-1]+1][rows - rows[0]]
+            rawdata = f['rawdata'][rows[0]:rows[-1]+1][rows - rows[0]]
+            metadata = f['metadata'][rows[0]:rows[-1]+1][rows - rows[0]]
+
+        is_reference = metadata['Reference'].reshape(-1) != 0
+        if not is_reference.any():
+            is_reference[0] = True # coin files : the first measurement is the calibration
+        if is_reference.all():
+            raise ValueError("{} has no coin measurement".format(file_path))
+
+        self.frequency = impedance[0, 0]
+        Z = impedance[:, 1:]
+        self.reference = Z[is_reference]
+        self.reference_mean = self.reference.mean(axis=0)
+        self.delta = Z[~is_reference] - self.reference_mean
+        self.delta_mean = self.delta.mean(axis=0)
+        self.rawdata = rawdata[~is_reference]
+        self.reference_rawdata = rawdata[is_reference]
+        self.metadata = metadata[0]
+
+    def sample(self, n, rng, noise="gaussian", noise_scale=1.0, reference=False):
+        """
+        Draw measurements (relative to the calibration for the coins)
+
+        Arguments:
+        n -- number of measurements : int
+        rng -- random generator : numpy Generator
+        noise -- 'gaussian' (mean and covariance of the real measurements), 'resample' (real measurements)
+                 or 'none' (mean) : str
+        noise_scale -- factor of the gaussian standard deviation : float
+        reference -- draw calibration measurements instead of coin measurements : bool
+
+        Returns:
+        real and imaginary rows (n, 2, F) : 3D numpy array
+        raw data of real measurements (n, 2, F) : 3D numpy array
+        """
+        if reference:
+            measured, raw = self.reference - self.reference_mean, self.reference_rawdata
+        else:
+            measured, raw = self.delta, self.rawdata
+        mean = measured.mean(axis=0)
+        rows = rng.integers(len(measured), size=n)
+        if noise == "resample":
+            Z = measured[rows]
+        elif noise == "gaussian":
+            # random combinations of the deviations of the real measurements : the covariance between the
+            # frequencies (coin position, height, ...) is the one of the real measurements
+            m = len(measured)
+            weights = rng.standard_normal((n, m))*(noise_scale/np.sqrt(max(m - 1, 1)))
+            Z = mean + (weights @ (measured - mean).reshape(m, -1)).reshape((n,) + mean.shape)
+        elif noise == "none":
+            Z = np.broadcast_to(mean, (n,) + mean.shape).copy()
+        else:
+            raise ValueError("unknown noise model {}, expected one of {}".format(noise, NOISE_MODELS))
+        return Z, raw[rows % len(raw)]
+
+
+class MeasurementGenerator:
+    """
+    Class to generate the rows of a data file : coin measurements drawn at random among the coin models,
+    and a calibration measurement first and then every reference_every measurements
+    """
+
+    def __init__(self, models, reference_every=0, noise="gaussian", noise_scale=1.0, seed=0,
+                 start_time=None, interval=1.0):
+        """
+        Constructor
+
+        Arguments:
+        models -- coin models, the first one gives the calibration of the file : list of CoinModel
+        reference_every -- number of measurements between two calibrations, 0 for the first one only : int
+        noise -- noise model, see CoinModel.sample : str
+        noise_scale -- factor of the gaussian standard deviation : float
+        seed -- seed of the random generator : int
+        start_time -- time stamp of the first measurement, now if None : datetime
+        interval -- time between two measurements in the metadata [s] : float
+        """
+        if noise not in NOISE_MODELS:
+            raise ValueError("unknown noise model {}, expected one of {}".format(noise, NOISE_MODELS))
+        self.models = list(models)
+        self.reference_every = reference_every
+        self.noise = noise
+        self.noise_scale = noise_scale
+        self.rng = np.random.default_rng(seed)
+        self.start_time = start_time or datetime.datetime.now()
+        self.interval = interval
+        self.count = 0 # number of measurements generated
+        self.labels = [] # coin model of each measurement, -1 for the calibrations
+
+        self.frequency = self.models[0].frequency
+        self.calibration = self.models[0].reference_mean
+        for model in self.models:
+            if not np.array_equal(model.frequency, self.frequency):
+                raise ValueError("{} does not have the frequencies of {}".format(model.file_path, self.models[0].file_path))
+
+        self.dtype = metadata_dtype()
+        self.__metadata = np.zeros((), dtype=self.dtype)
+        for name in self.dtype.names:
+            if name in self.models[0].metadata.dtype.names:
+                self.__metadata[name] = self.models[0].metadata[name]
+            elif name in DEFAULT_METADATA:
+                value = DEFAULT_METADATA[name]
+                self.__metadata[name] = encode_strings([value])[0] if isinstance(value, str) else value
+
+    def is_reference(self, k):
+        """
+        Returns:
+        True if the measurement k is a calibration : bool
+        """
+        return k == 0 or (self.reference_every > 0 and k % (self.reference_every + 1) == 0)
+
+    def next_block(self, n):
+        """
+        Generate the next measurements
+
+        Arguments:
+        n -- number of measurements : int
+
+        Returns:
+        impedance (n, 3, F), rawdata (n, 2, F), metadata (n,) : numpy arrays
+        """
+        index = np.arange(self.count, self.count + n)
+        is_reference = np.array([self.is_reference(k) for k in index], dtype=bool)
+        labels = np.where(is_reference, -1, self.rng.integers(len(self.models), size=n))
+
+        F = len(self.frequency)
+        impedance = np.empty((n, 3, F))
+        rawdata = np.empty((n, 2, F))
+        impedance[:, 0] = self.frequency
+        for label in np.unique(labels):
+            rows = np.flatnonzero(labels == label)
+            model = self.models[0] if label < 0 else self.models[label]
+            Z, raw = model.sample(len(rows), self.rng, self.noise, self.noise_scale, reference=label < 0)
+            impedance[rows, 1:] = Z + self.calibration
+            rawdata[rows] = raw
+
+        metadata = np.repeat(self.__metadata[None], n)
+        metadata['Measurement description'] = encode_strings(["data {}".format(k+1) for k in index])
+        metadata['Measurement UID'] = index[:, None]
+        times = [self.start_time + datetime.timedelta(seconds=k*self.interval) for k in index]
+        metadata['Date and time'] = encode_strings([t.strftime("%Y-%m-%d %H:%M:%S.%f") for t in times])
+        metadata['Reference'] = is_reference[:, None]
+
+        self.count += n
+        self.labels += labels.tolist()
+        return impedance, rawdata, metadata
+
+
+def create_file(file_path, capacity, F, dtype, swmr=False):
+    """
+    Create an empty data file, preallocated for capacity measurements as the acquisition tool does
+
+    Arguments:
+    file_path -- data file to create : str
+    capacity -- number of measurements : int
+    F -- number of frequencies : int
+    dtype -- metadata type : numpy dtype
+    swmr -- create the file for a SWMR writer (latest format, chunked datasets) : bool
+
+    Returns:
+    file handle : h5py File
+    """
+    f = h5py.File(file_path, 'w', libver='latest' if swmr else None)
+    f.attrs['File description'] = 'synthetic data'
+    f.attrs['User name'] = ''
+    # a SWMR writer can not change the layout of a dataset read concurrently, its storage is chunked
+    rows = min(capacity, 64) if swmr else None
+    f.create_dataset('existing', shape=(capacity,), dtype=np.int8, fillvalue=0, chunks=(rows,) if rows else None)
+    f.create_dataset('impedance', shape=(capacity, 3, F), dtype=np.float64, chunks=(rows, 3, F) if rows else None)
+    f.create_dataset('rawdata', shape=(capacity, 2, F), dtype=np.float64, chunks=(rows, 2, F) if rows else None)
+    f.create_dataset('metadata', shape=(capacity,), dtype=dtype, chunks=(rows,) if rows else None)
+    return f
+
+
+def generate_file(file_path, n, models, capacity=None, block=4096, **generator_args):
+    """
+    Write a synthetic data file
+
+    Arguments:
+    file_path -- data file to create : str
+    n -- number of measurements : int
+    models -- coin models : list of CoinModel
+    capacity -- preallocated number of measurements (>= n, the others are not existing), n if None : int
+    block -- number of measurements generated and written at once : int
+    generator_args -- arguments of MeasurementGenerator (reference_every, noise, noise_scale, seed, ...)
+
+    Returns:
+    generator used, its labels give the coin model of each measurement : MeasurementGenerator
+    """
+    generator = MeasurementGenerator(models, **generator_args)
+    capacity = n if capacity is None else max(capacity, n)
+    with create_file(file_path, capacity, len(generator.frequency), generator.dtype) as f:
+        for start in range(0, n, block):
+            impedance, rawdata, metadata = generator.next_block(min(block, n - start))
+            stop = start + len(metadata)
+            f['impedance'][start:stop] = impedance
+            f['rawdata'][start:stop] = rawdata
+            f['metadata'][start:stop] = metadata
+            f['existing'][start:stop] = 1
+    return generator
+
+
+class LiveAppender:
+    """
+    Class to emulate the acquisition tool : measurements appended one by one to a preallocated file at a set rate.
+
+    By default the file is opened for each measurement (as the ISS tool), with retries while a reader holds it.
+    With swmr=True the file is kept open in SWMR write mode, for the readers opened with DataFileReader(swmr=True).
+    """
+
+    def __init__(self, file_path, models, capacity=1000, swmr=False, **generator_args):
+        """
+        Constructor
+
+        Arguments:
+        file_path -- data file to create : str
+        models -- coin models : list of CoinModel
+        capacity -- preallocated number of measurements : int
+        swmr -- keep the file open in SWMR write mode : bool
+        generator_args -- arguments of MeasurementGenerator (reference_every, noise, noise_scale, seed, ...)
+        """
+        self.file_path = file_path
+        self.capacity = capacity
+        self.generator = MeasurementGenerator(models, **generator_args)
+        self.n_written = 0
+
+        self.__handle = create_file(file_path, capacity, len(self.generator.frequency), self.generator.dtype, swmr)
+        if swmr:
+            self.__handle.swmr_mode = True
+        else:
+            self.__handle.close()
+            self.__handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, n=1, retries=50):
+        """
+        Append the next measurements
+
+        Arguments:
+        n -- number of measurements to append : int
+        retries -- number of retries while the file is locked by a reader : int
+
+        Returns:
+        number of measurements appended (less than n when the file is full) : int
+        """
+        n = min(n, self.capacity - self.n_written)
+        if n <= 0:
+            return 0
+        impedance, rawdata, metadata = self.generator.next_block(n)
+        start, stop = self.n_written, self.n_written + n
+
+        if self.__handle is not None:
+            self.__write(self.__handle, start, stop, impedance, rawdata, metadata)
+            self.__handle.flush()
+        else:
+            for attempt in range(retries):
+                try:
+                    with h5py.File(self.file_path, 'a') as f:
+                        self.__write(f, start, stop, impedance, rawdata, metadata)
+                    break
+                except OSError:
+                    if attempt == retries - 1:
+                        raise
+                    time.sleep(0.01)
+        self.n_written = stop
+        return n
+
+    def run(self, rate=1.0, count=None):
+        """
+        Append measurements one by one at a fixed rate
+
+        Arguments:
+        rate -- number of measurements per second : float
+        count -- number of measurements to append (until the file is full if None) : int
+        """
+        count = self.capacity if count is None else min(self.n_written + count, self.capacity)
+        next_time = time.monotonic()
+        while self.n_written < count:
+            next_time += 1/rate
+            time.sleep(max(next_time - time.monotonic(), 0))
+            self.append()
+
+    def close(self):
+        if self.__handle is not None:
+            self.__handle.close()
+            self.__handle = None
+
+    def __write(self, f, start, stop, impedance, rawdata, metadata):
+        # the data first, then the 'existing' flags : a reader never sees a flagged empty row
+        f['impedance'][start:stop] = impedance
+        f['rawdata'][start:stop] = rawdata
+        f['metadata'][start:stop] = metadata
+        if self.__handle is not None:
+            for name in ('impedance', 'rawdata', 'metadata'):
+                f[name].flush()
+        f['existing'][start:stop] = 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic data files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ('generate', 'live'):
+        sub = subparsers.add_parser(command, help='write a file' if command == 'generate' else 'append live')
+        sub.add_argument('file_path', type=str, help='data file to create')
+        sub.add_argument('--coins', nargs='+', type=str, default=DEFAULT_COINS, help='real coin files')
+        sub.add_argument('--reference-every', type=int, default=0, help='measurements between two calibrations')
+        sub.add_argument('--noise', type=str, default='gaussian', choices=NOISE_MODELS, help='noise model')
+        sub.add_argument('--noise-scale', type=float, default=1.0, help='factor of the gaussian noise')
+        sub.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    subparsers.choices['generate'].add_argument('--n', type=int, default=10000, help='number of measurements')
+    subparsers.choices['generate'].add_argument('--capacity', type=int, default=None, help='preallocated measurements')
+    subparsers.choices['live'].add_argument('--rate', type=float, default=1.0, help='measurements per second')
+    subparsers.choices['live'].add_argument('--count', type=int, default=None, help='number of measurements')
+    subparsers.choices['live'].add_argument('--capacity', type=int, default=1000, help='preallocated measurements')
+    subparsers.choices['live'].add_argument('--swmr', action='store_true', help='keep the file open in SWMR mode')
+    args = parser.parse_args()
+
+    models = [CoinModel(path) for path in args.coins]
+    generator_args = {'reference_every': args.reference_every, 'noise': args.noise,
+                      'noise_scale': args.noise_scale, 'seed': args.seed}
+    if args.command == 'generate':
+        t0 = time.perf_counter()
+        generate_file(args.file_path, args.n, models, args.capacity, **generator_args)
+        print("{} measurements written in {} ({:.1f} MB, {:.1f} s)".format(
+            args.n, args.file_path, os.path.getsize(args.file_path)/2**20, time.perf_counter() - t0))
+    else:
+        with LiveAppender(args.file_path, models, args.capacity, args.swmr, **generator_args) as appender:
+            print("appending to {} at {} measurements/s, Ctrl+C to stop".format(args.file_path, args.rate))
+            try:
+                appender.run(args.rate, args.count)
+            except KeyboardInterrupt:
+                pass
+            print(appender.n_written, "measurements appended")
@@ -1,10 +1,26 @@
-import time
 import os
 import numpy as np
 from datafilereader import DataFileReader
-import pickle
+from features import FeatureExtractor, LABELS, feature_bins, spec_on_bins
+from watcher import MeasurementWatcher
+from model_bundle import DEFAULT_BUNDLE
+from svm_inference import load_predictors
+from latency import LATENCY
+from calibration import CalibrationTracker, MEASUREMENT, REFERENCE, EMPTY, STEP, REJECTED, load_empty_coil
 import glob
 
+CALIBRATION_MESSAGES = {
+    REFERENCE: "Calibration updated",
+    EMPTY: "Empty coil, calibration updated",
+    STEP: "Calibration moved, press again in the air to confirm it",
+    REJECTED: "Calibration rejected, remove the coin from the coil",
+}
+RECALIBRATION_MESSAGES = {
+    'step': "the calibration moved",
+    'age': "no calibration for a long time",
+    'drift': "the coil is drifting",
+}
+
 # Count the number of files in the folder
 def count_files_in_folder(folder_path):
     try:
@@ -14,21 +30,59 @@ def count_files_in_folder(folder_path):
         print(f"An error occurred: {e}")
         return 0
 
-#live files function (live_files.ipynb)
-# Process each test file
-def process_files(folder_path):
+# Classify a batch of measurements
+def classify_batch(X, SVM, SVMO, labels=LABELS):
+    """
+    Gate all the finite feature rows through the one-class model in one call,
+    then classify the accepted rows in a second call
+
+    Arguments:
+    X -- features, one row per measurement : 2D numpy array
+    SVM -- coin classifier
+    SVMO -- one-class model (-1 for unknown coins)
+    labels -- names of the classes : list of str
+
+    Returns:
+    verdict of each measurement : 1D numpy array of str
+    """
+    verdicts = np.full(X.shape[0], "Skipped due to NaN", dtype=object)
+
+    # rows with a NaN (or a zero inductance) can not be classified
+    valid = np.flatnonzero(np.isfinite(X).all(axis=1))
+    if valid.size == 0:
+        return verdicts
+
+    # Anomaly detection
+    t = LATENCY.clock()
+    try:
+        gate = SVMO.predict(X[valid])
+    except ValueError as ve:
+        verdicts[valid] = "Anomaly detection error"
+        return verdicts
+    t = LATENCY.lap('gate', t)
+
+    verdicts[valid[gate == -1]] = "Unknown"
+    accepted = valid[gate != -1]
+    if accepted.size == 0:
+        return verdicts
+
+    # Classification
+    try:
+        Y = SVM.predict(X[accepted])
+        verdicts[accepted] = np.asarray(labels, dtype=object)[Y]
+    except ValueError as ve:
+        verdicts[accepted] = "Classification error"
+    LATENCY.lap('classify', t)
 
-    # Set up features
-    featureListR = [17, 20, 21, 22, 26, 28, 31, 32, 39, 42, 44, 71]
-    featureListL = [4, 5, 6, 7, 8, 9, 10, 12, 61]
-    labels = ["unknown", "5_CTS", "10_CTS", "20_CTS", "50_CTS", "1_CHF", "2_CHF", "5_CHF"]
+    return verdicts
 
-    # Load the pre-trained models
-    with open("models/model1.pkl","rb+") as f:
-        SVM = pickle.load(f)
+#live files function (live_files.ipynb)
+# Process each test file
+def process_files(folder_path, bundle_path=DEFAULT_BUNDLE):
 
-    with open("models/modelOneVsAll.pkl", "rb") as f:
-        SVMO = pickle.load(f)
+    # Load the pre-trained models (once per process)
+    SVM, SVMO, bundle = load_predictors(bundle_path)
+    labels = bundle.labels
 
     NmbFiles = count_files_in_folder(folder_path)
 
@@ -49,74 +103,31 @@ def process_files(folder_path):
         
         dataset = DataFileReader(file_path)
         
-        # Get all measured Z for this coin
-        f, Z = dataset.get_all_mesurements()
-        R = np.real(Z)
-        L = np.imag(Z) / (2 * np.pi * f)
+        # Get all measured Z for this coin, on the frequencies of the features only
+        bins = feature_bins(bundle.feature_spec)
+        f, Z, is_reference, _ = dataset.read_band(bins)
         
         # Get the calibration index
-        C_idx = dataset.get_reference_impedance_index()
-        if C_idx is None or len(C_idx) == 0:
+        C_idx = np.flatnonzero(is_reference)
+        if len(C_idx) == 0:
             print(f"No reference measurement found in {file_path}")
             continue
         
-        R_cal = R[C_idx,:]
-        L_cal = L[C_idx,:]
+        # Calibrate with the reference measurement and remove it from the list of measurements
+        extractor = FeatureExtractor(f, **spec_on_bins(bundle.feature_spec, bins))
+        extractor.set_reference(Z[C_idx,:])
+        Z = np.delete(Z, C_idx, axis=0)
         
-        # Remove the calibration index from the list of measurements
-        R = np.delete(R, C_idx, axis=0)
-        L = np.delete(L, C_idx, axis=0)
-        
-        # Calibrate the coin measurements
-        R = R - R_cal
-        L = L - L_cal
         # Extract the needed features
-        R = R[:, featureListR]
-        L = L[:, featureListL]
-        
-        # Ensure no zero or near-zero values in L to avoid division by zero
-        L[L == 0] = np.nan  # Replace zero with NaN to handle safely
-        p = R[:,0:9] / L
+        features = bundle.scale(extractor.transform(Z))
         
-        # Collect results for each measurement
-        results = []
+        # Classify all the measurements at once
+        verdicts = classify_batch(features, SVM, SVMO, labels)
+        results = [("Measurement {}".format(j), verdict) for j, verdict in enumerate(verdicts)]
         
-        # Initialize prediction counter for the summary
-        predictions = {label: 0 for label in labels}
-
-        # Get the number of measurements after removing calibration
-        N = R.shape[0]
-
-        for j in range(N):
-            # Concatenate the features
-            X = np.concatenate((R[j, :], L[j, :], p[j, :]), axis=0)
-            # Check for NaN values before prediction
-            if np.isnan(X).any():
-                results.append(("Measurement {}".format(j), "Skipped due to NaN"))
-                continue
-            
-            # Reshape the array to 2D
-            X = X.reshape(1, -1)
-            
-            # Anomaly detection
-            try:
-                result = SVMO.predict(X)
-            except ValueError as ve:
-                results.append(("Measurement {}".format(j), "Anomaly detection error"))
-                continue
-            
-            if result == -1:
-                results.append(("Measurement {}".format(j), "Unknown"))
-                predictions["unknown"] += 1
-            else:
-                # Classification
-                try:
-                    Y = SVM.predict(X)
-                    results.append(("Measurement {}".format(j), labels[Y[0]]))
-                    predictions[labels[Y[0]]] += 1
-                except ValueError as ve:
-                    results.append(("Measurement {}".format(j), "Classification error"))
-                    continue
+        # Prediction counter for the summary
+        predictions = {label: int(np.count_nonzero(verdicts == label)) for label in labels}
+        predictions["unknown"] += int(np.count_nonzero(verdicts == "Unknown"))
         
         # Convert results to NumPy array
         results_array = np.array(results, dtype=object)
@@ -129,64 +140,65 @@ def process_files(folder_path):
     return summary_results, detailed_results
 
 #live test function (live_test.ipynb)
-def liveTest(file_path):
-
-    #Set up features
-    featureListR = [17,20,21,22,26,28,31,32,39,42,44,71]
-    featureListL = [4,5,6,7,8,9,10,12,61]
-
-    labels = ["unknown", "5_CTS", "10_CTS", "20_CTS", "50_CTS", "1_CHF", "2_CHF", "5_CHF"]
+def liveTest(file_path, bundle_path=DEFAULT_BUNDLE, swmr=False, idle_timeout=None):
 
     #SETUP
-    Calibrated = False
-    reader = DataFileReader(file_path)
-    with open("models/model1.pkl","rb+") as f:
-        SVM = pickle.load(f)
-
-    with open("models/modelOneVsAll.pkl", "rb") as f:
-        SVMO = pickle.load(f)
-
-    # CALIBRATION
-    print("\n\n")
-    print("=====================================================")
-    print("Please Start Calibration (one short press in the air)")
-    while not Calibrated:
-    
-        if reader.has_file_changed():
-            f, Z, is_reference = reader.get_last_mesurement()
-            R_cal = np.real(Z)
-            L_cal = np.imag(Z)/(2*np.pi*f)
-            Calibrated = True
-            print("Calibration done")
-            
-
-        #time.sleep(2)  # Give user time to calibrate
-        
-    # TESTING
-    print("Please take the measurement with the coin to be tested (one short press)")
-    while  Calibrated:
-        if reader.has_file_changed():
-            f, Z, is_reference = reader.get_last_mesurement()
-            R = np.real(Z)
-            L = np.imag(Z)/(2*np.pi*f)
-            # calibrate the coin
-            R = R-R_cal
-            L = L-L_cal
-            
-            #extract the needed features
-            R = R[featureListR]
-            L = L[featureListL]
-            p = R[0:9]/L
-            #concatenate the features
-            X = np.concatenate((R,L,p),axis=0)
-            # reshape the array to 2D
-            X = X.reshape(1, -1)
-            Y_pred = SVMO.predict(X)
+    # one handle for the whole session, opened without the file lock: the ISS tool reopens the file to append
+    # (swmr=True only for an acquisition tool writing in SWMR mode)
+    with DataFileReader(file_path, keep_open=True, swmr=swmr) as reader:
+        watcher = MeasurementWatcher(reader) # blocks until new measurements are written (no busy wait)
+        new_measurements = watcher.watch(idle_timeout)
+        SVM, SVMO, bundle = load_predictors(bundle_path)
+        labels = bundle.labels
+
+        # CALIBRATION
+        print("\n\n")
+        print("=====================================================")
+        print("Please Start Calibration (one short press in the air)")
+        # rolling calibration : reference presses and empty coil presses follow the drift of the coil,
+        # a calibration press with a coin on the coil (far from the empty coil signature) is rejected
+        calibration = None
+        for n in new_measurements:
+            f, Z, is_reference = reader.get_mesurement(n)
+            if calibration is None:
+                calibration = CalibrationTracker(f, bundle.feature_spec, empty_coil=load_empty_coil(f))
+            if calibration.add_reference(Z, is_reference) != REJECTED:
+                break
+            print(CALIBRATION_MESSAGES[REJECTED])
+        else:
+            return # idle_timeout expired before the calibration
+        extractor = calibration.extractor
+        X = np.empty((1, extractor.n_features)) # feature buffer reused for every coin
+        print("Calibration done")
+
+        # TESTING
+        print("Please take the measurement with the coin to be tested (one short press)")
+        recalibration = None
+        for n in new_measurements:
+            t = LATENCY.clock()
+            f, Z, is_reference = reader.get_mesurement(n)
+            t = LATENCY.lap('read', t)
+            kind = calibration.observe(Z, is_reference)
+            if kind != MEASUREMENT:
+                print(CALIBRATION_MESSAGES[kind])
+                recalibration = calibration.recalibration_reason()
+                continue
+            # calibrate the coin and extract the needed features
+            extractor.transform(Z, out=X)
+            x = bundle.scale(X)
+            t = LATENCY.lap('features', t)
+            Y_pred = SVMO.predict(x)
+            t = LATENCY.lap('gate', t)
             #result = ANO.predict(X)
             if Y_pred == -1:
                 print("Coin is unknown")
             else:
-                Y = SVM.predict(X)
+                Y = SVM.predict(x)
+                LATENCY.lap('classify', t)
                 print("Coin is of type: ", labels[Y[0]])
-
-        #time.sleep(2)  # Give user time to mesure the coin to be tested
\ No newline at end of file
+            if watcher.last_write_ns is not None:
+                LATENCY.record_since_write('verdict', watcher.last_write_ns)
+            reason = calibration.recalibration_reason()
+            if reason is not None and reason != recalibration:
+                print("Please recalibrate (one short press in the air) : " + RECALIBRATION_MESSAGES[reason])
+            recalibration = reason
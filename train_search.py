@@ -0,0 +1,481 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Hyperparameter search of the coin classifier (SVC) and of the one-class gate (OneClassSVM or
+              IsolationForest) by grouped cross-validation : each fold keeps out all the coins measured by one
+              group (and coil), so the scores measure how the models generalise to a sensor they have never seen.
+              The (candidate, fold) fits run in a process pool and the fitted models are cached on disk, keyed by
+              the training data and the parameters, so a new run only fits the candidates it has not seen yet.
+
+              The classifier is scored by its accuracy on the coins of the held-out group, the gate by its
+              balanced accuracy between these coins (accepted) and the foreign coins (rejected). The ranked
+              candidates are printed and written as CSV, the best classifier and the best gate are fitted again
+              on all the coins and saved as a model bundle (model_bundle.py).
+
+Usage : python train_search.py [--folders FOLDER ...] [--workers N] [--models svc ocsvm iforest] [--no-scale]
+                               [--out FOLDER] [--table FILE] [--cache FOLDER | --no-cache] [--spec FILE] [--top N]
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import glob
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+import sklearn
+from sklearn.ensemble import IsolationForest
+from sklearn.model_selection import LeaveOneGroupOut, ParameterGrid
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC, OneClassSVM
+from createSets import FOREIGN_FOLDER, FOREIGN_NAMES, SEED, discover_files, extract_all
+from data_catalog import parse_path
+from feature_cache import DEFAULT_CACHE_DIR
+from features import load_spec
+from model_bundle import save_bundle
+
+SEARCH_CACHE_VERSION = 1 # to be incremented when the fits or the scores change
+DEFAULT_SEARCH_CACHE = os.environ.get("SEARCH_CACHE_DIR", "./.search_cache")
+DEFAULT_OUT = "models/bundle_search"
+DEFAULT_TABLE = "models/search_results.csv"
+
+# model of each family, its role in the bundle and its grid (the values of the training notebooks are included)
+MODELS = {'svc': SVC, 'ocsvm': OneClassSVM, 'iforest': IsolationForest}
+ROLES = {'svc': 'classifier', 'ocsvm': 'gate', 'iforest': 'gate'}
+DEFAULT_GRIDS = {
+    'svc': [{'kernel': ['linear'], 'C': [0.1, 1, 10, 100]},
+            {'kernel': ['rbf'], 'C': [1, 10, 100, 1000], 'gamma': ['scale', 0.01, 0.1]}],
+    'ocsvm': [{'kernel': ['rbf'], 'nu': [0.001, 0.01, 0.05, 0.1], 'gamma': ['scale', 0.01, 0.1, 1]}],
+    'iforest': [{'contamination': [0.01, 0.05, 0.1], 'n_estimators': [100, 300], 'random_state': [SEED]}],
+}
+
+_data = None # data of the search, set in each worker of the pool
+
+
+def discover_groups(folders):
+    """
+    Find the coin files of the folders and the group (and coil) which measured them
+
+    Arguments:
+    folders -- folders containing the coin files : list of str
+
+    Returns:
+    (file path, label, group) of each coin file : list of tuple
+    """
+    files = []
+    for path, label in discover_files(folders):
+        entry = parse_path(os.path.relpath(path).replace(os.sep, "/"))
+        group = entry['group_name'] if entry['coil'] is None else entry['group_name'] + "/" + entry['coil']
+        files.append((path, label, group))
+    return files
+
+
+def load_data(folders, workers=None, cache_dir=DEFAULT_CACHE_DIR, spec=None):
+    """
+    Features of the coins and of the foreign coins, the first measurement of each file is its calibration
+
+    Arguments:
+    folders -- folders containing the coin files : list of str
+    workers -- number of processes extracting the features : int
+    cache_dir -- feature cache folder, None to always read the files : str
+    spec -- feature specification : dict
+
+    Returns:
+    'X', 'Y', 'groups' of the coins and 'X_foreign' (rows with non finite features are removed) : dict
+    """
+    spec = load_spec() if spec is None else spec
+    coin_files = discover_groups(folders)
+    foreign_files = [os.path.join(FOREIGN_FOLDER, name+".h5") for name in FOREIGN_NAMES]
+    features = extract_all([path for path,_,_ in coin_files] + foreign_files, workers, cache_dir, spec)
+
+    coin_features = features[:len(coin_files)]
+    X = np.concatenate(coin_features, axis=0)
+    Y = np.concatenate([np.full(len(x), label) for x,(_,label,_) in zip(coin_features, coin_files)])
+    groups = np.concatenate([np.full(len(x), group) for x,(_,_,group) in zip(coin_features, coin_files)])
+    X_foreign = np.concatenate(features[len(coin_files):], axis=0)
+
+    keep = np.all(np.isfinite(X), axis=1)
+    keep_foreign = np.all(np.isfinite(X_foreign), axis=1)
+    return {'X': X[keep], 'Y': Y[keep], 'groups': groups[keep], 'X_foreign': X_foreign[keep_foreign],
+            'removed': int(np.sum(~keep) + np.sum(~keep_foreign))}
+
+
+def candidates(grids):
+    """
+    Candidates of the search
+
+    Arguments:
+    grids -- parameter grids of each model family : dict
+
+    Returns:
+    (family, parameters) of each candidate : list of tuple
+    """
+    return [(name, params) for name, grid in grids.items() for params in ParameterGrid(grid)]
+
+
+def array_hash(*arrays):
+    """
+    Content hash of numpy arrays
+
+    Returns:
+    hash : str
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        h.update(str((array.dtype, array.shape)).encode('utf-8'))
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+class FoldCache:
+    """
+    Class to cache the models fitted on the folds, one pickle per (training data, family, parameters)
+
+    """
+
+    def __init__(self, cache_dir=DEFAULT_SEARCH_CACHE):
+        """
+        Constructor
+
+        Arguments:
+        cache_dir -- folder of the cache : str
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # --- public methods
+    def key(self, name, params, data_hash):
+        """
+        Key of a fitted model
+
+        Arguments:
+        name -- model family : str
+        params -- parameters of the model : dict
+        data_hash -- content hash of the training data : str
+
+        Returns:
+        key : str
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([SEARCH_CACHE_VERSION, sklearn.__version__, name, params, data_hash],
+                            sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key, fit):
+        """
+        Load a fitted model, or fit and store it
+
+        Arguments:
+        key -- key of the model : str
+        fit -- function returning the fitted model : callable
+
+        Returns:
+        fitted model, fit duration [s] (of the original fit), loaded from the cache : tuple
+        """
+        path = os.path.join(self.cache_dir, key + ".pkl")
+        if os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    model, fit_time = pickle.load(f)
+                return model, fit_time, True
+            except (OSError, EOFError, pickle.UnpicklingError):
+                os.remove(path) # incomplete entry
+
+        t0 = time.perf_counter()
+        model = fit()
+        fit_time = time.perf_counter() - t0
+        # written in a temporary file renamed at the end, so that concurrent writers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((model, fit_time), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        return model, fit_time, False
+
+
+def make_model(name, params):
+    """
+    Unfitted model of a candidate
+
+    Arguments:
+    name -- model family ('svc', 'ocsvm' or 'iforest') : str
+    params -- parameters of the model : dict
+
+    Returns:
+    sklearn estimator
+    """
+    return MODELS[name](**params)
+
+
+def score_fold(name, model, X_test, Y_test, X_foreign):
+    """
+    Scores of a fitted model on the held-out group
+
+    Arguments:
+    name -- model family : str
+    model -- fitted model
+    X_test -- features of the coins of the held-out group : 2D numpy array
+    Y_test -- labels of these coins : 1D numpy array
+    X_foreign -- features of the foreign coins : 2D numpy array
+
+    Returns:
+    'score' (accuracy of the classifier, balanced accuracy of the gate) and the other measures : dict
+    """
+    if ROLES[name] == 'classifier':
+        return {'score': float(np.mean(model.predict(X_test) == Y_test))}
+    accepted = float(np.mean(model.predict(X_test) == 1))
+    rejected = float(np.mean(model.predict(X_foreign) == -1))
+    return {'score': (accepted + rejected)/2, 'accepted': accepted, 'rejected': rejected}
+
+
+def fit_fold(task):
+    """
+    Fit (or load from the cache) and score a candidate on a fold, runs in the workers of the pool
+
+    Arguments:
+    task -- (family, parameters, held-out group) : tuple
+
+    Returns:
+    scores of score_fold, with 'fit_time' [s] and 'cached' : dict
+    """
+    name, params, group = task
+    X, Y, X_foreign = _data['X'], _data['Y'], _data['X_foreign']
+    test = _data['groups'] == group
+
+    scaler = None
+    X_train, X_test = X[~test], X[test]
+    if _data['scale']:
+        scaler = StandardScaler().fit(X_train)
+        X_train, X_test, X_foreign = scaler.transform(X_train), scaler.transform(X_test), scaler.transform(X_foreign)
+    Y_train = Y[~test]
+
+    if ROLES[name] == 'classifier':
+        fit = lambda: make_model(name, params).fit(X_train, Y_train)
+    else:
+        fit = lambda: make_model(name, params).fit(X_train)
+
+    cache = _data['cache']
+    if cache is None:
+        t0 = time.perf_counter()
+        model, cached = fit(), False
+        fit_time = time.perf_counter() - t0
+    else:
+        model, fit_time, cached = cache.get(cache.key(name, params, array_hash(X_train, Y_train)), fit)
+
+    scores = score_fold(name, model, X_test, Y[test], X_foreign)
+    scores.update({'fit_time': fit_time, 'cached': cached})
+    return scores
+
+
+def init_worker(data):
+    """
+    Set the data of the search in a worker of the pool
+
+    Arguments:
+    data -- data of the search : dict
+    """
+    global _data
+    _data = data
+
+
+def run_search(data, grids=DEFAULT_GRIDS, workers=None, cache_dir=DEFAULT_SEARCH_CACHE, scale=True):
+    """
+    Grouped cross-validation of all the candidates, the (candidate, fold) fits run in a process pool
+
+    Arguments:
+    data -- data of the search (load_data) : dict
+    grids -- parameter grids of each model family : dict
+    workers -- number of processes (None for the number of CPUs, 1 to stay in this process) : int
+    cache_dir -- cache folder of the fitted folds, None to always fit : str
+    scale -- standardize the features (scaler fitted on the training coins of each fold) : bool
+
+    Returns:
+    results of the candidates, best first in each family : list of dict
+    """
+    folds = [str(data['groups'][test[0]]) for _,test in LeaveOneGroupOut().split(data['X'], groups=data['groups'])]
+    tasks = [(name, params, group) for name, params in candidates(grids) for group in folds]
+    search_data = dict(data, scale=scale, cache=FoldCache(cache_dir) if cache_dir is not None else None)
+
+    if workers == 1:
+        init_worker(search_data)
+        scores = [fit_fold(task) for task in tasks]
+    else:
+        n_workers = workers or os.cpu_count()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                    initargs=(search_data,)) as pool:
+            scores = list(pool.map(fit_fold, tasks, chunksize=max(1, len(tasks)//(4*n_workers))))
+
+    results = []
+    for i, (name, params) in enumerate(candidates(grids)):
+        folds_scores = scores[i*len(folds):(i+1)*len(folds)]
+        fold_score = np.array([s['score'] for s in folds_scores])
+        result = {'model': name, 'role': ROLES[name], 'params': params,
+                  'mean': float(np.mean(fold_score)), 'std': float(np.std(fold_score)),
+                  'worst': float(np.min(fold_score)), 'worst_group': folds[int(np.argmin(fold_score))],
+                  'folds': dict(zip(folds, fold_score.tolist())),
+                  'fit_time': float(sum(s['fit_time'] for s in folds_scores)),
+                  'cached': sum(s['cached'] for s in folds_scores)}
+        for measure in ('accepted', 'rejected'):
+            if measure in folds_scores[0]:
+                result[measure] = float(np.mean([s[measure] for s in folds_scores]))
+        results.append(result)
+    return rank(results)
+
+
+def rank(results):
+    """
+    Sort the results by role, then by mean score, then by worst fold score
+
+    Arguments:
+    results -- results of the candidates : list of dict
+
+    Returns:
+    sorted results, with their 'rank' in their role : list of dict
+    """
+    results = sorted(results, key=lambda r: (r['role'], -r['mean'], -r['worst']))
+    for role in set(r['role'] for r in results):
+        for i, result in enumerate(r for r in results if r['role'] == role):
+            result['rank'] = i + 1
+    return results
+
+
+def best(results, role):
+    """
+    Best candidate of a role
+
+    Arguments:
+    results -- ranked results : list of dict
+    role -- 'classifier' or 'gate' : str
+
+    Returns:
+    result of the best candidate, None if the role was not searched : dict
+    """
+    return next((r for r in results if r['role'] == role and r['rank'] == 1), None)
+
+
+def format_params(params):
+    return " ".join("{}={}".format(key, value) for key, value in sorted(params.items()) if key != 'random_state')
+
+
+def print_table(results, top=10):
+    """
+    Print the best candidates of each role
+
+    Arguments:
+    results -- ranked results : list of dict
+    top -- number of candidates printed per role : int
+    """
+    for role in ('classifier', 'gate'):
+        rows = [r for r in results if r['role'] == role and r['rank'] <= top]
+        if not rows:
+            continue
+        print("\n{} (score : {}, mean over the held-out groups)".format(
+            role, "accuracy" if role == 'classifier' else "balanced accuracy CHF / foreign"))
+        print("{:>4}  {:<8} {:<40} {:>7} {:>7} {:>7}  {:<18} {:>8}".format(
+            "rank", "model", "parameters", "mean", "std", "worst", "worst group", "fit [s]"))
+        for r in rows:
+            print("{:>4}  {:<8} {:<40} {:>7.3f} {:>7.3f} {:>7.3f}  {:<18} {:>8.2f}".format(
+                r['rank'], r['model'], format_params(r['params']), r['mean'], r['std'], r['worst'],
+                r['worst_group'], r['fit_time']))
+
+
+def write_table(path, results):
+    """
+    Write the ranked results as CSV, one row per candidate and one column per held-out group
+
+    Arguments:
+    path -- CSV file : str
+    results -- ranked results : list of dict
+    """
+    groups = sorted(set(group for r in results for group in r['folds']))
+    columns = ["role", "rank", "model", "params", "mean", "std", "worst", "worst_group", "accepted", "rejected",
+               "fit_time"]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns + groups)
+        for r in results:
+            row = [r.get(column, "") for column in columns]
+            row[columns.index("params")] = json.dumps(r['params'], sort_keys=True)
+            writer.writerow(row + [r['folds'].get(group, "") for group in groups])
+
+
+def fit_best(data, results, scale=True):
+    """
+    Fit the best classifier and the best gate on all the coins
+
+    Arguments:
+    data -- data of the search (load_data) : dict
+    results -- ranked results : list of dict
+    scale -- standardize the features : bool
+
+    Returns:
+    classifier, gate, scaler (None without scaling) : tuple
+    """
+    X, Y = data['X'], data['Y']
+    scaler = StandardScaler().fit(X) if scale else None
+    Xs = scaler.transform(X) if scale else X
+    classifier, gate = best(results, 'classifier'), best(results, 'gate')
+    return (make_model(classifier['model'], classifier['params']).fit(Xs, Y),
+            make_model(gate['model'], gate['params']).fit(Xs),
+            scaler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Grouped cross-validation search of the classifier and the gate')
+    parser.add_argument('--folders', nargs='+', type=str, default=None,
+                        help='folders of the coin files (default: all the ./data/Groupe* folders)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--models', nargs='+', type=str, default=list(MODELS), choices=list(MODELS),
+                        help='model families searched')
+    parser.add_argument('--no-scale', action='store_true', help='do not standardize the features')
+    parser.add_argument('--out', type=str, default=DEFAULT_OUT, help='bundle folder of the best models')
+    parser.add_argument('--table', type=str, default=DEFAULT_TABLE, help='CSV of the ranked candidates')
+    parser.add_argument('--cache', type=str, default=DEFAULT_SEARCH_CACHE, help='cache folder of the fitted folds')
+    parser.add_argument('--no-cache', action='store_true', help='always fit the folds')
+    parser.add_argument('--spec', type=str, default=None, help='feature specification JSON (feature_selection.py)')
+    parser.add_argument('--top', type=int, default=10, help='number of candidates printed per role')
+    args = parser.parse_args()
+
+    folders = args.folders if args.folders is not None else sorted(glob.glob("./data/Groupe*/"))
+    spec = load_spec(args.spec)
+    scale = not args.no_scale
+    grids = {name: DEFAULT_GRIDS[name] for name in args.models}
+
+    t0 = time.perf_counter()
+    data = load_data(folders, args.workers, DEFAULT_CACHE_DIR, spec)
+    groups, counts = np.unique(data['groups'], return_counts=True)
+    print("{} measurements of {} coins, {} foreign, {} rows with non finite features removed".format(
+        len(data['Y']), len(np.unique(data['Y'])), len(data['X_foreign']), data['removed']))
+    print("groups : " + ", ".join("{} ({})".format(g, n) for g, n in zip(groups, counts)))
+    t_load = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    results = run_search(data, grids, args.workers, None if args.no_cache else args.cache, scale)
+    t_search = time.perf_counter() - t0
+    n_fits = len(results)*len(groups)
+    n_cached = sum(r['cached'] for r in results)
+    print("{} candidates x {} folds in {:.1f} s ({} fits, {} loaded from the cache)".format(
+        len(results), len(groups), t_search, n_fits - n_cached, n_cached))
+
+    print_table(results, args.top)
+    write_table(args.table, results)
+    print("\nranked candidates written in", args.table)
+
+    if best(results, 'classifier') is None or best(results, 'gate') is None:
+        print("a classifier and a gate family are needed for the bundle, no bundle saved")
+    else:
+        classifier, gate, scaler = fit_best(data, results, scale)
+        summary = {role: {key: best(results, role)[key] for key in ('model', 'params', 'mean', 'std', 'folds')}
+                   for role in ('classifier', 'gate')}
+        save_bundle(args.out, classifier, gate, scaler, spec=spec,
+                    search={'folders': folders, 'scale': scale, 'grids': grids, 'best': summary,
+                            'table': args.table})
+        print("best classifier {} {}, best gate {} {}".format(
+            summary['classifier']['model'], format_params(summary['classifier']['params']),
+            summary['gate']['model'], format_params(summary['gate']['params'])))
+        print("bundle saved in {} (data {:.1f} s, search {:.1f} s)".format(args.out, t_load, t_search))
@@ -0,0 +1,316 @@
+"""
+Cours :       MachLearn - Metal classifier project
+Created : 2024
+
+Description : Wait for new measurements appended to a data file by the ISS acquisition tool
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from latency import LATENCY
+
+# inotify constants (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+DIR_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+class InotifyBackend:
+    """
+    Class to block on the inotify events of a file (linux only), through ctypes.
+    When the file is deleted, moved or replaced, its directory is watched until the file reappears
+
+    """
+
+    def __init__(self, file_path):
+        """
+        Constructor
+
+        Arguments:
+        file_path -- path of the file to watch : str
+        """
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on linux")
+
+        self.file_path = file_path
+        self.__directory = os.path.dirname(os.path.abspath(file_path))
+        self.__name = os.fsencode(os.path.basename(file_path))
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.__file_wd = None
+        self.__dir_wd = None
+        self.__inode = None
+        self.__arm()
+
+    def wait(self, timeout=None):
+        """
+        Wait for a change of the file
+
+        Arguments:
+        timeout -- maximum waiting time [s], None to wait forever : float
+
+        Returns:
+        True if the file has changed : bool
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            readable, _, _ = select.select([self.__fd], [], [], remaining)
+            if not readable:
+                return False
+
+            changed = False
+            for wd, name in self.__read_events():
+                if wd == self.__file_wd:
+                    changed = True
+                elif wd == self.__dir_wd and name == self.__name:
+                    changed = True
+            # re-arm the watch if the file was deleted, moved or replaced by another one
+            if self.__get_inode() != self.__inode:
+                self.__arm()
+            # while the file is missing, only its directory is watched
+            if changed and self.__inode is not None:
+                return True
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+    def __read_events(self):
+        """
+        Drain all pending events
+
+        Returns:
+        watch descriptor and file name (empty for the file watch) of each event : list of tuple
+        """
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.__fd, 4096)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buffer):
+                wd, _, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                start = offset + EVENT_HEADER.size
+                events.append((wd, buffer[start:start+length].rstrip(b'\0')))
+                offset = start + length
+
+    def __arm(self):
+        """
+        Watch the file, or its directory until the file (re)appears
+        """
+        while True:
+            try:
+                wd = self.__add_watch(self.file_path, WATCH_MASK)
+            except FileNotFoundError:
+                if self.__dir_wd is None:
+                    self.__dir_wd = self.__add_watch(self.__directory, DIR_WATCH_MASK)
+                    continue # the file may have been created before the directory watch
+                self.__inode = None
+                return
+            break
+
+        # the watch of a replaced file is dropped, the directory watch is not needed anymore
+        if self.__file_wd is not None and self.__file_wd != wd:
+            self.__libc.inotify_rm_watch(self.__fd, self.__file_wd)
+        if self.__dir_wd is not None:
+            self.__libc.inotify_rm_watch(self.__fd, self.__dir_wd)
+            self.__dir_wd = None
+        self.__file_wd = wd
+        self.__inode = self.__get_inode()
+
+    def __add_watch(self, path, mask):
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def __get_inode(self):
+        try:
+            st = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return st.st_dev, st.st_ino
+
+
+class PollingBackend:
+    """
+    Class to detect the changes of a file by polling its size and modification time,
+    the polling interval doubles while the file is idle and drops back to the minimum on a change
+
+    """
+
+    def __init__(self, file_path, min_interval=0.01, max_interval=0.5, settle_polls=3):
+        """
+        Constructor
+
+        Arguments:
+        file_path -- path of the file to watch : str
+        min_interval -- polling interval after a change [s] : float
+        max_interval -- polling interval when the file is idle [s] : float
+        settle_polls -- number of polls still reported as changes after a change, to catch the writes
+                        done within the time stamp resolution : int
+        """
+        self.file_path = file_path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.settle_polls = settle_polls
+
+        self.interval = max_interval
+        self.__stamp = self.__get_stamp()
+        self.__hot = 0
+
+    def wait(self, timeout=None):
+        """
+        Wait for a change of the file
+
+        Arguments:
+        timeout -- maximum waiting time [s], None to wait forever : float
+
+        Returns:
+        True if the file has (possibly) changed : bool
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            sleep = self.interval
+            if deadline is not None:
+                sleep = min(sleep, max(deadline - time.monotonic(), 0))
+            time.sleep(sleep)
+
+            stamp = self.__get_stamp()
+            if stamp != self.__stamp:
+                self.__stamp = stamp
+                self.__hot = self.settle_polls
+                self.interval = self.min_interval
+                return True
+            if self.__hot > 0:
+                self.__hot -= 1
+                return True
+
+            self.interval = min(2*self.interval, self.max_interval)
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def close(self):
+        pass
+
+    def __get_stamp(self):
+        try:
+            st = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
+class MeasurementWatcher:
+    """
+    Class to yield the indexes of the measurements appended to a data file.
+
+    New measurements are found by the number of existing measurements, not by the file time stamp,
+    so several measurements written between two wake-ups are all reported.
+
+    """
+
+    def __init__(self, reader, backend='auto', min_interval=0.01, max_interval=0.5):
+        """
+        Constructor
+
+        Arguments:
+        reader -- reader of the watched file : DataFileReader
+        backend -- 'inotify', 'polling' or 'auto' (inotify if available) : str
+        min_interval -- polling interval after a change [s] (polling backend) : float
+        max_interval -- polling interval when the file is idle [s] (polling backend) : float
+        """
+        self.reader = reader
+        self.file_path = reader.filename
+
+        self.backend = None
+        if backend in ('auto', 'inotify'):
+            try:
+                self.backend = InotifyBackend(self.file_path)
+            except OSError:
+                if backend == 'inotify':
+                    raise
+        if self.backend is None:
+            self.backend = PollingBackend(self.file_path, min_interval, max_interval)
+
+        # index of the next measurement to report
+        self.cursor = reader.get_number_of_mesurements()
+        # modification time of the file when the last new measurements were found [ns] (latency instrumentation only)
+        self.last_write_ns = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def poll(self, timeout=None):
+        """
+        Wait for new measurements
+
+        Arguments:
+        timeout -- maximum waiting time [s], None to wait forever : float
+
+        Returns:
+        indexes of the new measurements (empty if the timeout expired) : list of int
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self.backend.wait(remaining):
+                return []
+
+            self.reader.refresh()
+            N = self.reader.get_number_of_mesurements()
+            if N < self.cursor:
+                # the file has been rewritten, start again from its beginning
+                self.cursor = 0
+            if N > self.cursor:
+                new = list(range(self.cursor, N))
+                self.cursor = N
+                if LATENCY.enabled:
+                    self.last_write_ns = os.stat(self.file_path).st_mtime_ns
+                    LATENCY.record_since_write('detect', self.last_write_ns)
+                return new
+
+    def watch(self, idle_timeout=None):
+        """
+        Generator of the indexes of the new measurements
+
+        Arguments:
+        idle_timeout -- stop after this time without new measurement [s], None to never stop : float
+
+        Yields:
+        measurement index : int
+        """
+        while True:
+            new = self.poll(idle_timeout)
+            if not new:
+                return
+            for n in new:
+                yield n
+
+    def close(self):
+        self.backend.close()